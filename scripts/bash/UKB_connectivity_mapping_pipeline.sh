@@ -115,6 +115,25 @@ subject_instance=(`sed "${line_number}q;d" "${temporary_dir}/bulk/dwi,rsfc,surf,
 ukb_subject_id=${subject_instance[0]}
 ukb_instance=${subject_instance[1]}
 
+# json lines records of the runtime and resources used by the python stages (see instrumentation.py)
+export UKB_STAGE_LOG="${UKB_STAGE_LOG:-${temporary_dir}/logs/stage_records.jsonl}"
+export UKB_SUBJECT_ID="${ukb_subject_id}"
+export UKB_INSTANCE="${ukb_instance}"
+
+# content-addressed cache of derived template files (atlas annot files converted for all subjects,
+# see derived_cache.py), set to an empty value to disable it
+export UKB_DERIVED_CACHE_DIR="${UKB_DERIVED_CACHE_DIR-${temporary_dir}/cache/derived}"
+
+# optionally (UKB_FMRI_CACHE=yes) decompress the fMRI once into a memory-mapped cache that is read by
+# all fMRI extractions (see fmri_cache.py), the cache is written next to the downloaded fMRI (on the
+# node local download directory, not the shared temporary directory) and removed when the run ends
+if [ "${UKB_FMRI_CACHE:-no}" == "yes" ]; then
+	export UKB_FMRI_CACHE_DIR="${ukb_subjects_dir}/${ukb_subject_id}_${ukb_instance}/fmri_cache"
+	trap 'rm -rf "${UKB_FMRI_CACHE_DIR}"' EXIT
+else
+	unset UKB_FMRI_CACHE_DIR
+fi
+
 # execute download script
 "${script_dir}/bash/download_subject_data.sh" "${main_dir}" "${ukb_subjects_dir}" "${ukb_subject_id}" "${ukb_instance}" "${working_dir}"
 
@@ -146,6 +165,26 @@ if [ ! -d "${template_dir}/freesurfer/fsaverage" ]; then
 	cp -r "${FREESURFER_HOME}/subjects/fsaverage" "${template_dir}/freesurfer/"
 fi
 
+# convert the annot files of all fsaverage atlases that are not converted yet in a single run
+# (the converted atlases are shared by all subjects)
+annots_in_l=""
+annots_in_r=""
+annots_out_l=""
+annots_out_r=""
+for atlas in ${atlases[@]}; do
+	IFS=',' read -a atlas_info <<< "${atlas}"
+	if [ "${atlas_info[2]}" == "fsaverage" ] && { [ ! -f "${temporary_dir}/atlases/lh.fsaverage164.${atlas_info[0]}.annot" ] || [ ! -f "${temporary_dir}/atlases/rh.fsaverage164.${atlas_info[0]}.annot" ]; }; then
+		annots_in_l="${annots_in_l:+${annots_in_l},}${template_dir}/atlases/lh.${atlas_info[1]}"
+		annots_in_r="${annots_in_r:+${annots_in_r},}${template_dir}/atlases/rh.${atlas_info[1]}"
+		annots_out_l="${annots_out_l:+${annots_out_l},}${temporary_dir}/atlases/lh.fsaverage164.${atlas_info[0]}.annot"
+		annots_out_r="${annots_out_r:+${annots_out_r},}${temporary_dir}/atlases/rh.fsaverage164.${atlas_info[0]}.annot"
+	fi
+done
+if [ -n "${annots_in_l}" ]; then
+	mkdir -p "${temporary_dir}/atlases"
+	python3 "${script_dir}/python/convert_schaefer_annot.py" "${annots_in_l}" "${annots_in_r}" "${annots_out_l}" "${annots_out_r}"
+fi
+
 # map all surface atlases to native surface
 for atlas in ${atlases[@]}; do
 	IFS=',' read -a atlas_info <<< "${atlas}"
@@ -159,32 +198,7 @@ done
 
 echo -e "${GREEN}[INFO]`date`:${NC} Completed mapping surface atlases to native surface space."
 
-# Step 2: map native surface atlases to native volumetric labels
-
-echo -e "${GREEN}[INFO]`date`:${NC} Mapping native surface atlases to native volume."
-
-# map all surface atlases to native volume
-for atlas in ${atlases[@]}; do
-	IFS=',' read -a atlas_info <<< "${atlas}"
-	atlas_name=${atlas_info[0]}
-	atlas_file=${atlas_info[1]}
-
-	echo -e "${GREEN}[INFO]`date`:${NC} Mapping ${atlas_name} to native volume."
-
-	# use the python code to map surface labels to native volume
-	native_atlas_location="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/atlases/native.${atlas_name}.nii.gz"
-	if [ ! -f ${native_atlas_location} ]; then
-		python3 "${script_dir}/python/map_surface_label_to_volume.py" "${main_dir}" "${ukb_subjects_dir}" "${ukb_subject_id}" "${ukb_instance}" "${atlas_name}"
-	fi
-
-	# This native parcellation should now be resampled to the fmri space
-	native_atlas_location_fMRI="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/atlases/native.fMRI_space.${atlas_name}.nii.gz"
-	if [ ! -f ${native_atlas_location_fMRI} ]; then
-		mri_vol2vol --mov "${native_atlas_location}" --targ "${ukb_subjects_dir}/${ukb_subject_id}_${ukb_instance}/fMRI/rfMRI.ica/mean_func.nii.gz" --interp nearest --regheader --o "${native_atlas_location_fMRI}"
-	fi
-done
-
-# Step 3: map subcortical labels from standard to native space
+# Step 2: map subcortical labels from standard to native space
 
 echo -e "${GREEN}[INFO]`date`:${NC} Mapping MNI subcortical atlases to native volume."
 
@@ -215,70 +229,37 @@ for atlas in ${subcortical_atlases[@]}; do
 	if [ ! -f ${native_atlas_location} ]; then
 		applywarp --ref="${ukb_subjects_dir}/${ukb_subject_id}_${ukb_instance}/T1/T1_brain.nii.gz" --in="${atlas_location}" --warp="${inverse_warp}" --out="${native_atlas_location}" --interp=nn
 	fi
-
-	# This native parcellation should now be resampled to the fmri space
-	native_atlas_location_fMRI="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/atlases/native.fMRI_space.${atlas_name}.nii.gz"
-	if [ ! -f ${native_atlas_location_fMRI} ]; then
-		mri_vol2vol --mov "${native_atlas_location}" --targ "${ukb_subjects_dir}/${ukb_subject_id}_${ukb_instance}/fMRI/rfMRI.ica/mean_func.nii.gz" --interp nearest --regheader --o "${native_atlas_location_fMRI}"
-	fi
 done
 
-echo -e "${GREEN}[INFO]`date`:${NC} All native volumetric atlases generated."
-
 
 # --------------------------------------------------------------------------------
-# Map functional time-series
+# Map native volumetric atlases and functional time-series
 # --------------------------------------------------------------------------------
 
-# Step 1: map fMRI for cortical atlases
+# a single python process runs the following steps (existing outputs are skipped):
+#     1. map native surface atlases to native volumetric labels (sharing the ribbon to surface map)
+#     2. resample all native cortical and subcortical atlases to the fmri space
+#     3. map fMRI for all cortical and subcortical atlases, as well as the global signal (the fMRI
+#        data is only loaded once)
+#     4. compute the functional connectivity (correlation) matrices of all atlases
 
-echo -e "${GREEN}[INFO]`date`:${NC} Mapping fMRI on cortical atlases."
+echo -e "${GREEN}[INFO]`date`:${NC} Mapping native volumetric atlases, fMRI time-series, and functional connectivity."
 
-# iterate over cortical atlases
+cortical_atlas_names=""
 for atlas in ${atlases[@]}; do
 	IFS=',' read -a atlas_info <<< "${atlas}"
-	atlas_name=${atlas_info[0]}
-	atlas_file=${atlas_info[1]}
-
-	echo -e "${GREEN}[INFO]`date`:${NC} Mapping fMRI on ${atlas_name} atlas."
-
-	# use the python code to map fMRI time-series onto cortical atlases
-	fMRI_data="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/fMRI/fMRI.${atlas_name}.csv.gz"
-	if [ ! -f ${fMRI_data} ]; then
-		python3 "${script_dir}/python/compute_cortical_fmri.py" "${main_dir}" "${ukb_subjects_dir}" "${ukb_subject_id}" "${ukb_instance}" "${atlas_name}"
-	fi
+	cortical_atlas_names="${cortical_atlas_names:+${cortical_atlas_names},}${atlas_info[0]}"
 done
 
-# Step 2: map fMRI for subcortical atlases
-
-echo -e "${GREEN}[INFO]`date`:${NC} Mapping fMRI on subcortical atlases."
-
-# iterate over subortical atlases
+subcortical_atlas_names=""
 for atlas in ${subcortical_atlases[@]}; do
 	IFS=',' read -a atlas_info <<< "${atlas}"
-	atlas_name=${atlas_info[0]}
-	atlas_file=${atlas_info[1]}
-
-	echo -e "${GREEN}[INFO]`date`:${NC} Mapping fMRI on ${atlas_name} atlas."
-
-	# use the python code to map fMRI time-series onto cortical atlases
-	fMRI_data="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/fMRI/fMRI.${atlas_name}.csv.gz"
-	if [ ! -f ${fMRI_data} ]; then
-		python3 "${script_dir}/python/compute_subcortical_fmri.py" "${main_dir}" "${ukb_subjects_dir}" "${ukb_subject_id}" "${ukb_instance}" "${atlas_name}"
-	fi
+	subcortical_atlas_names="${subcortical_atlas_names:+${subcortical_atlas_names},}${atlas_info[0]}"
 done
 
-# Step 3: map fMRI for global signal
-
-echo -e "${GREEN}[INFO]`date`:${NC} Mapping fMRI for global signal."
-
-# use the python code to map fMRI time-series onto cortical atlases
-global_signal_fmri="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/fMRI/fMRI.global_signal.csv.gz"
-if [ ! -f ${global_signal_fmri} ]; then
-	python3 "${script_dir}/python/compute_global_fmri.py" "${main_dir}" "${ukb_subjects_dir}" "${ukb_subject_id}" "${ukb_instance}"
-fi
+python3 "${script_dir}/python/run_subject.py" "${main_dir}" "${ukb_subjects_dir}" "${ukb_subject_id}" "${ukb_instance}" "${cortical_atlas_names}" "${subcortical_atlas_names}" --stages volume,fmri,connectivity
 
-echo -e "${GREEN}[INFO]`date`:${NC} All fMRI time-series generated."
+echo -e "${GREEN}[INFO]`date`:${NC} All native volumetric atlases, fMRI time-series, and functional connectivity generated."
 
 
 # --------------------------------------------------------------------------------
@@ -297,7 +278,24 @@ streamlines="10M"
 
 echo -e "${GREEN}[INFO]`date`:${NC} Mapping structural connectomes from tractography outputs."
 
-# Step 2: map connectivity on combined cortical + subcortical atlases
+# Step 2: transform the atlases to dMRI space and combine all selected cortical + subcortical atlases
+# (each atlas is loaded only once)
+
+combination_names=""
+cortical_atlas_names=""
+subcortical_atlas_names=""
+for atlas_combination in ${selected_atlas_combinations[@]}; do
+	IFS=',' read -a atlas_combination_info <<< "${atlas_combination}"
+	"${script_dir}/bash/transform_atlases_to_dmri.sh" "${main_dir}" "${ukb_subjects_dir}" "${ukb_subject_id}" "${ukb_instance}" "${atlas_combination_info[0]}" "${atlas_combination_info[1]}"
+	combination_names="${combination_names:+${combination_names},}${atlas_combination_info[0]}+${atlas_combination_info[1]}"
+	cortical_atlas_names="${cortical_atlas_names:+${cortical_atlas_names},}${atlas_combination_info[0]}"
+	subcortical_atlas_names="${subcortical_atlas_names:+${subcortical_atlas_names},}${atlas_combination_info[1]}"
+done
+
+echo -e "${GREEN}[INFO]`date`:${NC} Combining the cortical and subcortical atlases in dMRI space."
+python3 "${script_dir}/python/combine_volumetric_atlases.py" "${main_dir}" "${ukb_subjects_dir}" "${ukb_subject_id}" "${ukb_instance}" "${cortical_atlas_names}" "${subcortical_atlas_names}" "${combination_names}"
+
+# Step 3: map connectivity on combined cortical + subcortical atlases
 
 for atlas_combination in ${selected_atlas_combinations[@]}; do
 	IFS=',' read -a atlas_combination_info <<< "${atlas_combination}"
@@ -335,5 +333,7 @@ zip -urvTm "${output_dir}/subjects/${ukb_subject_id}_${ukb_instance}/${ukb_subje
 # Tractography data
 zip -urvTm "${output_dir}/subjects/${ukb_subject_id}_${ukb_instance}/${ukb_subject_id}_tractography_${ukb_instance}.zip" \
 		 "./tractography"
+# Cached intermediate files (e.g. the ribbon vertex map, kept until the subject is complete)
+rm -rf "./cache"
 
 # deactivate
@@ -0,0 +1,56 @@
+#!/bin/bash
+#SBATCH --account punim1566
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=1
+#SBATCH --time=0-06:00:00
+#SBATCH --mem=4G
+#SBATCH --partition=physical
+#SBATCH -o /data/gpfs/projects/punim1566/UKB-slurm/slurm_logs/%x_%j.out
+
+# This script is used for automated connectivity mapping of several UKB instances in a single
+# (packed) job. It is submitted as a job array by plan_job_submission.py, and every array task maps
+# the instances of one packed job of the plan.
+#
+# Usage: sbatch --array=0-<jobs-1> ./automate_packed.sh <plan-file> [extra]
+#
+# extra is passed on to the pipeline of every instance, as the second argument of automate.sh.
+#
+
+source /usr/local/module/spartan_new.sh
+module load foss/2019b
+module load web_proxy/latest connectomeworkbench/1.4.2 freesurfer/7.1.1-centos7_x86_64 fsl/6.0.3-python-3.7.4
+# module load mrtrix/3.0.1-python-2.7.16 eigen/3.3.7
+
+# ensure using the built mrtrix
+export PATH="/data/gpfs/projects/punim1566/UKB-connectomics/lib/mrtrix3/bin:$PATH"
+
+source ukbvenv/bin/activate
+
+# make sure that the virtual environment is in pythonpath
+[[ ":$PYTHONPATH:" != *":/data/gpfs/projects/punim1566/UKB-slurm/ukbvenv/lib/python3.7/site-packages:"* ]] && PYTHONPATH="/data/gpfs/projects/punim1566/UKB-slurm/ukbvenv/lib/python3.7/site-packages:${PYTHONPATH}"
+
+# some colors for fancy logging :D
+RED='\033[0;31m'
+GREEN='\033[0;32m'
+NC='\033[0m'
+
+# read the arguments
+plan_file=$1
+export extra=$2
+job_number=${SLURM_ARRAY_TASK_ID}
+
+# change directory to scripts directory
+export code_dir="/data/gpfs/projects/punim1566/UKB-connectomics"
+# use the fast local NVMe storage
+export data_dir="/tmp/UKB-download"
+mkdir -p ${data_dir}
+
+cd ${code_dir}
+
+# run the automation command for every instance of this packed job
+python3 "${code_dir}/scripts/python/plan_job_submission.py" run "${plan_file}" "${job_number}"
+
+echo -e "${GREEN}[INFO]${NC} `date`: Script finished!"
+
+deactivate
@@ -142,17 +142,24 @@ if [ "${atlas_space}" == "fsLR" ]; then
 	fi
 
 	left_fsaverage164_sphere="${ukb_subjects_dir}/${ukb_subject_id}_${ukb_instance}/fsaverage164/surf/lh.sphere"
+	right_fsaverage164_sphere="${ukb_subjects_dir}/${ukb_subject_id}_${ukb_instance}/fsaverage164/surf/rh.sphere"
+
+	# mris_convert --annot "${left_fsaverage164_atlas_gii}" "${left_fsaverage164_sphere}" "${left_fsaverage164_atlas_fs}"
+	# mris_convert --annot "${right_fsaverage164_atlas_gii}" "${right_fsaverage164_sphere}" "${right_fsaverage164_atlas_fs}"
+	# the mris_convert script was replaced with a python script due to a bug in mris_convert
+	# (both hemispheres are converted in a single run)
+	gifti_files=""
+	annot_files=""
 	if [ ! -f ${left_fsaverage164_atlas_fs} ]; then
-		# mris_convert --annot "${left_fsaverage164_atlas_gii}" "${left_fsaverage164_sphere}" "${left_fsaverage164_atlas_fs}"
-		# the mris_convert script was replaced with a python script due to a bug in mris_convert
-		python3 "${script_dir}/python/convert_labels_gii_to_annot.py" "${left_fsaverage164_atlas_gii}" "${left_fsaverage164_atlas_fs}"
+		gifti_files="${gifti_files:+${gifti_files},}${left_fsaverage164_atlas_gii}"
+		annot_files="${annot_files:+${annot_files},}${left_fsaverage164_atlas_fs}"
 	fi
-
-	right_fsaverage164_sphere="${ukb_subjects_dir}/${ukb_subject_id}_${ukb_instance}/fsaverage164/surf/rh.sphere"
 	if [ ! -f ${right_fsaverage164_atlas_fs} ]; then
-		# mris_convert --annot "${right_fsaverage164_atlas_gii}" "${right_fsaverage164_sphere}" "${right_fsaverage164_atlas_fs}"
-		# the mris_convert script was replaced with a python script due to a bug in mris_convert
-		python3 "${script_dir}/python/convert_labels_gii_to_annot.py" "${right_fsaverage164_atlas_gii}" "${right_fsaverage164_atlas_fs}"
+		gifti_files="${gifti_files:+${gifti_files},}${right_fsaverage164_atlas_gii}"
+		annot_files="${annot_files:+${annot_files},}${right_fsaverage164_atlas_fs}"
+	fi
+	if [ -n "${gifti_files}" ]; then
+		python3 "${script_dir}/python/convert_labels_gii_to_annot.py" "${gifti_files}" "${annot_files}"
 	fi
 
 	echo -e "${GREEN}[INFO]`date`:${NC} Labels (fsaverage) converted to .annot format."
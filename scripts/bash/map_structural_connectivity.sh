@@ -47,22 +47,7 @@ subcortical_atlas_file="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instan
 echo -e "${GREEN}[INFO]${NC} `date`: Starting structural connectivity mapping for: ${ukb_subject_id}_${ukb_instance} on (cortical: ${cortical_atlas_name}, subcortical: ${subcortical_atlas_name}) atlases."
 
 # Transform atlases to dwi space (~1sec)
-cortical_atlas_dwi="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/tractography/atlases/native.dMRI_space.${cortical_atlas_name}.nii.gz"
-transform_DWI_T1="${dmri_dir}/diff2struct_mrtrix.txt"
-mkdir -p "${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/tractography/atlases"
-if [ ! -f ${cortical_atlas_dwi} ]; then
-    echo -e "${GREEN}[INFO]${NC} `date`: Transforming atlases to dMRI space"
-    # no need for nearest neighbor given rigid transformation (see issue #19)
-    ${mrtrix_dir}/mrtransform "${cortical_atlas_file}" "${cortical_atlas_dwi}" -linear "${transform_DWI_T1}" -inverse \
-                -datatype uint32 ${threading} -info
-fi
-subcortical_atlas_dwi="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/tractography/atlases/native.dMRI_space.${subcortical_atlas_name}.nii.gz"
-if [ ! -f ${subcortical_atlas_dwi} ]; then
-    echo -e "${GREEN}[INFO]${NC} `date`: Transforming atlases to dMRI space"
-    # nearest neighbor mapping as we aim to combine two atlases (see issue #19)
-    ${mrtrix_dir}/mrtransform "${subcortical_atlas_file}" "${subcortical_atlas_dwi}" -linear "${transform_DWI_T1}" -inverse -interp nearest \
-                -datatype uint32 -template "${cortical_atlas_dwi}" ${threading} -info
-fi
+"${script_dir}/bash/transform_atlases_to_dmri.sh" "${main_dir}" "${ukb_subjects_dir}" "${ukb_subject_id}" "${ukb_instance}" "${cortical_atlas_name}" "${subcortical_atlas_name}"
 
 # Combine atlases together
 combined_atlas_dwi="${dmri_dir}/atlases/combinations/native.dMRI_space.${cortical_atlas_name}+${subcortical_atlas_name}.nii.gz"
@@ -74,6 +59,9 @@ if [ ! -f ${combined_atlas_dwi} ]; then
 fi
 
 # Compute connectivity for different measures extracted (~1sec)
+# The archived connectomes are computed with MRtrix's tck2connectome. The same metrics can be computed
+# with tck2connectome.py (opt-in: run_subjects.py --stages connectome), which writes them to a separate
+# location that is not archived (see run_subjects.py).
 # tracks="${dmri_dir}/tracks_${streamlines}.tck"
 endpoints="${dmri_dir}/tracks_${streamlines}_endpoints.tck"
 sift_weights="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/tractography/metrics/sift_weights.npy"
@@ -6,7 +6,9 @@
 # if the required outputs are generated for that instance, if yes, then skips. If not,
 # it then submits the appropriate job to the queue to generate required outputs.
 #
-# Usage: smart_run_automization.sh ...
+# Usage: smart_run_automization.sh <start_index> <end_index> <main_dir> <ukb_subjects_dir> <required_file_list> [instances_per_job]
+#
+# The instances with missing files are submitted as a job array of packed jobs (plan_job_submission.py).
 #
 
 # source /usr/local/module/spartan_new.sh
@@ -31,8 +33,12 @@ end_index=$(($2 + 1))
 main_dir=$3
 ukb_subjects_dir=$4
 required_file_list=$5
+instances_per_job=${6:-1}
 
 temporary_dir="${main_dir}/data/temporary"
+script_dir="${main_dir}/scripts"
+
+missing_indices=()
 
 index=$start_index
 end_line=$(($(< "${temporary_dir}/bulk/dwi,rsfc,surf,t1.combined" wc -l) + 1))
@@ -67,13 +73,15 @@ do
 
         # Only submit required indices:
         if [ "${needs_running}" = true ] ; then
-                sbatch --job-name="ukb_${index}_smart" --comment="UKB mapping pipeline, instance #${index}" automate.sh ${index}
-                sleep 0.1
+                missing_indices+=(${index})
         fi
 
         ((index = index + 1))
 done
 
+# submit the instances as packed jobs (a single job array)
+python3 "${script_dir}/python/plan_job_submission.py" submit "${main_dir}" ${missing_indices[@]} --instances_per_job ${instances_per_job} < /dev/null
+
 echo -e "${GREEN}[INFO]${NC} `date`: All jobs submitted."
 
 # deactivate
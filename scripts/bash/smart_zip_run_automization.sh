@@ -6,7 +6,10 @@
 # if the required outputs are generated for that instance, if yes, then skips. If not,
 # it then submits the appropriate job to the queue to generate required outputs.
 #
-# Usage: smart_run_automization.sh ...
+# Usage: smart_zip_run_automization.sh <start_index> <end_index> <main_dir> <zip_file> <required_file_list> [instances_per_job]
+#
+# The zip contents are checked with an index kept by zip_completion_index.py, and the instances
+# with missing files are submitted as a job array of packed jobs (plan_job_submission.py).
 #
 
 # source /usr/local/module/spartan_new.sh
@@ -31,50 +34,24 @@ end_index=$(($2 + 1))
 main_dir=$3
 zip_file=$4 # tractography
 required_file_list=$5
+instances_per_job=${6:-1}
 
 temporary_dir="${main_dir}/data/temporary"
 output_dir="${main_dir}/data/output"
 
-index=$start_index
-end_line=$(($(< "${temporary_dir}/bulk/dwi,rsfc,surf,t1.combined" wc -l) + 1))
-min_end=$(( end_index < end_line ? end_index : end_line ))
-while [ $index -lt $min_end ]
-do
-        # Report index
-        echo -e "${GREEN}[INFO]${NC} `date`: Checking files for: instance ${index}"
-
-        # Map index to instance information from the combined bulk file
-        subject_instance=(`sed "${index}q;d" "${temporary_dir}/bulk/dwi,rsfc,surf,t1.combined"`)
-
-        ukb_subject_id=${subject_instance[0]}
-        ukb_instance=${subject_instance[1]}
-
-        echo -e "${GREEN}[INFO]${NC} `date`: Instance info: ${ukb_subject_id}_${ukb_instance}"
-
-        # Check if required files are present
-        needs_running=false
-
+script_dir="${main_dir}/scripts"
 
-        files=(`${required_file_list}`)
+# update the index of files stored in the zip files (only new or modified zips are read)
+python3 "${script_dir}/python/zip_completion_index.py" update "${main_dir}"
 
-        # check existence of all files
-        for file in ${files[@]}; do
-                # check if file exists in the compressed folder
-                if [[ ! `unzip -Z1 "${output_dir}/subjects/${ukb_subject_id}_${ukb_instance}/${ukb_subject_id}_${zip_file}_${ukb_instance}.zip" | grep -w ${file}` ]]; then
-                        echo -e "${RED}[INFO]${NC} File missing: ${file}"
-                        needs_running=true
-                        break
-                fi
-        done
+# list all instances with missing files in a single query
+files=(`${required_file_list}`)
+missing_indices=(`python3 "${script_dir}/python/zip_completion_index.py" missing "${main_dir}" "${zip_file}" ${files[@]} --start ${start_index} --end $((end_index - 1))`)
 
-        # Only submit required indices:
-        if [ "${needs_running}" = true ] ; then
-                sbatch --job-name="ukb_${index}_smart" --comment="UKB mapping pipeline, instance #${index}" automate.sh ${index}
-                sleep 0.1
-        fi
+echo -e "${GREEN}[INFO]${NC} `date`: ${#missing_indices[@]} instances have missing files."
 
-        ((index = index + 1))
-done
+# submit the instances as packed jobs (a single job array)
+python3 "${script_dir}/python/plan_job_submission.py" submit "${main_dir}" ${missing_indices[@]} --instances_per_job ${instances_per_job} < /dev/null
 
 echo -e "${GREEN}[INFO]${NC} `date`: All jobs submitted."
 
@@ -0,0 +1,57 @@
+#!/bin/bash
+
+# This script transforms a pair of native cortical and subcortical volumetric atlases to the dMRI
+# space (existing outputs are skipped), such that they can be combined for connectivity mapping.
+# It mainly uses codes from MRtrix 3.0
+#
+# Usage: transform_atlases_to_dmri.sh <main_dir> <ukb_subjects_dir> <subject_id> <instance> <cortical_atlas_name> <subcortical_atlas_name>
+#
+# Helpful resources:
+# https://www.mrtrix.org/
+# 
+
+
+# some colors for fancy logging :D
+RED='\033[0;31m'
+GREEN='\033[0;32m'
+NC='\033[0m'
+
+
+# --------------------------------------------------------------------------------
+# Setting required variables
+# --------------------------------------------------------------------------------
+
+main_dir=$1
+ukb_subjects_dir=$2
+ukb_subject_id=$3
+ukb_instance=$4
+cortical_atlas_name=$5
+subcortical_atlas_name=$6
+
+mrtrix_dir="${main_dir}/lib/mrtrix3/bin"
+temporary_dir="${main_dir}/data/temporary"
+
+dmri_dir="${ukb_subjects_dir}/${ukb_subject_id}_${ukb_instance}/dMRI/dMRI"
+
+threading="-nthreads 0"
+
+cortical_atlas_file="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/atlases/native.${cortical_atlas_name}.nii.gz"
+subcortical_atlas_file="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/atlases/native.${subcortical_atlas_name}.nii.gz"
+
+# Transform atlases to dwi space (~1sec)
+cortical_atlas_dwi="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/tractography/atlases/native.dMRI_space.${cortical_atlas_name}.nii.gz"
+transform_DWI_T1="${dmri_dir}/diff2struct_mrtrix.txt"
+mkdir -p "${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/tractography/atlases"
+if [ ! -f ${cortical_atlas_dwi} ]; then
+    echo -e "${GREEN}[INFO]${NC} `date`: Transforming atlases to dMRI space"
+    # no need for nearest neighbor given rigid transformation (see issue #19)
+    ${mrtrix_dir}/mrtransform "${cortical_atlas_file}" "${cortical_atlas_dwi}" -linear "${transform_DWI_T1}" -inverse \
+                -datatype uint32 ${threading} -info
+fi
+subcortical_atlas_dwi="${temporary_dir}/subjects/${ukb_subject_id}_${ukb_instance}/tractography/atlases/native.dMRI_space.${subcortical_atlas_name}.nii.gz"
+if [ ! -f ${subcortical_atlas_dwi} ]; then
+    echo -e "${GREEN}[INFO]${NC} `date`: Transforming atlases to dMRI space"
+    # nearest neighbor mapping as we aim to combine two atlases (see issue #19)
+    ${mrtrix_dir}/mrtransform "${subcortical_atlas_file}" "${subcortical_atlas_dwi}" -linear "${transform_DWI_T1}" -inverse -interp nearest \
+                -datatype uint32 -template "${cortical_atlas_dwi}" ${threading} -info
+fi
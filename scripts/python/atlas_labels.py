@@ -0,0 +1,159 @@
+# helper functions to load the label tables of the template atlases (data/templates/atlases/labels)
+#
+# Three formats of label tables are used:
+#     <atlas>.ColorLUT.txt:     freesurfer color lookup table (index, name, R, G, B, A per line)
+#     <atlas>.label_list.txt:   connectome workbench label list (name line, then "index R G B A" line)
+#     <atlas>_label.txt:        subcortical (Tian) label names, one per line (indexed from 1, with
+#                               an added ??? label for 0)
+#
+# Parsed tables are cached as npz files (in data/temporary/cache/atlas_labels, next to the templates
+# directory) that are used as long as the modification time and size of the label file are unchanged, or its content
+# hash still matches (e.g. after copying the templates). Within a process, tables are only loaded
+# once. Every table is a dictionary of arrays:
+#     index:        label ids (int32)
+#     label_name:   label names (str)
+#     color:        R, G, B, A colours (uint8, labels x 4), or None if not available
+#
+# Usage (reading from python):
+#     from atlas_labels import load_atlas_labels
+#     labels = load_atlas_labels(template_dir, 'Glasser', 'ColorLUT')
+#
+# label_ctab generates the colour table of annot files written by the annot conversion scripts, with
+# the colour of every label derived from the hash of its name, so that converted atlases are
+# identical across runs (and a label has the same colour in every atlas).
+
+import os
+import hashlib
+import numpy as np
+
+
+label_formats = {
+    'ColorLUT': '{}.ColorLUT.txt',
+    'label_list': '{}.label_list.txt',
+    'subcortical': '{}_label.txt',
+}
+
+loaded_labels = {}
+
+
+def label_file_name(template_dir, atlas_name, label_format):
+    return '{}/atlases/labels/{}'.format(template_dir, label_formats[label_format].format(atlas_name))
+
+
+def file_hash(file_name):
+    with open(file_name, 'rb') as label_file:
+        return hashlib.sha1(label_file.read()).hexdigest()
+
+
+def read_lines(file_name):
+    # non-empty lines, without comments
+    with open(file_name) as label_file:
+        lines = [line.split('#')[0].strip() for line in label_file]
+    return [line for line in lines if line]
+
+
+def parse_color_lut(file_name):
+    rows = [line.split() for line in read_lines(file_name)]
+    return {
+        'index': np.array([int(x[0]) for x in rows], dtype=np.int32),
+        'label_name': np.array([x[1] for x in rows], dtype=str),
+        'color': np.array([[int(y) for y in x[2:6]] for x in rows], dtype=np.uint8).reshape(-1, 4),
+    }
+
+
+def parse_label_list(file_name):
+    lines = read_lines(file_name)
+    values = [x.split() for x in lines[1::2]]
+    return {
+        'index': np.array([int(x[0]) for x in values], dtype=np.int32),
+        'label_name': np.array(lines[0::2], dtype=str),
+        'color': np.array([[int(y) for y in x[1:5]] for x in values], dtype=np.uint8).reshape(-1, 4),
+    }
+
+
+def parse_subcortical_labels(file_name):
+    label_names = ['???'] + [line.split()[0] for line in read_lines(file_name)]
+    return {
+        'index': np.arange(len(label_names), dtype=np.int32),
+        'label_name': np.array(label_names, dtype=str),
+        'color': None,
+    }
+
+
+label_parsers = {
+    'ColorLUT': parse_color_lut,
+    'label_list': parse_label_list,
+    'subcortical': parse_subcortical_labels,
+}
+
+
+def read_cache(cache_file):
+    if not os.path.isfile(cache_file):
+        return None
+    with np.load(cache_file) as content:
+        return dict(content)
+
+
+def write_cache(cache_file, stat, source_hash, labels):
+    # write through a temporary file, as several processes may load the same table
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        temporary_file = '{}.{}.tmp.npz'.format(cache_file[:-len('.npz')], os.getpid())
+        np.savez(
+            temporary_file,
+            mtime_ns=np.array(stat.st_mtime_ns),
+            size=np.array(stat.st_size),
+            sha1=np.array(source_hash),
+            **{x: labels[x] for x in ['index', 'label_name', 'color'] if labels.get(x) is not None},
+        )
+        os.replace(temporary_file, cache_file)
+    except OSError:
+        # the cache may not be writable, the labels are then parsed in every process
+        pass
+
+
+def load_atlas_labels(template_dir, atlas_name, label_format='ColorLUT'):
+    # load a label table, from the cache if it is still valid
+    file_name = label_file_name(template_dir, atlas_name, label_format)
+    stat = os.stat(file_name)
+    key = (os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size)
+    if key in loaded_labels:
+        return loaded_labels[key]
+
+    cache_file = '{}/temporary/cache/atlas_labels/{}.npz'.format(os.path.dirname(os.path.abspath(template_dir)), os.path.basename(file_name))
+    labels = read_cache(cache_file)
+    if labels is None or (int(labels['mtime_ns']), int(labels['size'])) != (stat.st_mtime_ns, stat.st_size):
+        # the label file was modified (or copied), only parse it again if its content changed
+        source_hash = file_hash(file_name)
+        if labels is None or str(labels['sha1']) != source_hash:
+            labels = label_parsers[label_format](file_name)
+        write_cache(cache_file, stat, source_hash, labels)
+
+    loaded_labels[key] = {
+        'index': labels['index'],
+        'label_name': labels['label_name'],
+        'color': labels.get('color'),
+    }
+    return loaded_labels[key]
+
+
+def label_ctab(label_names):
+    # colour table (R, G, B, A, labels x 4) of an annot file, the first label is unknown
+    #
+    # colours are unique (as annot files identify labels by colour), a label colliding with the
+    # colour of a previous label is given the colour of the hash of its name with a counter
+    reserved = {0, 1 + 1 * 256 + 1 * 256 ** 2}
+    colors = []
+    for label_name in label_names[1:]:
+        label_name = label_name.decode() if isinstance(label_name, bytes) else str(label_name)
+        attempt = 0
+        color = int(hashlib.sha1(label_name.encode('utf8')).hexdigest()[:6], 16)
+        while color in reserved:
+            attempt += 1
+            color = int(hashlib.sha1('{}#{}'.format(label_name, attempt).encode('utf8')).hexdigest()[:6], 16)
+        reserved.add(color)
+        colors.append(color)
+
+    colors = np.array(colors, dtype=np.int64)
+    ctab = np.c_[(colors // 256**2), ((colors // 256) % 256), (colors % 256), np.zeros(len(colors))]
+    return np.concatenate([[[1, 1, 1, 1]], ctab.reshape(-1, 4)]).astype(np.int64)
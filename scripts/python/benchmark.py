@@ -0,0 +1,417 @@
+# script to benchmark the python hot paths of the pipeline on synthetic data
+#
+# Real UKB data can not be shared, so the generate command writes synthetic inputs of realistic
+# dimensions to a benchmark directory:
+#     - volumetric label atlases in dMRI space (2mm) and fMRI space (2.4mm) with a given number of
+#       parcels (a Voronoi partition of a cortex-like shell around two hemisphere ellipsoids), and
+#       on the conformed FreeSurfer grid (256^3 1mm, the grid of the atlases that the pipeline maps
+#       connectomes on, as mrtransform keeps the native grid)
+#     - streamline endpoints (float16 npy) close to the cortical shell, with streamline weights,
+#       and a small tck file
+#     - a 4D fMRI volume (float32 nii.gz) with a brain mask
+#     - FreeSurfer-like pial/white surfaces, a ribbon.mgz, and annot files per parcel count
+#
+# The run command then times every stage (tck2connectome assignment engines, tck endpoint
+# extraction, fMRI loading and parcel averaging, time-series output formats, and the surface to
+# volume label mapping) and reports the wall time, throughput and peak memory of every stage
+# (measured with instrumentation.py). The endpoint assignments of all engines are checked against
+# the kdtree (same distances, and same labels up to ties between equidistant voxels), so that a
+# faster engine can not hide a wrong result. Results can be stored and compared against a baseline
+# run, in which case stages slower than the baseline (by more than the tolerance)
+# are reported as regressions and the script exits with an error.
+#
+# Usage:
+#     benchmark.py generate <bench_dir> [--scale small|ukb] [--parcels 100,400,1000] [--streamlines N]
+#     benchmark.py run <bench_dir> [--stages tck2connectome,endpoints,fmri,surface] [--repeat N]
+#                      [--output results.jsonl] [--baseline results.jsonl] [--tolerance 0.2]
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import nibabel as nib
+from scipy import spatial
+from nibabel import freesurfer
+from instrumentation import Stage, write_record, ensure_dir, time_str
+from tck2connectome import map_connectomes, assignment_engines
+from save_endpoints_as_npy import read_tck_header, iterate_endpoints
+from parcel_timeseries import load_fmri, parcel_mean_timeseries, timeseries_dataframe, save_timeseries
+from map_surface_label_to_volume import compute_ribbon_vertex_map, label_volume
+
+
+# dimensions of the synthetic data (the ukb scale mimics the dimensions of the UKB imaging data)
+scales = {
+    'small': {
+        'dmri_shape': (52, 52, 36), 'dmri_voxel': 4.,
+        'fmri_shape': (44, 44, 32), 'fmri_voxel': 4.8, 'timepoints': 100,
+        'ribbon_shape': (128, 128, 128), 'ribbon_voxel': 2.,
+        'conformed_shape': (128, 128, 128), 'conformed_voxel': 2.,
+        'vertices': 20000, 'streamlines': 1000000, 'tck_streamlines': 20000,
+    },
+    'ukb': {
+        'dmri_shape': (104, 104, 72), 'dmri_voxel': 2.,
+        'fmri_shape': (88, 88, 64), 'fmri_voxel': 2.4, 'timepoints': 490,
+        'ribbon_shape': (256, 256, 256), 'ribbon_voxel': 1.,
+        'conformed_shape': (256, 256, 256), 'conformed_voxel': 1.,
+        'vertices': 130000, 'streamlines': 10000000, 'tck_streamlines': 200000,
+    },
+}
+
+# hemisphere ellipsoids (center and radii in mm), the cortex is the outer shell of each ellipsoid
+hemispheres = {
+    'lh': (np.array([-34., -15., 10.]), np.array([32., 80., 62.])),
+    'rh': (np.array([34., -15., 10.]), np.array([32., 80., 62.])),
+}
+white_radius = 0.85
+
+
+def centered_affine(shape, voxel_size):
+    # affine of a volume centered at the origin
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.])
+    affine[:3, 3] = -(np.array(shape) - 1) / 2 * voxel_size
+    return affine
+
+
+def ellipsoid_radius(xyz_axes, hemi):
+    # normalized ellipsoid radius of coordinates given as a broadcastable (x, y, z) tuple
+    center, radii = hemispheres[hemi]
+    return np.sqrt(sum(((xyz_axes[i] - center[i]) / radii[i]) ** 2 for i in range(3)))
+
+
+def volume_axes(shape, affine):
+    # world coordinates of all voxels as a broadcastable (x, y, z) tuple (float32)
+    ijk = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    return tuple(
+        sum(np.float32(affine[axis, i]) * ijk[i].astype(np.float32) for i in range(3)) + np.float32(affine[axis, 3])
+        for axis in range(3)
+    )
+
+
+def cortex_masks(shape, affine):
+    # cortical shell and (white matter) interior of both hemispheres
+    xyz_axes = volume_axes(shape, affine)
+    masks = {}
+    for hemi in hemispheres:
+        radius = ellipsoid_radius(xyz_axes, hemi)
+        masks[hemi] = ((radius <= 1) & (radius > white_radius), radius <= white_radius)
+    return masks
+
+
+def voronoi_labels(points, seeds, first_label=1):
+    # label every point by its nearest seed
+    return spatial.cKDTree(seeds).query(points, workers=-1)[1] + first_label
+
+
+def parcellate_volume(shape, affine, parcels, rng):
+    # label the cortical shell of both hemispheres with (about) the given number of parcels
+    atlas = np.zeros(shape, dtype=np.int32)
+    masks = cortex_masks(shape, affine)
+    first_label = 1
+    for (i, hemi) in enumerate(hemispheres):
+        ijk = np.argwhere(masks[hemi][0])
+        hemi_parcels = parcels // 2 + (parcels % 2) * (i == 0)
+        seeds = ijk[rng.choice(ijk.shape[0], hemi_parcels, replace=False)]
+        atlas[tuple(ijk.T)] = voronoi_labels(ijk, seeds, first_label)
+        first_label += hemi_parcels
+    return atlas
+
+
+def sphere_points(count):
+    # evenly spread points on the unit sphere (fibonacci lattice)
+    index = np.arange(count) + 0.5
+    polar = np.arccos(1 - 2 * index / count)
+    azimuth = np.pi * (1 + 5 ** 0.5) * index
+    return np.stack([np.cos(azimuth) * np.sin(polar), np.sin(azimuth) * np.sin(polar), np.cos(polar)], axis=1)
+
+
+def write_tck(output_file, starts, ends, rng):
+    # write streamlines as straight lines (with a variable number of points) between endpoints
+    header = 'mrtrix tracks\ncount: {}\ndatatype: Float32LE\nfile: . {:010d}\nEND\n'
+    offset = len(header.format(starts.shape[0], 0))
+    with open(ensure_dir(output_file), 'wb') as tck_file:
+        tck_file.write(header.format(starts.shape[0], offset).encode('utf8'))
+        for chunk in range(0, starts.shape[0], 10000):
+            chunk = slice(chunk, chunk + 10000)
+            lengths = rng.integers(20, 100, starts[chunk].shape[0])
+            fraction = np.concatenate([np.linspace(0, 1, x) for x in lengths])[:, None]
+            owner = np.repeat(np.arange(lengths.shape[0]), lengths)
+            points = starts[chunk][owner] * (1 - fraction) + ends[chunk][owner] * fraction
+            # insert a NaN delimiter after every streamline
+            delimited = np.full((points.shape[0] + lengths.shape[0], 3), np.nan, dtype=np.float32)
+            delimited[np.arange(points.shape[0]) + owner] = points
+            delimited.tofile(tck_file)
+        np.full((1, 3), np.inf, dtype=np.float32).tofile(tck_file)
+
+
+def generate(bench_dir, scale='small', parcels=(100, 400, 1000), streamlines=None, seed=0):
+    rng = np.random.default_rng(seed)
+    sizes = scales[scale]
+    streamlines = streamlines or sizes['streamlines']
+
+    # dMRI space atlases and streamline endpoints
+    print('{}: \033[0;32m[INFO]\033[0m Generating dMRI space atlases and {} endpoints.'.format(time_str(), streamlines))
+    dmri_affine = centered_affine(sizes['dmri_shape'], sizes['dmri_voxel'])
+    for parcel_count in parcels:
+        nib.save(
+            nib.Nifti1Image(parcellate_volume(sizes['dmri_shape'], dmri_affine, parcel_count, rng), dmri_affine),
+            ensure_dir('{}/dmri/atlas_{}.nii.gz'.format(bench_dir, parcel_count))
+        )
+
+    # endpoints close to the cortical shell (a tenth of them far from the cortex)
+    masks = cortex_masks(sizes['dmri_shape'], dmri_affine)
+    cortex_xyz = nib.affines.apply_affine(dmri_affine, np.argwhere(masks['lh'][0] | masks['rh'][0]))
+    endpoints = np.lib.format.open_memmap(ensure_dir('{}/dmri/endpoints.npy'.format(bench_dir)), mode='w+', dtype=np.float16, shape=(streamlines, 2, 3))
+    for chunk in range(0, streamlines, 2 ** 20):
+        chunk = slice(chunk, min(chunk + 2 ** 20, streamlines))
+        points = cortex_xyz[rng.integers(0, cortex_xyz.shape[0], (chunk.stop - chunk.start) * 2)]
+        points += rng.normal(0, sizes['dmri_voxel'] * 0.75, points.shape)
+        far = rng.random(points.shape[0]) < 0.1
+        points[far] *= 0.5
+        endpoints[chunk] = points.reshape(-1, 2, 3)
+    endpoints.flush()
+    np.save('{}/dmri/weights.npy'.format(bench_dir), rng.gamma(2., 0.5, streamlines).astype(np.float32))
+
+    tck_streamlines = min(sizes['tck_streamlines'], streamlines)
+    write_tck(
+        '{}/dmri/tracks.tck'.format(bench_dir),
+        endpoints[:tck_streamlines, 0].astype(np.float32), endpoints[:tck_streamlines, -1].astype(np.float32), rng
+    )
+    del endpoints
+
+    # fMRI space atlases, brain mask and 4D fMRI (written through a memory map to keep memory low)
+    print('{}: \033[0;32m[INFO]\033[0m Generating fMRI space atlases and a {} timepoint fMRI.'.format(time_str(), sizes['timepoints']))
+    fmri_affine = centered_affine(sizes['fmri_shape'], sizes['fmri_voxel'])
+    for parcel_count in parcels:
+        nib.save(
+            nib.Nifti1Image(parcellate_volume(sizes['fmri_shape'], fmri_affine, parcel_count, rng), fmri_affine),
+            ensure_dir('{}/fmri/atlas_{}.nii.gz'.format(bench_dir, parcel_count))
+        )
+    masks = cortex_masks(sizes['fmri_shape'], fmri_affine)
+    brain_mask = np.any([masks[hemi][0] | masks[hemi][1] for hemi in masks], axis=0)
+    nib.save(nib.Nifti1Image(brain_mask.astype(np.int16), fmri_affine), '{}/fmri/mask.nii.gz'.format(bench_dir))
+
+    fmri_shape = tuple(sizes['fmri_shape']) + (sizes['timepoints'],)
+    fmri_data = np.lib.format.open_memmap('{}/fmri/fmri_tmp.npy'.format(bench_dir), mode='w+', dtype=np.float32, shape=fmri_shape)
+    for x in range(fmri_shape[0]):
+        fmri_data[x] = rng.normal(0, 1, fmri_shape[1:]).astype(np.float32) * brain_mask[x, ..., None] + 100 * brain_mask[x, ..., None]
+    nib.save(nib.Nifti1Image(fmri_data, fmri_affine), '{}/fmri/fmri.nii.gz'.format(bench_dir))
+    del fmri_data
+    os.remove('{}/fmri/fmri_tmp.npy'.format(bench_dir))
+
+    # FreeSurfer-like surfaces, ribbon and annots
+    print('{}: \033[0;32m[INFO]\033[0m Generating surfaces ({} vertices per hemisphere), ribbon and annots.'.format(time_str(), sizes['vertices']))
+    sphere = sphere_points(sizes['vertices'])
+    faces = spatial.ConvexHull(sphere).simplices.astype(np.int32)
+    for hemi in hemispheres:
+        center, radii = hemispheres[hemi]
+        freesurfer.write_geometry(ensure_dir('{}/subject/FreeSurfer/surf/{}.pial'.format(bench_dir, hemi)), sphere * radii + center, faces)
+        freesurfer.write_geometry('{}/subject/FreeSurfer/surf/{}.white'.format(bench_dir, hemi), sphere * radii * white_radius + center, faces)
+        for parcel_count in parcels:
+            hemi_parcels = parcel_count // 2
+            labels = voronoi_labels(sphere, sphere[rng.choice(sphere.shape[0], hemi_parcels, replace=False)], 0)
+            ctab = np.hstack([rng.integers(0, 256, (hemi_parcels, 3)), np.zeros((hemi_parcels, 2), dtype=int)])
+            names = ['parcel_{}'.format(x) for x in range(hemi_parcels)]
+            freesurfer.write_annot(
+                ensure_dir('{}/subject/annot/{}.atlas_{}.annot'.format(bench_dir, hemi, parcel_count)),
+                labels.astype(np.int32), ctab, names, fill_ctab=True
+            )
+
+    ribbon_shape = sizes['ribbon_shape']
+    ribbon_affine = centered_affine(ribbon_shape, sizes['ribbon_voxel'])
+    ribbon_header = nib.MGHImage(np.zeros((1, 1, 1), dtype=np.uint8), ribbon_affine).header
+    ribbon_header.set_data_shape(ribbon_shape)
+    ribbon_header.set_zooms([sizes['ribbon_voxel']] * 3)
+    ribbon = np.zeros(ribbon_shape, dtype=np.uint8)
+    masks = cortex_masks(ribbon_shape, ribbon_header.get_vox2ras_tkr())
+    ribbon[masks['lh'][1]] = 2
+    ribbon[masks['lh'][0]] = 3
+    ribbon[masks['rh'][1]] = 41
+    ribbon[masks['rh'][0]] = 42
+    nib.save(nib.MGHImage(ribbon, ribbon_header.get_affine(), ribbon_header), ensure_dir('{}/subject/FreeSurfer/mri/ribbon.mgz'.format(bench_dir)))
+
+    # atlases on the conformed grid (for the tck2connectome assignment engines)
+    print('{}: \033[0;32m[INFO]\033[0m Generating conformed atlases.'.format(time_str()))
+    conformed_affine = centered_affine(sizes['conformed_shape'], sizes['conformed_voxel'])
+    for parcel_count in parcels:
+        nib.save(
+            nib.Nifti1Image(parcellate_volume(sizes['conformed_shape'], conformed_affine, parcel_count, rng), conformed_affine),
+            '{}/dmri/conformed_atlas_{}.nii.gz'.format(bench_dir, parcel_count)
+        )
+
+    with open('{}/benchmark.json'.format(bench_dir), 'w') as info_file:
+        json.dump({'scale': scale, 'parcels': list(parcels), 'streamlines': streamlines, 'tck_streamlines': tck_streamlines, 'sizes': sizes}, info_file, indent=1)
+
+    print('{}: \033[0;32m[INFO]\033[0m Synthetic data written to {}.'.format(time_str(), bench_dir))
+
+
+def measure(results, benchmark, items, unit, function, repeat=1, **parameters):
+    # run a benchmark (repeatedly) and keep the record of the fastest run
+    best = None
+    for _ in range(repeat):
+        with Stage(benchmark, **parameters) as stage:
+            output = function()
+        if best is None or stage.record['wall_seconds'] < best['wall_seconds']:
+            best = stage.record
+    best['items'] = items
+    best['unit'] = unit
+    best['throughput'] = items / max(best['wall_seconds'], 1e-9)
+    results.append(best)
+
+    print('{:<28} {:<40} {:>9.3f} s {:>12.4g} {}/s {:>9.1f} MB'.format(
+        benchmark, ', '.join('{}={}'.format(x, parameters[x]) for x in parameters), best['wall_seconds'],
+        best['throughput'], unit, best['peak_rss_bytes'] / 2 ** 20))
+
+    return output
+
+
+def check_engines(atlas_file, endpoints, search_radius=4, sample_size=2 ** 18):
+    # every assignment engine should assign the endpoints (of a sample of streamlines) to a labelled
+    # voxel at the same distance as the kdtree, and to the same label unless there is a tie (several
+    # labelled voxels at that distance, common with float16 endpoints on a regular grid)
+    atlas = nib.load(atlas_file)
+    atlas_data = np.asarray(atlas.dataobj).astype(int)
+    points = np.asarray(endpoints[:sample_size], dtype=np.float64).reshape(-1, 3)
+    reference = assignment_engines['kdtree'](atlas_data, atlas.affine)
+    dists, labels = reference.query(points, search_radius)
+    assigned = dists < search_radius
+
+    for engine in sorted(assignment_engines):
+        engine_dists, engine_labels = assignment_engines[engine](atlas_data, atlas.affine).query(points, search_radius)
+        different = np.flatnonzero(engine_labels != labels)
+        ties = reference.kdtree.query_ball_point(points[different], dists[different] * (1 + 1e-9) + 1e-9)
+        if (
+            not np.array_equal(engine_dists < search_radius, assigned)
+            or not np.allclose(engine_dists[assigned], dists[assigned])
+            or not all(label in reference.labels[x] for (label, x) in zip(engine_labels[different], ties))
+        ):
+            raise AssertionError('The {} and kdtree engines assign endpoints differently on {}.'.format(engine, atlas_file))
+
+
+def run(bench_dir, stages=('tck2connectome', 'endpoints', 'fmri', 'surface'), repeat=1):
+    with open('{}/benchmark.json'.format(bench_dir)) as info_file:
+        info = json.load(info_file)
+    parcels = info['parcels']
+    results = []
+
+    if 'tck2connectome' in stages:
+        endpoints = np.load('{}/dmri/endpoints.npy'.format(bench_dir), mmap_mode='r')
+        weights = ('sift2_fbc', np.load('{}/dmri/weights.npy'.format(bench_dir), mmap_mode='r'))
+        for (grid, atlas_file) in [('dmri', '{}/dmri/atlas_{}.nii.gz'), ('conformed', '{}/dmri/conformed_atlas_{}.nii.gz')]:
+            for parcel_count in parcels:
+                if not os.path.isfile(atlas_file.format(bench_dir, parcel_count)):
+                    continue
+                for engine in sorted(assignment_engines):
+                    measure(
+                        results, 'tck2connectome', endpoints.shape[0], 'streamlines',
+                        lambda: map_connectomes([atlas_file.format(bench_dir, parcel_count)], endpoints, 4, engine, weights),
+                        repeat, engine=engine, parcels=parcel_count, grid=grid,
+                    )
+                check_engines(atlas_file.format(bench_dir, parcel_count), endpoints)
+        for engine in sorted(assignment_engines):
+            measure(
+                results, 'tck2connectome_batch', endpoints.shape[0] * len(parcels), 'streamlines',
+                lambda: map_connectomes(['{}/dmri/atlas_{}.nii.gz'.format(bench_dir, x) for x in parcels], endpoints, 4, engine, weights),
+                repeat, engine=engine, parcels=','.join(str(x) for x in parcels),
+            )
+
+    if 'endpoints' in stages:
+        tck_file = '{}/dmri/tracks.tck'.format(bench_dir)
+        measure(
+            results, 'save_endpoints_as_npy', info['tck_streamlines'], 'streamlines',
+            lambda: sum(x.shape[0] for x in iterate_endpoints(tck_file, read_tck_header(tck_file))),
+            repeat,
+        )
+
+    if 'fmri' in stages:
+        fmri_data = measure(results, 'load_fmri', int(np.prod(info['sizes']['fmri_shape'])) * info['sizes']['timepoints'], 'values', lambda: load_fmri('{}/fmri/fmri.nii.gz'.format(bench_dir)), 1)
+        for parcel_count in parcels:
+            atlas_data = nib.load('{}/fmri/atlas_{}.nii.gz'.format(bench_dir, parcel_count)).get_fdata()
+            label_indices = np.arange(1, parcel_count + 1)
+            timeseries = measure(
+                results, 'parcel_mean_timeseries', int(np.count_nonzero(atlas_data)) * fmri_data.shape[-1], 'values',
+                lambda: parcel_mean_timeseries(fmri_data, atlas_data, label_indices),
+                repeat, parcels=parcel_count,
+            )
+            atlas_fmri = timeseries_dataframe(['parcel_{}'.format(x) for x in label_indices], timeseries)
+            for output_format in ['csv.gz', 'npz']:
+                output_file = ensure_dir('{}/output/fMRI.atlas_{}.{}'.format(bench_dir, parcel_count, output_format))
+                measure(
+                    results, 'save_timeseries', timeseries.size, 'values',
+                    lambda: save_timeseries(output_file, atlas_fmri),
+                    repeat, parcels=parcel_count, output_format=output_format,
+                )
+        del fmri_data
+
+    if 'surface' in stages:
+        vertex_map = measure(
+            results, 'ribbon_vertex_map', int(np.prod(info['sizes']['ribbon_shape'])), 'voxels',
+            lambda: compute_ribbon_vertex_map('{}/subject'.format(bench_dir)), repeat,
+        )
+        for parcel_count in parcels:
+            annot_labels = {
+                hemi: freesurfer.read_annot('{}/subject/annot/{}.atlas_{}.annot'.format(bench_dir, hemi, parcel_count))[0]
+                for hemi in hemispheres
+            }
+            measure(
+                results, 'label_volume', vertex_map['lh_voxels'].shape[0] + vertex_map['rh_voxels'].shape[0], 'voxels',
+                lambda: label_volume(vertex_map, annot_labels),
+                repeat, parcels=parcel_count,
+            )
+
+    return results
+
+
+def benchmark_key(record, fields=('stage', 'engine', 'parcels', 'grid', 'output_format')):
+    return tuple(record.get(x) for x in fields)
+
+
+def compare(results, baseline_file, tolerance=0.2):
+    # report stages that are slower than in the baseline run
+    with open(baseline_file) as baseline:
+        baseline = {benchmark_key(x): x for x in (json.loads(line) for line in baseline if line.strip())}
+
+    regressions = 0
+    for record in results:
+        reference = baseline.get(benchmark_key(record))
+        if reference is None:
+            continue
+        ratio = record['wall_seconds'] / max(reference['wall_seconds'], 1e-9)
+        if ratio > 1 + tolerance:
+            regressions += 1
+            print('{}: \033[0;31m[INFO]\033[0m Regression in {}: {:.3f} s (baseline {:.3f} s, {:.2f}x)'.format(
+                time_str(), ', '.join(str(x) for x in benchmark_key(record) if x is not None), record['wall_seconds'], reference['wall_seconds'], ratio))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the python hot paths on synthetic data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='generate synthetic data')
+    generate_parser.add_argument('bench_dir')
+    generate_parser.add_argument('--scale', choices=sorted(scales), default='small')
+    generate_parser.add_argument('--parcels', default='100,400,1000', help='comma separated list of parcel counts')
+    generate_parser.add_argument('--streamlines', type=int, default=None, help='number of streamline endpoints')
+    generate_parser.add_argument('--seed', type=int, default=0)
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('bench_dir')
+    run_parser.add_argument('--stages', default='tck2connectome,endpoints,fmri,surface', help='comma separated list of benchmarks')
+    run_parser.add_argument('--repeat', type=int, default=1, help='repetitions (the fastest is reported)')
+    run_parser.add_argument('--output', default=None, help='write the results as json lines')
+    run_parser.add_argument('--baseline', default=None, help='results of a previous run to compare against')
+    run_parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown reported as a regression')
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.bench_dir, args.scale, [int(x) for x in args.parcels.split(',')], args.streamlines, args.seed)
+    else:
+        results = run(args.bench_dir, args.stages.split(','), args.repeat)
+        if args.output is not None:
+            for record in results:
+                write_record(record, args.output)
+        if args.baseline is not None and compare(results, args.baseline, args.tolerance) > 0:
+            sys.exit(1)
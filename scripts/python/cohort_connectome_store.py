@@ -0,0 +1,250 @@
+# script to gather the connectomes of all subjects into a cohort store, allowing downstream analyses
+# to access any subject or edge of the whole cohort without decompressing the subject zip files
+#
+# Usage:
+#     cohort_connectome_store.py ingest <main_dir> --atlases <atlas_names> --metrics <metric_names>
+#                                [--streamlines 10M] [--workers N] [--chunk_size N] [--start i] [--end j]
+#     cohort_connectome_store.py info <store_dir>
+#
+# For every atlas (e.g. Schaefer7n400p+Tian_Subcortex_S3_3T) and metric (e.g. streamline_count),
+# the store is a directory (data/output/cohort/connectomes/<atlas>/<metric>_<streamlines>) with:
+#     header.npz:     atlas, metric, node count, and the (row, col) of the upper triangle edges
+#     index.csv:      subject, instance, and row of every ingested connectome
+#     chunk_*.npy:    float32 arrays of chunk_size rows (subjects) x upper triangle edges (incl.
+#                     the diagonal), rows that are not yet filled are nan
+#
+# Ingest reads the connectomes (csv, npy, or npz, see connectome_io.py) from the tractography zip
+# files of the instances listed in the combined bulk file, with one process per zip file, and only
+# appends instances that are not yet in the store (instances missing a connectome are retried the
+# next time). The chunks are memory-mapped, so reading from python is cheap, e.g.
+#     from cohort_connectome_store import ConnectomeStore
+#     store = ConnectomeStore('data/output/cohort/connectomes/Glasser+Tian_Subcortex_S1_3T/streamline_count_10M')
+#     adj = store.subject('1000000', '2_0')
+#     edge_values = store.edges([0, 1], [10, 20])
+
+import io
+import os
+import glob
+import zipfile
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import ensure_dir, time_str
+from connectome_io import load_connectome
+from zip_completion_index import normalize_name, read_subject_instances, zip_file_name
+
+
+default_chunk_size = 1024
+connectome_extensions = ['npz', 'npy', 'csv']
+
+
+def store_dir_name(main_dir, atlas_name, metric_name, streamlines):
+    return '{}/data/output/cohort/connectomes/{}/{}_{}'.format(main_dir, atlas_name, metric_name, streamlines)
+
+
+class ConnectomeStore:
+    # a cohort store of one atlas and metric (memory-mapped, new rows can be appended)
+
+    def __init__(self, store_dir, atlas_name=None, metric_name=None, node_count=None, chunk_size=default_chunk_size):
+        self.store_dir = store_dir
+        if os.path.isfile('{}/header.npz'.format(store_dir)):
+            with np.load('{}/header.npz'.format(store_dir)) as header:
+                self.atlas_name = str(header['atlas'])
+                self.metric_name = str(header['metric'])
+                self.node_count = int(header['node_count'])
+                self.chunk_size = int(header['chunk_size'])
+                self.edge_rows = header['row']
+                self.edge_cols = header['col']
+        elif node_count is not None:
+            # create a new (empty) store
+            self.atlas_name = atlas_name
+            self.metric_name = metric_name
+            self.node_count = node_count
+            self.chunk_size = chunk_size
+            self.edge_rows, self.edge_cols = np.triu_indices(node_count)
+            np.savez(
+                ensure_dir('{}/header.npz'.format(store_dir)),
+                atlas=np.array(atlas_name),
+                metric=np.array(metric_name),
+                node_count=np.array(node_count),
+                chunk_size=np.array(chunk_size),
+                row=self.edge_rows,
+                col=self.edge_cols,
+            )
+        else:
+            raise FileNotFoundError('No connectome store found in {}'.format(store_dir))
+
+        self.edge_count = self.edge_rows.shape[0]
+        self.index = pd.read_csv('{}/index.csv'.format(store_dir), dtype={'subject': str, 'instance': str}) \
+            if os.path.isfile('{}/index.csv'.format(store_dir)) else pd.DataFrame({'subject': [], 'instance': [], 'row': []})
+        self.index['row'] = self.index['row'].astype(int)
+        self.rows = {(x.subject, x.instance): x.row for x in self.index.itertuples()}
+        self.chunks = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def chunk(self, chunk_number, mode='r'):
+        # memory-mapped chunk (created, filled with nan, when opened for writing)
+        if (chunk_number, mode) not in self.chunks:
+            chunk_file = '{}/chunk_{:05d}.npy'.format(self.store_dir, chunk_number)
+            if not os.path.isfile(chunk_file):
+                if mode == 'r':
+                    raise FileNotFoundError(chunk_file)
+                chunk = np.lib.format.open_memmap(chunk_file, mode='w+', dtype=np.float32, shape=(self.chunk_size, self.edge_count))
+                chunk[:] = np.nan
+                chunk.flush()
+                del chunk
+            self.chunks[(chunk_number, mode)] = np.load(chunk_file, mmap_mode=mode)
+        return self.chunks[(chunk_number, mode)]
+
+    def append(self, ukb_subject_id, ukb_instance, adj):
+        # write a (dense) connectome to the next free row (or overwrite the row of the instance)
+        if adj.shape != (self.node_count, self.node_count):
+            raise ValueError('Connectome of {}_{} has {} nodes, but the {} store has {}.'.format(
+                ukb_subject_id, ukb_instance, adj.shape[0], self.atlas_name, self.node_count))
+        row = self.rows.setdefault((ukb_subject_id, ukb_instance), len(self.rows))
+        self.chunk(row // self.chunk_size, 'r+')[row % self.chunk_size] = adj[self.edge_rows, self.edge_cols]
+
+    def save(self):
+        # flush the chunks before the index, so that the index only lists stored rows
+        for (chunk_number, mode) in self.chunks:
+            if mode == 'r+':
+                self.chunks[(chunk_number, mode)].flush()
+        self.index = pd.DataFrame(
+            [(subject, instance, row) for ((subject, instance), row) in self.rows.items()],
+            columns=['subject', 'instance', 'row'],
+        )
+        self.index.to_csv('{}/index.csv.tmp'.format(self.store_dir), index=False)
+        os.replace('{}/index.csv.tmp'.format(self.store_dir), '{}/index.csv'.format(self.store_dir))
+
+    def subject(self, ukb_subject_id, ukb_instance):
+        # dense (symmetric) connectome of an instance
+        row = self.rows[(str(ukb_subject_id), str(ukb_instance))]
+        adj = np.zeros((self.node_count, self.node_count), dtype=np.float32)
+        adj[self.edge_rows, self.edge_cols] = self.chunk(row // self.chunk_size)[row % self.chunk_size]
+        adj[self.edge_cols, self.edge_rows] = adj[self.edge_rows, self.edge_cols]
+        return adj
+
+    def edge_indices(self, rows, cols):
+        # positions of edges (node pairs, in any order) in the upper triangle
+        rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+        return rows * self.node_count - rows * (rows - 1) // 2 + cols - rows
+
+    def edges(self, rows, cols):
+        # values of the given edges for all subjects (in the order of the index)
+        edge_indices = self.edge_indices(np.asarray(rows), np.asarray(cols))
+        values = np.empty((len(self.rows), edge_indices.shape[0]), dtype=np.float32)
+        all_rows = np.array(list(self.rows.values()), dtype=int)
+        for chunk_number in np.unique(all_rows // self.chunk_size):
+            selected = (all_rows // self.chunk_size) == chunk_number
+            values[selected] = self.chunk(chunk_number)[np.ix_(all_rows[selected] % self.chunk_size, edge_indices)]
+        return values
+
+
+def read_instance_connectomes(zip_path, connectome_names):
+    # read the connectomes of an instance from its tractography zip file
+    #
+    # connectome_names is a list of connectome file names without extension, the first available
+    # format is used, connectomes that can not be found are returned as None
+    connectomes = []
+    try:
+        with zipfile.ZipFile(zip_path) as zip_content:
+            names = {normalize_name(x): x for x in zip_content.namelist()}
+            for connectome_name in connectome_names:
+                adj = None
+                for extension in connectome_extensions:
+                    file_name = '{}.{}'.format(connectome_name, extension)
+                    if file_name in names:
+                        # the (small) file is read to memory, as npy and npz files need a seekable file
+                        adj = load_connectome(io.BytesIO(zip_content.read(names[file_name])), file_name)
+                        break
+                connectomes.append(adj)
+    except (zipfile.BadZipFile, OSError):
+        connectomes = [None] * len(connectome_names)
+    return connectomes
+
+
+def ingest(main_dir, atlas_names, metric_names, streamlines='10M', workers=8, chunk_size=default_chunk_size, start=1, end=None):
+    subject_instances = read_subject_instances(main_dir)
+    end = len(subject_instances) if end is None else min(end, len(subject_instances))
+    subject_instances = subject_instances[start - 1:end]
+
+    keys = [(atlas_name, metric_name) for atlas_name in atlas_names for metric_name in metric_names]
+    connectome_names = ['tractography/connectomes/{}/connectome_{}_{}'.format(atlas_name, metric_name, streamlines) for (atlas_name, metric_name) in keys]
+
+    # open the existing stores (new stores are created once the node count is known)
+    stores = {}
+    for (atlas_name, metric_name) in keys:
+        store_dir = store_dir_name(main_dir, atlas_name, metric_name, streamlines)
+        if os.path.isfile('{}/header.npz'.format(store_dir)):
+            stores[(atlas_name, metric_name)] = ConnectomeStore(store_dir)
+
+    # only read the instances missing from any of the stores
+    pending = [
+        (ukb_subject_id, ukb_instance) for (ukb_subject_id, ukb_instance) in subject_instances
+        if any(key not in stores or (ukb_subject_id, ukb_instance) not in stores[key].rows for key in keys)
+    ]
+    print('{}: \033[0;32m[INFO]\033[0m Reading the connectomes of {} instances.'.format(time_str(), len(pending)))
+
+    ingested = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        connectomes = executor.map(
+            read_instance_connectomes,
+            [zip_file_name(main_dir, ukb_subject_id, ukb_instance, 'tractography') for (ukb_subject_id, ukb_instance) in pending],
+            [connectome_names] * len(pending),
+            chunksize=8,
+        )
+        for ((ukb_subject_id, ukb_instance), instance_connectomes) in zip(pending, connectomes):
+            for ((atlas_name, metric_name), adj) in zip(keys, instance_connectomes):
+                if adj is None:
+                    continue
+                if (atlas_name, metric_name) not in stores:
+                    stores[(atlas_name, metric_name)] = ConnectomeStore(
+                        store_dir_name(main_dir, atlas_name, metric_name, streamlines), atlas_name, metric_name, adj.shape[0], chunk_size)
+                if (ukb_subject_id, ukb_instance) not in stores[(atlas_name, metric_name)].rows:
+                    stores[(atlas_name, metric_name)].append(ukb_subject_id, ukb_instance, adj)
+            ingested += 1
+
+            # save regularly, so that an interrupted ingest can continue from there
+            if ingested % chunk_size == 0:
+                for store in stores.values():
+                    store.save()
+                print('{}: \033[0;32m[INFO]\033[0m Read {} of {} instances.'.format(time_str(), ingested, len(pending)))
+
+    for (key, store) in stores.items():
+        store.save()
+        print('{}: \033[0;32m[INFO]\033[0m {} {}: {} connectomes stored.'.format(time_str(), key[0], key[1], len(store)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gather the connectomes of all subjects into a cohort store.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser('ingest', help='append the connectomes of new instances to the cohort stores')
+    ingest_parser.add_argument('main_dir')
+    ingest_parser.add_argument('--atlases', required=True, help='comma separated list of (combined) atlas names')
+    ingest_parser.add_argument('--metrics', default='streamline_count,sift2_fbc,mean_length,mean_FA', help='comma separated list of connectome metrics')
+    ingest_parser.add_argument('--streamlines', default='10M', help='number of streamlines in the connectome file names')
+    ingest_parser.add_argument('--workers', type=int, default=8, help='number of zip files read in parallel')
+    ingest_parser.add_argument('--chunk_size', type=int, default=default_chunk_size, help='number of subjects per chunk (for new stores)')
+    ingest_parser.add_argument('--start', type=int, default=1, help='first instance index (inclusive)')
+    ingest_parser.add_argument('--end', type=int, default=None, help='last instance index (inclusive)')
+
+    info_parser = subparsers.add_parser('info', help='print a summary of cohort stores')
+    info_parser.add_argument('store_dirs', nargs='+')
+
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        ingest(
+            args.main_dir, args.atlases.split(','), args.metrics.split(','), args.streamlines,
+            args.workers, args.chunk_size, args.start, args.end,
+        )
+    else:
+        for store_dir in args.store_dirs:
+            store = ConnectomeStore(store_dir)
+            print('{}: {} {}, {} nodes, {} edges, {} connectomes in {} chunks'.format(
+                store_dir, store.atlas_name, store.metric_name, store.node_count, store.edge_count,
+                len(store), len(glob.glob('{}/chunk_*.npy'.format(store_dir)))))
@@ -1,14 +1,20 @@
 # script made from the notebook codes
+#
+# Usage:
+#     combine_volumetric_atlases.py <main_dir> <ukb_subjects_dir> <subject_id> <instance> <atlas_1_names> <atlas_2_names> [combinations]
+#
+# atlas_1_names (cortical) and atlas_2_names (subcortical) can be comma separated lists, in which case
+# every combination (or only the given comma separated list of <atlas_1>+<atlas_2> combinations) is
+# written in a single run, loading each atlas only once. Labels are kept as integers, and the combined
+# atlases are stored with the smallest unsigned integer type that fits all labels.
 
 import os
 import sys
 import time
 import datetime
 import numpy as np
-import pandas as pd
 import nibabel as nib
-from scipy import spatial
-from nibabel import freesurfer
+from atlas_labels import load_atlas_labels
 
 
 def ensure_dir(file_name):
@@ -25,61 +31,116 @@ def time_str(mode='abs', base=None):
         return time.asctime(time.localtime(time.time()))
 
 
-if __name__ == '__main__':
-    # sys.argv
-    main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, atlas_1_name, atlas_2_name = sys.argv[1:]
+def label_dtype(max_label):
+    # smallest unsigned integer type to store the labels
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if max_label <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
 
-    template_dir = "{}/data/templates".format(main_dir)
-    temporary_dir = "{}/data/temporary".format(main_dir)
-    output_dir = "{}/data/output".format(main_dir)
 
+def load_atlas(atlas_file):
+    # load an atlas image (in closest canonical orientation) along with its integer labels
+    atlas_image = nib.as_closest_canonical(nib.load(atlas_file))
+    atlas_data = np.asanyarray(atlas_image.dataobj)
+    if not np.issubdtype(atlas_data.dtype, np.integer):
+        atlas_data = np.rint(atlas_data)
+    return atlas_image, atlas_data.astype(np.uint32)
+
+
+def combine_atlas_data(atlas_1, atlas_2, shift_value, output_file):
+    # combine two loaded atlases (image, labels) and store the combined atlas
+    atlas_1_image, atlas_1_data = atlas_1
+    atlas_2_image, atlas_2_data = atlas_2
+
+    # mask and shift atlas_2 labels
+    shift_value = int(shift_value)
+    combined_atlas_data = np.where(
+        (atlas_1_data == 0) & (atlas_2_data > 0),
+        atlas_2_data + np.uint32(shift_value),
+        atlas_1_data,
+    )
+    combined_atlas_data = combined_atlas_data.astype(label_dtype(combined_atlas_data.max()))
+
+    # store combined atlas
+    combined_atlas_image = nib.Nifti1Image(combined_atlas_data, atlas_1_image.affine, atlas_1_image.header)
+    combined_atlas_image.set_data_dtype(combined_atlas_data.dtype)
+    combined_atlas_image.header.set_slope_inter(1, 0)
+    nib.save(combined_atlas_image, ensure_dir(output_file))
+
+    return output_file
+
+
+def combine_atlases(atlas_1, atlas_2, shift_value, output_file):
     # combine two atlases and generate a new label table
     # this is mainly used to add a subcortical atlas (atlas_2) to a cortical volumetric brain label (atlas_1)
     #
     # in case a voxel has non-zero labels in both atlases, atlas_1 label will be used.
+    return combine_atlas_data(load_atlas(atlas_1), load_atlas(atlas_2), shift_value, output_file)
 
-    # load cortical label indices
-    cortical_labels = pd.DataFrame(
-        np.genfromtxt(
-            '{}/atlases/labels/{}.ColorLUT.txt'.format(template_dir, atlas_1_name),
-            dtype='str'
-        ),
-        columns=['index', 'label_name', 'R', 'G', 'B', 'A'],
-    ).astype(
-        dtype={
-            "index": "int",
-            "label_name": "str",
-            "R": "int",
-            "G": "int",
-            "B": "int",
-            "A": "int",
-        }
-    )
 
-    # load native atlases
-    atlas_1 = f'{temporary_dir}/subjects/{ukb_subject_id}_{ukb_instance}/tractography/atlases/native.dMRI_space.{atlas_1_name}.nii.gz'
-    atlas_2 = f'{temporary_dir}/subjects/{ukb_subject_id}_{ukb_instance}/tractography/atlases/native.dMRI_space.{atlas_2_name}.nii.gz'
-    atlas_1_image = nib.as_closest_canonical(nib.load(atlas_1))
-    atlas_2_image = nib.as_closest_canonical(nib.load(atlas_2))
+def combine_all_subject_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, combinations):
+    # combine a list of (cortical, subcortical) dMRI space atlas pairs of a subject, loading every
+    # atlas only once (existing combinations are skipped)
+    #
+    # returns the list of combined atlas files
+    template_dir = "{}/data/templates".format(main_dir)
+    temporary_dir = "{}/data/temporary".format(main_dir)
+    atlas_file = '{}/subjects/{}_{}/tractography/atlases/native.dMRI_space.{{}}.nii.gz'.format(temporary_dir, ukb_subject_id, ukb_instance)
+    combined_atlas_file = '{}/{}_{}/dMRI/dMRI/atlases/combinations/native.dMRI_space.{{}}+{{}}.nii.gz'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance)
 
-    # load atlas data
-    atlas_1_data = atlas_1_image.get_fdata()
-    atlas_2_data = atlas_2_image.get_fdata()
+    atlases = {}
+    shift_values = {}
+    combined_atlas_files = []
+    for (atlas_1_name, atlas_2_name) in combinations:
+        combined_atlas_files.append(combined_atlas_file.format(atlas_1_name, atlas_2_name))
+        if os.path.isfile(combined_atlas_files[-1]):
+            continue
 
-    # mask and shift atlas_2 labels
-    data_mask = (atlas_1_data == 0)
-    shift_mask = (atlas_2_data > 0)
-    shift_value = cortical_labels['index'].max()
-    atlas_2_data_masked_shifted = np.multiply((shift_mask & data_mask), (atlas_2_data + shift_value))
+        print('{}: \033[0;32m[INFO]\033[0m Combining {} and {}.'.format(time_str(), atlas_1_name, atlas_2_name))
+        for atlas_name in [atlas_1_name, atlas_2_name]:
+            if atlas_name not in atlases:
+                atlases[atlas_name] = load_atlas(atlas_file.format(atlas_name))
 
-    combined_atlas_data = atlas_1_data + atlas_2_data_masked_shifted
+        # subcortical labels are shifted after the last cortical label
+        # (Note: colorLUTs of the combined atlases are generated in ipython notebook)
+        if atlas_1_name not in shift_values:
+            shift_values[atlas_1_name] = load_atlas_labels(template_dir, atlas_1_name)['index'].max()
 
-    # store combined atlas
-    combined_atlas_image = nib.Nifti1Image(combined_atlas_data, atlas_1_image.affine, atlas_1_image.header)
-    combined_atlas_image.header.set_slope_inter(1, 0)
-    nib.save(
-        combined_atlas_image,
-        ensure_dir(f'{ukb_subjects_dir}/{ukb_subject_id}_{ukb_instance}/dMRI/dMRI/atlases/combinations/native.dMRI_space.{atlas_1_name}+{atlas_2_name}.nii.gz')
+        combine_atlas_data(atlases[atlas_1_name], atlases[atlas_2_name], shift_values[atlas_1_name], combined_atlas_files[-1])
+
+    return combined_atlas_files
+
+
+def combine_subject_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, atlas_1_name, atlas_2_name):
+    # combine the dMRI space cortical (atlas_1) and subcortical (atlas_2) atlases of a subject
+    template_dir = "{}/data/templates".format(main_dir)
+    temporary_dir = "{}/data/temporary".format(main_dir)
+
+    # subcortical labels are shifted after the last cortical label
+    # (Note: colorLUTs of the combined atlases are generated in ipython notebook)
+    cortical_labels = load_atlas_labels(template_dir, atlas_1_name)
+
+    return combine_atlases(
+        f'{temporary_dir}/subjects/{ukb_subject_id}_{ukb_instance}/tractography/atlases/native.dMRI_space.{atlas_1_name}.nii.gz',
+        f'{temporary_dir}/subjects/{ukb_subject_id}_{ukb_instance}/tractography/atlases/native.dMRI_space.{atlas_2_name}.nii.gz',
+        cortical_labels['index'].max(),
+        f'{ukb_subjects_dir}/{ukb_subject_id}_{ukb_instance}/dMRI/dMRI/atlases/combinations/native.dMRI_space.{atlas_1_name}+{atlas_2_name}.nii.gz',
     )
 
-    # generate new colorLUTs (Note: colorLUTs generated in ipython notebook)
+
+if __name__ == '__main__':
+    # sys.argv
+    main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, atlas_1_names, atlas_2_names = sys.argv[1:7]
+
+    # optional list of selected combinations (all combinations by default)
+    selected_combinations = sys.argv[7].split(',') if len(sys.argv) > 7 else None
+
+    combinations = [
+        (atlas_1_name, atlas_2_name)
+        for atlas_1_name in atlas_1_names.split(',') if atlas_1_name
+        for atlas_2_name in atlas_2_names.split(',') if atlas_2_name
+        if selected_combinations is None or '{}+{}'.format(atlas_1_name, atlas_2_name) in selected_combinations
+    ]
+
+    combine_all_subject_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, combinations)
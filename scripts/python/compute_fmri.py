@@ -0,0 +1,79 @@
+# script to compute the fMRI time-series of several cortical and subcortical atlases along with the
+# global signal, decompressing the ica clean fMRI only once
+#
+# Usage:
+#     compute_fmri.py <main_dir> <ukb_subjects_dir> <subject_id> <instance> <cortical_atlases> <subcortical_atlases> [csv|npz]
+#
+# Atlases are given as comma separated lists of atlas names (either list may be empty). Outputs
+# are written exactly as compute_cortical_fmri.py, compute_subcortical_fmri.py and
+# compute_global_fmri.py would (gzipped csv by default, or binary npz), and outputs that
+# already exist are skipped.
+
+import os
+import sys
+from instrumentation import Stage, ensure_dir, time_str
+from parcel_timeseries import output_extensions, save_timeseries, load_fmri, load_cortical_labels, load_subcortical_labels, atlas_timeseries, global_signal_timeseries
+
+
+def compute_subject_fmri(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, cortical_atlases, subcortical_atlases, output_format='csv', clean_fmri=None):
+    # compute the fMRI time-series of lists of cortical and subcortical atlases along with the global
+    # signal (the ica clean fMRI is loaded unless given)
+    #
+    # returns the names of the computed time-series
+    template_dir = "{}/data/templates".format(main_dir)
+    temporary_dir = "{}/data/temporary".format(main_dir)
+
+    # list of all time-series to compute: (output name, label loader, atlas name)
+    extractions = (
+        [(x, load_cortical_labels, x) for x in cortical_atlases] +
+        [(x, load_subcortical_labels, x) for x in subcortical_atlases] +
+        [('global_signal', None, None)]
+    )
+
+    # skip time-series that were already computed
+    fmri_file = '{}/subjects/{}_{}/fMRI/fMRI.{{}}.{}'.format(temporary_dir, ukb_subject_id, ukb_instance, output_extensions[output_format])
+    extractions = [x for x in extractions if not os.path.isfile(fmri_file.format(x[0]))]
+    if len(extractions) == 0:
+        print('{}: \033[0;32m[INFO]\033[0m All fMRI time-series are already computed.'.format(time_str()))
+        return []
+
+    # load the ica clean fMRI (only once for all atlases, unless it is already loaded)
+    if clean_fmri is None:
+        with Stage('load_fmri', subject=ukb_subject_id, instance=ukb_instance):
+            clean_fmri = load_fmri('{}/{}_{}/fMRI/rfMRI.ica/filtered_func_data_clean.nii.gz'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance))
+
+    for (output_name, load_labels, atlas_name) in extractions:
+        print('{}: \033[0;32m[INFO]\033[0m Mapping fMRI on {}.'.format(time_str(), output_name))
+
+        with Stage('compute_fmri', subject=ukb_subject_id, instance=ukb_instance, atlas=output_name, output_format=output_format):
+            if load_labels is None:
+                # compute the global signal over the brain mask
+                atlas_fmri = global_signal_timeseries(
+                    clean_fmri,
+                    '{}/{}_{}/fMRI/rfMRI.ica/mask.nii.gz'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance),
+                )
+            else:
+                # average fmri signal over every label from the volumetric atlas
+                atlas_fmri = atlas_timeseries(
+                    clean_fmri,
+                    '{}/subjects/{}_{}/atlases/native.fMRI_space.{}.nii.gz'.format(temporary_dir, ukb_subject_id, ukb_instance, atlas_name),
+                    load_labels(template_dir, atlas_name),
+                )
+
+            # write out the resulting time-series (csv or npz)
+            save_timeseries(ensure_dir(fmri_file.format(output_name)), atlas_fmri)
+
+    return [x[0] for x in extractions]
+
+
+if __name__ == '__main__':
+    # sys.argv
+    main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, cortical_atlases, subcortical_atlases = sys.argv[1:7]
+
+    # optional output format (csv or npz)
+    output_format = sys.argv[7] if len(sys.argv) > 7 else 'csv'
+
+    compute_subject_fmri(
+        main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance,
+        [x for x in cortical_atlases.split(',') if x], [x for x in subcortical_atlases.split(',') if x], output_format
+    )
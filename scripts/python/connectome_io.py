@@ -0,0 +1,73 @@
+# helper functions to store and load connectomes
+#
+# Besides dense csv files (and npy files from save_csv_as_npy.py), connectomes can be stored in
+# a compact binary npz format: as connectomes are symmetric, only the non-zero edges of the
+# upper triangle (including the diagonal) are stored as sparse (row, col, data) arrays, along
+# with a small header recording the atlas, the metric, and the number of nodes.
+#
+# Usage (reading from python):
+#     from connectome_io import load_connectome
+#     adj = load_connectome('connectome_streamline_count_10M.npz')
+
+import os
+import numpy as np
+
+
+def atlas_name(atlas_file):
+    # name of an atlas from its file name (e.g. native.dMRI_space.Glasser+Tian_Subcortex_S1_3T)
+    return os.path.basename(atlas_file).split('.nii')[0]
+
+
+def save_connectome(output_file, adj, atlas='', metric='streamline_count'):
+    # streamline counts are stored as integers
+    if metric == 'streamline_count':
+        adj = np.rint(adj).astype(np.int32)
+    else:
+        adj = adj.astype(np.float32)
+
+    if output_file.endswith('.npz'):
+        # sparse upper triangle
+        node_count = adj.shape[0]
+        row, col = np.nonzero(np.triu(adj))
+        index_dtype = np.uint16 if node_count <= np.iinfo(np.uint16).max else np.uint32
+        np.savez(
+            output_file,
+            atlas=np.array(atlas),
+            metric=np.array(metric),
+            node_count=np.array(node_count),
+            row=row.astype(index_dtype),
+            col=col.astype(index_dtype),
+            data=adj[row, col],
+        )
+    elif metric == 'streamline_count':
+        np.savetxt(output_file, adj, delimiter=',', fmt="%d")
+    else:
+        np.savetxt(output_file, adj, delimiter=',', fmt="%.8g")
+
+
+def load_connectome_header(input_file):
+    # atlas, metric and number of nodes of a connectome stored in the npz format
+    with np.load(input_file) as content:
+        return {
+            'atlas': str(content['atlas']),
+            'metric': str(content['metric']),
+            'node_count': int(content['node_count']),
+        }
+
+
+def load_connectome(input_file, file_name=None):
+    # load a connectome as a dense (symmetric) matrix from any of the supported formats
+    #
+    # input_file can also be an open (binary) file object, e.g. a file within a zip archive, in
+    # which case the format is deduced from file_name
+    file_name = input_file if file_name is None else file_name
+    if file_name.endswith('.npz'):
+        with np.load(input_file) as content:
+            node_count = int(content['node_count'])
+            adj = np.zeros((node_count, node_count), dtype=content['data'].dtype)
+            adj[content['row'], content['col']] = content['data']
+            adj[content['col'], content['row']] = content['data']
+        return adj
+    if file_name.endswith('.npy'):
+        return np.load(input_file)
+    return np.loadtxt(input_file, dtype=np.float32, delimiter=',')
@@ -1,11 +1,24 @@
 # script to convert label GIFTI files to annot format (to fix the bug encountered with mris_convert)
+#
+# Usage:
+#     convert_labels_gii_to_annot.py <gifti_in> <annot_out>
+#
+# Both arguments can also be comma separated lists (e.g. both hemispheres) to convert several files
+# in a single run.
+#
+# Colour tables are derived from the label names (see label_ctab in atlas_labels.py), and converted
+# annot files are cached by the hash of their inputs (see derived_cache.py).
 
 import sys
 import time
 import datetime
-import numpy as np
 import nibabel as nib
 from nibabel import freesurfer
+from atlas_labels import label_ctab
+from derived_cache import cached
+
+
+conversion_name = 'convert_labels_gii_to_annot'
 
 
 def time_str(mode='abs', base=None):
@@ -17,22 +30,18 @@ def time_str(mode='abs', base=None):
         return time.asctime(time.localtime(time.time()))
 
 
-if __name__ == '__main__':
-    # sys.argv
-    gifti_in, annot_out = sys.argv[1:]
-
+def convert_gifti(gifti_in, annot_out):
     # read the gifti labels
     gifti = nib.load(gifti_in)
 
     # construct the complete label set
-    labels = [gifti.labeltable.get_labels_as_dict()[x] for x in range(len(gifti.labeltable.labels))]
+    label_dict = gifti.labeltable.get_labels_as_dict()
+    labels = [label_dict[x] for x in range(len(gifti.labeltable.labels))]
 
-    # construct ctab
-    colors = np.random.default_rng().choice(2**24, len(gifti.labeltable.labels), replace=False)
-    ctab = np.c_[(colors // 256**2), ((colors // 256) % 256), (colors % 256), np.zeros(len(gifti.labeltable.labels))]
-    ctab[0, :] = [1, 1, 1, 1]
+    # construct ctab (deterministic colours)
+    ctab = label_ctab(labels)
 
-    # write our the annot file (random color ctab)
+    # write our the annot file
     freesurfer.write_annot(
         annot_out,
         gifti.darrays[0].data,
@@ -41,6 +50,16 @@ if __name__ == '__main__':
         fill_ctab=True
     )
 
-    print('{}: \033[0;32m[INFO]\033[0m The gifti file "{}" successfully converted to annot file "{}".'.format(
-        time_str(), gifti_in, annot_out)
-    )
+
+if __name__ == '__main__':
+    # sys.argv (comma separated lists to convert several files)
+    gifti_files, annot_files = [x.split(',') for x in sys.argv[1:3]]
+    if len(gifti_files) != len(annot_files):
+        sys.exit('Expected one annot file per gifti file.')
+
+    for (gifti_in, annot_out) in zip(gifti_files, annot_files):
+        cached('{}/2'.format(conversion_name), [gifti_in], [annot_out], {}, convert_gifti, gifti_in, annot_out)
+
+        print('{}: \033[0;32m[INFO]\033[0m The gifti file "{}" successfully converted to annot file "{}".'.format(
+            time_str(), gifti_in, annot_out)
+        )
@@ -1,10 +1,21 @@
-# script to convert Shaefer parcelation annot formats to our desired format
+# script to convert native (FreeSurfer) parcelation annot formats to our desired format
+#
+# Usage:
+#     convert_native_annot.py <annot_in_l> <annot_in_r> <annot_out_l> <annot_out_r>
+#
+# Every argument can also be a comma separated list (one entry per atlas) to convert several atlases
+# in a single run.
+#
+# Colour tables are derived from the label names (see label_ctab in atlas_labels.py). Converted native
+# annot files are not cached (see derived_cache.py), as they are specific to every subject and
+# archived with the subject's atlases.
 
 import sys
 import time
 import datetime
 import numpy as np
 from nibabel import freesurfer
+from atlas_labels import label_ctab
 
 
 def time_str(mode='abs', base=None):
@@ -16,62 +27,59 @@ def time_str(mode='abs', base=None):
         return time.asctime(time.localtime(time.time()))
 
 
-if __name__ == '__main__':
-    # sys.argv
-    annot_in_l, annot_in_r, annot_out_l, annot_out_r = sys.argv[1:]
+def relabel_hemisphere(vertex_labels, label_names, present_labels, first_label=1):
+    # number the labels that are in present_labels (in the order of the colour table, starting from
+    # first_label), unknown vertices (-1) are labelled 0
+    #
+    # returns the new vertex labels and the names of the remaining labels
+    present = np.zeros(len(label_names) + 1, dtype=bool)
+    present_labels = present_labels[(present_labels > 0) & (present_labels < len(label_names))]
+    present[present_labels] = True
+    kept = np.flatnonzero(present)
+
+    # lookup table of the new labels (the last entry is used for -1)
+    lookup = np.zeros(len(label_names) + 1, dtype=np.int32)
+    lookup[kept] = np.arange(first_label, first_label + kept.shape[0])
+
+    return lookup[vertex_labels], [label_names[x] for x in kept]
 
-    # read the gifti labels
+
+def convert_annot(annot_in_l, annot_in_r, annot_out_l, annot_out_r):
+    # read the annot labels
     in_l = freesurfer.read_annot(annot_in_l)
     in_r = freesurfer.read_annot(annot_in_r)
 
-    # construct the complete label set
-    left_labels = [x.decode() for x in in_l[2]]
-    right_labels = [x.decode() for x in in_r[2]]
+    # labels are removed from both hemispheres if they have no vertices on the left hemisphere (so
+    # that label ids match the fixed colour lookup tables, e.g. aparc.ColorLUT.txt), right hemisphere
+    # labels follow the left hemisphere labels
+    left_present = np.unique(in_l[0])
+    right_missing = np.setdiff1d(np.unique(in_r[0][in_r[0] > 0]), left_present)
+    if right_missing.shape[0] > 0:
+        raise ValueError('Labels {} of "{}" have no vertices on the left hemisphere ("{}").'.format(
+            ','.join(in_r[2][x].decode() for x in right_missing), annot_in_r, annot_in_l))
+
+    left_vertex_labels, left_labels_clean = relabel_hemisphere(in_l[0], [x.decode() for x in in_l[2]], left_present)
+    right_vertex_labels, right_labels_clean = relabel_hemisphere(in_r[0], [x.decode() for x in in_r[2]], left_present, len(left_labels_clean) + 1)
 
-    # replace lables
-    left_labels_dict = {x:i+1 for (i,x) in enumerate(left_labels[1:])}
-    left_labels_dict.update({'???':-1})
-    left_removes = [x for x in left_labels_dict.values() if x not in np.unique(in_l[0])]
+    labels = ['???'] + ['left_{}'.format(x) for x in left_labels_clean] + ['right_{}'.format(x) for x in right_labels_clean]
 
-    left_labels_clean = [x for x in left_labels[1:] if left_labels_dict[x] not in left_removes]
-    left_label_replace = {left_labels_dict[x]:i+1 for (i,x) in enumerate(left_labels_clean)}
-    left_label_replace.update({-1:0})
+    # construct the complete ctab (deterministic colours)
+    ctab = label_ctab(labels)
 
-    right_labels_dict = {x:i+1 for (i,x) in enumerate(right_labels[1:])}
-    right_labels_dict.update({'???':-1})
-    right_removes = [x for x in right_labels_dict.values() if x not in np.unique(in_l[0])]
+    # write out the modified annot files
+    freesurfer.write_annot(annot_out_l, left_vertex_labels, ctab, labels, fill_ctab=True)
+    freesurfer.write_annot(annot_out_r, right_vertex_labels, ctab, labels, fill_ctab=True)
 
-    right_labels_clean = [x for x in right_labels[1:] if right_labels_dict[x] not in right_removes]
-    right_label_replace = {right_labels_dict[x]:i+1+len(left_labels_clean) for (i,x) in enumerate(right_labels_clean)}
-    right_label_replace.update({-1:0})
 
-    labels = ['???'] + ['left_{}'.format(x) for x in left_labels_clean] + ['right_{}'.format(x) for x in right_labels_clean]
+if __name__ == '__main__':
+    # sys.argv (comma separated lists to convert several atlases)
+    annot_files = [x.split(',') for x in sys.argv[1:5]]
+    if len(set(len(x) for x in annot_files)) != 1:
+        sys.exit('Expected the same number of input and output annot files for both hemispheres.')
 
-    # construct the complete ctab
-    # ctab = np.concatenate([np.array([[1, 1, 1, 1, 65793]]), in_l[1][1:], in_r[1][1:]])
-    # ctab = np.c_[np.random.choice(256, (len(labels), 3)), np.zeros(len(labels))]
-    colors = np.random.default_rng().choice(2**24, len(labels), replace=False)
-    ctab = np.c_[(colors // 256**2), ((colors // 256) % 256), (colors % 256), np.zeros(len(labels))]
-    ctab[0, :] = [1, 1, 1, 1]
-
-    # writ out the modified annot files (shif right hemisphere label values)
-
-    # write out the left hemisphere's annot file
-    freesurfer.write_annot(
-        annot_out_l,
-        [left_label_replace[x] for x in in_l[0]],
-        ctab,
-        labels,
-        fill_ctab=True
-    )
-    freesurfer.write_annot(
-        annot_out_r,
-        [right_label_replace[x] for x in in_r[0]],
-        ctab,
-        labels,
-        fill_ctab=True
-    )
+    for (annot_in_l, annot_in_r, annot_out_l, annot_out_r) in zip(*annot_files):
+        convert_annot(annot_in_l, annot_in_r, annot_out_l, annot_out_r)
 
-    print('{}: \033[0;32m[INFO]\033[0m Successfully converted the annot files.'.format(
-        time_str())
+    print('{}: \033[0;32m[INFO]\033[0m Successfully converted {} pairs of annot files.'.format(
+        time_str(), len(annot_files[0]))
     )
@@ -1,10 +1,24 @@
 # script to convert Shaefer parcelation annot formats to our desired format
+#
+# Usage:
+#     convert_schaefer_annot.py <annot_in_l> <annot_in_r> <annot_out_l> <annot_out_r>
+#
+# Every argument can also be a comma separated list (one entry per atlas) to convert several atlases
+# (e.g. all Schaefer variants) in a single run.
+#
+# Colour tables are derived from the label names (see label_ctab in atlas_labels.py), and converted
+# annot files are cached by the hash of their inputs (see derived_cache.py).
 
 import sys
 import time
 import datetime
 import numpy as np
 from nibabel import freesurfer
+from atlas_labels import label_ctab
+from derived_cache import cached
+
+
+conversion_name = 'convert_schaefer_annot'
 
 
 def time_str(mode='abs', base=None):
@@ -16,23 +30,16 @@ def time_str(mode='abs', base=None):
         return time.asctime(time.localtime(time.time()))
 
 
-if __name__ == '__main__':
-    # sys.argv
-    annot_in_l, annot_in_r, annot_out_l, annot_out_r = sys.argv[1:]
-
-    # read the gifti labels
+def convert_annot(annot_in_l, annot_in_r, annot_out_l, annot_out_r):
+    # read the annot labels
     in_l = freesurfer.read_annot(annot_in_l)
     in_r = freesurfer.read_annot(annot_in_r)
 
     # construct the complete label set
     labels = ['???'] + in_l[2][1:] + in_r[2][1:]
 
-    # construct the complete ctab
-    # ctab = np.concatenate([np.array([[1, 1, 1, 1, 65793]]), in_l[1][1:], in_r[1][1:]])
-    # ctab = np.c_[np.random.choice(256, (len(labels), 3)), np.zeros(len(labels))]
-    colors = np.random.default_rng().choice(2**24, len(labels), replace=False)
-    ctab = np.c_[(colors // 256**2), ((colors // 256) % 256), (colors % 256), np.zeros(len(labels))]
-    ctab[0, :] = [1, 1, 1, 1]
+    # construct the complete ctab (deterministic colours)
+    ctab = label_ctab(labels)
 
     # writ out the modified annot files (shif right hemisphere label values)
 
@@ -57,6 +64,19 @@ if __name__ == '__main__':
         fill_ctab=True
     )
 
-    print('{}: \033[0;32m[INFO]\033[0m Successfully converted the annot files.'.format(
-        time_str())
+
+if __name__ == '__main__':
+    # sys.argv (comma separated lists to convert several atlases)
+    annot_files = [x.split(',') for x in sys.argv[1:5]]
+    if len(set(len(x) for x in annot_files)) != 1:
+        sys.exit('Expected the same number of input and output annot files for both hemispheres.')
+
+    for (annot_in_l, annot_in_r, annot_out_l, annot_out_r) in zip(*annot_files):
+        cached(
+            '{}/2'.format(conversion_name), [annot_in_l, annot_in_r], [annot_out_l, annot_out_r], {},
+            convert_annot, annot_in_l, annot_in_r, annot_out_l, annot_out_r,
+        )
+
+    print('{}: \033[0;32m[INFO]\033[0m Successfully converted {} pairs of annot files.'.format(
+        time_str(), len(annot_files[0]))
     )
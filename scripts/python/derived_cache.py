@@ -0,0 +1,102 @@
+# helper functions for a content-addressed cache of derived files (e.g. converted annot files)
+#
+# A derived file is fully determined by the content of its input files, the parameters of the
+# computation, and the version of the code deriving it. The cache key is the hash of all three, and
+# the outputs are stored in the cache directory under that key:
+#     <cache_dir>/<key[:2]>/<key>/<output number>.<output file name>
+# so that outputs that are removed are copied back from the cache instead of being computed again,
+# as long as their inputs are unchanged. Entries are never evicted, so only derived files shared by
+# all subjects (e.g. the template atlases converted by convert_schaefer_annot.py and
+# convert_labels_gii_to_annot.py) should be cached, not per subject outputs.
+# Changing the version of a computation invalidates all of its cached outputs.
+#
+# The cache directory is given by the UKB_DERIVED_CACHE_DIR environment variable (nothing is cached if
+# it is not set), which is exported by UKB_connectivity_mapping_pipeline.sh.
+#
+# Usage (reading from python):
+#     from derived_cache import cached
+#     cached('convert_schaefer_annot/2', [annot_in_l, annot_in_r], [annot_out_l, annot_out_r], {}, convert_annot)
+
+import os
+import json
+import shutil
+import hashlib
+
+
+def cache_dir():
+    return os.environ.get('UKB_DERIVED_CACHE_DIR') or None
+
+
+def file_hash(file_name, block_size=2 ** 20):
+    content_hash = hashlib.sha1()
+    with open(file_name, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_size), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def cache_key(version, input_files, parameters=None):
+    # hash of the computation (version and parameters) and the content of its inputs
+    key = {
+        'version': version,
+        'inputs': [file_hash(x) for x in input_files],
+        'parameters': parameters or {},
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def entry_files(entry_dir, output_files):
+    return ['{}/{}.{}'.format(entry_dir, i, os.path.basename(x)) for (i, x) in enumerate(output_files)]
+
+
+def copy_file(source, destination):
+    # copy through a temporary file (concurrent runs may copy the same file)
+    if os.path.dirname(destination):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+    temporary_file = '{}.{}.tmp'.format(destination, os.getpid())
+    shutil.copyfile(source, temporary_file)
+    os.replace(temporary_file, destination)
+
+
+def fetch(key, output_files):
+    # copy the cached outputs of a key to the output files (returns False if not cached)
+    if cache_dir() is None:
+        return False
+    entry_dir = '{}/{}/{}'.format(cache_dir(), key[:2], key)
+    if not os.path.isdir(entry_dir):
+        return False
+    for (cached_file, output_file) in zip(entry_files(entry_dir, output_files), output_files):
+        copy_file(cached_file, output_file)
+    return True
+
+
+def store(key, output_files):
+    # store the outputs of a key (the entry is written to a temporary directory and renamed, so that
+    # entries are always complete)
+    if cache_dir() is None:
+        return
+    entry_dir = '{}/{}/{}'.format(cache_dir(), key[:2], key)
+    temporary_dir = '{}.{}.tmp'.format(entry_dir, os.getpid())
+    try:
+        os.makedirs(temporary_dir, exist_ok=True)
+        for (cached_file, output_file) in zip(entry_files(temporary_dir, output_files), output_files):
+            shutil.copyfile(output_file, cached_file)
+        os.rename(temporary_dir, entry_dir)
+    except OSError:
+        # the entry was stored by another run (or the cache is not writable)
+        pass
+    finally:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+
+
+def cached(version, input_files, output_files, parameters, function, *args):
+    # write the output files from the cache, or compute them with function(*args) and store them
+    #
+    # returns True if the outputs were taken from the cache
+    key = cache_key(version, input_files, parameters) if cache_dir() is not None else None
+    if key is not None and fetch(key, output_files):
+        return True
+    function(*args)
+    if key is not None:
+        store(key, output_files)
+    return False
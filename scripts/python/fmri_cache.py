@@ -0,0 +1,139 @@
+# helper functions to cache the decompressed 4D fMRI of a subject for repeated reads
+#
+# The gzip compressed fMRI (filtered_func_data_clean.nii.gz) has to be fully decompressed every time
+# it is read. Instead, it can be transcoded once into an uncompressed float32 npy array that is
+# memory-mapped by every later read. The array is voxel-major (voxels x timepoints), and only holds
+# the voxels of the brain mask (mask.nii.gz next to the fMRI), so that extracting the time-series of
+# a parcel only reads the rows of its voxels. Voxels outside of the mask are zero in the FSL outputs
+# (otherwise all voxels are stored), so parcel averages are unchanged.
+#
+# The cache is opt-in: load_fmri (parcel_timeseries.py) opens the cache when the UKB_FMRI_CACHE_DIR
+# environment variable is set, transcoding the fMRI on first use (or when the fMRI file changed).
+# UKB_connectivity_mapping_pipeline.sh sets it per subject when UKB_FMRI_CACHE=yes, and removes the
+# cache when the run ends.
+#
+# Usage:
+#     fmri_cache.py transcode <fmri_file> <cache_dir> [--chunk_size N]
+#     fmri_cache.py remove <cache_dir>
+
+import os
+import shutil
+import argparse
+import numpy as np
+import nibabel as nib
+from instrumentation import time_str
+
+
+default_chunk_size = 32
+
+
+class FmriCache:
+    # memory-mapped voxel-major fMRI (used in place of the 4D array by parcel_mean_timeseries)
+
+    def __init__(self, cache_dir):
+        with np.load('{}/fmri_index.npz'.format(cache_dir)) as index:
+            self.shape = tuple(index['shape'])
+            self.affine = index['affine']
+            self.voxels = index['voxels']
+        self.data = np.load('{}/fmri.npy'.format(cache_dir), mmap_mode='r')
+
+        # row of every voxel in the cache (-1 for voxels that are not stored, i.e. zero)
+        self.voxel_rows = np.full(int(np.prod(self.shape[:3])), -1, dtype=np.intp)
+        self.voxel_rows[self.voxels] = np.arange(self.voxels.shape[0])
+
+    def voxel_timeseries(self, voxels):
+        # time-series of the given (flat) voxel indices (voxels x timepoints)
+        rows = self.voxel_rows[voxels]
+        timeseries = np.zeros((rows.shape[0], self.shape[3]), dtype=np.float32)
+        stored = np.flatnonzero(rows >= 0)
+        # read the rows in storage order
+        order = np.argsort(rows[stored], kind='stable')
+        timeseries[stored[order]] = self.data[rows[stored[order]]]
+        return timeseries
+
+
+def source_stat(fmri_file):
+    stat = os.stat(fmri_file)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def transcode_fmri(fmri_file, cache_dir, chunk_size=default_chunk_size, use_mask=True):
+    # decompress the fMRI (chunks of volumes, decompressing the file only once) into the cache
+    mask_file = '{}/mask.nii.gz'.format(os.path.dirname(fmri_file))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    fmri = nib.load(fmri_file, keep_file_open=True)
+    voxel_count = int(np.prod(fmri.shape[:3]))
+    if use_mask and os.path.isfile(mask_file):
+        mask = (np.asarray(nib.load(mask_file).dataobj) != 0).reshape(-1)
+    else:
+        mask = np.ones(voxel_count, dtype=bool)
+    voxels = np.flatnonzero(mask)
+
+    data_file = '{}/fmri.{}.tmp.npy'.format(cache_dir, os.getpid())
+    data = np.lib.format.open_memmap(data_file, mode='w+', dtype=np.float32, shape=(voxels.shape[0], fmri.shape[3]))
+    outside_mask = False
+    for start in range(0, fmri.shape[3], chunk_size):
+        end = min(start + chunk_size, fmri.shape[3])
+        volumes = np.asarray(fmri.dataobj[..., start:end], dtype=np.float32).reshape(voxel_count, end - start)
+        data[:, start:end] = volumes[voxels]
+        outside_mask = outside_mask or bool(np.any(volumes[~mask]))
+    data.flush()
+    del data
+    fmri.uncache()
+
+    if outside_mask:
+        # the fMRI is not masked, store all voxels instead
+        os.remove(data_file)
+        return transcode_fmri(fmri_file, cache_dir, chunk_size, use_mask=False)
+
+    # the index is written last, so that it only exists for a complete cache
+    os.replace(data_file, '{}/fmri.npy'.format(cache_dir))
+    index_file = '{}/fmri_index.{}.tmp.npz'.format(cache_dir, os.getpid())
+    np.savez(
+        index_file,
+        source=np.array(os.path.abspath(fmri_file)),
+        source_stat=np.array(source_stat(fmri_file)),
+        shape=np.array(fmri.shape),
+        affine=fmri.affine,
+        voxels=voxels,
+    )
+    os.replace(index_file, '{}/fmri_index.npz'.format(cache_dir))
+
+
+def open_fmri_cache(fmri_file, cache_dir, chunk_size=default_chunk_size):
+    # open the cache of an fMRI file, transcoding it first if needed
+    index_file = '{}/fmri_index.npz'.format(cache_dir)
+    valid = False
+    if os.path.isfile(index_file):
+        with np.load(index_file) as index:
+            valid = str(index['source']) == os.path.abspath(fmri_file) and tuple(index['source_stat']) == source_stat(fmri_file)
+    if not valid:
+        print('{}: \033[0;32m[INFO]\033[0m Caching the decompressed fMRI in {}.'.format(time_str(), cache_dir))
+        transcode_fmri(fmri_file, cache_dir, chunk_size)
+    return FmriCache(cache_dir)
+
+
+def remove_fmri_cache(cache_dir):
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cache the decompressed 4D fMRI for repeated reads.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    transcode_parser = subparsers.add_parser('transcode', help='transcode the fMRI into the cache')
+    transcode_parser.add_argument('fmri_file')
+    transcode_parser.add_argument('cache_dir')
+    transcode_parser.add_argument('--chunk_size', type=int, default=default_chunk_size, help='number of volumes decompressed at once')
+
+    remove_parser = subparsers.add_parser('remove', help='remove the cache')
+    remove_parser.add_argument('cache_dir')
+
+    args = parser.parse_args()
+
+    if args.command == 'transcode':
+        open_fmri_cache(args.fmri_file, args.cache_dir, args.chunk_size)
+    else:
+        remove_fmri_cache(args.cache_dir)
@@ -0,0 +1,202 @@
+# script to compute functional connectivity matrices from the parcel fMRI time-series
+#
+# Usage:
+#     functional_connectivity.py subject <main_dir> <subject_id> <instance> <atlas_names>
+#                                [--measures correlation,fisher_z,partial_correlation] [--shrinkage 0.1] [--input_format csv|npz]
+#     functional_connectivity.py cohort <main_dir> <atlas_names> [--measures ...] [--shrinkage 0.1] [--workers N] [--start i] [--end j]
+#
+# atlas_names is a comma separated list of atlases with time-series computed by compute_fmri.py. The
+# time-series are standardized once (in float32) and all measures are derived from the correlation
+# matrix computed by a single matrix product:
+#     correlation:          Pearson correlation
+#     fisher_z:             Fisher z-transformed correlation (arctanh)
+#     partial_correlation:  partial correlation from the inverse of the correlation matrix, shrunk
+#                           towards the identity (regularised, as there are often more parcels than
+#                           time points)
+# Parcels without signal (e.g. without voxels in the fMRI space) are excluded from all measures, and
+# their rows and columns are NaN (missing, as in group_statistics.py).
+#
+# In subject mode, the time-series of a subject in the temporary directory are used and every
+# measure is written to fMRI/connectivity/fMRI.<atlas>.<measure>.npz, keeping only the upper
+# triangle (excluding the diagonal) along with the label names (see load_connectivity). In cohort
+# mode, the time-series are read from the fMRI zip files (one process per instance) and appended to
+# cohort stores (data/output/cohort/functional_connectivity/<atlas>/<measure>, see
+# cohort_connectome_store.py); instances that are already stored are skipped.
+
+import os
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import ensure_dir, time_str
+from parcel_timeseries import load_timeseries, output_extensions
+from group_statistics import read_instance_timeseries
+from cohort_connectome_store import ConnectomeStore
+from zip_completion_index import read_subject_instances, zip_file_name
+
+
+measures = ['correlation', 'fisher_z', 'partial_correlation']
+diagonal_values = {'correlation': 1, 'fisher_z': np.nan, 'partial_correlation': 1}
+
+
+def connectivity_matrices(timeseries, selected_measures=('correlation',), shrinkage=0.1):
+    # connectivity matrices (parcels x parcels) of a time-series array (parcels x time points)
+    timeseries = np.asarray(timeseries, dtype=np.float32)
+
+    # parcels without signal (e.g. without voxels in the fMRI space, which have NaN time-series, or
+    # with a constant signal) are excluded from all measures, their rows and columns are NaN
+    valid = np.isfinite(timeseries).all(1) & (np.ptp(timeseries, axis=1) > 0)
+    standardized = timeseries[valid] - timeseries[valid].mean(1, keepdims=True)
+    standardized /= np.linalg.norm(standardized, axis=1, keepdims=True)
+    correlation = np.clip(standardized @ standardized.T, -1, 1)
+
+    valid_matrices = {}
+    if 'correlation' in selected_measures:
+        valid_matrices['correlation'] = correlation
+    if 'fisher_z' in selected_measures:
+        epsilon = np.finfo(np.float32).eps
+        valid_matrices['fisher_z'] = np.arctanh(np.clip(correlation, -1 + epsilon, 1 - epsilon))
+    if 'partial_correlation' in selected_measures:
+        precision = np.linalg.inv((1 - shrinkage) * correlation.astype(np.float64) + shrinkage * np.eye(correlation.shape[0]))
+        scale = np.sqrt(np.diag(precision))
+        valid_matrices['partial_correlation'] = (-precision / scale[:, None] / scale[None, :]).astype(np.float32)
+
+    matrices = {}
+    for measure in valid_matrices:
+        matrices[measure] = np.full((valid.shape[0], valid.shape[0]), np.nan, dtype=np.float32)
+        matrices[measure][np.ix_(valid, valid)] = valid_matrices[measure]
+        np.fill_diagonal(matrices[measure], diagonal_values[measure])
+    return matrices
+
+
+def save_connectivity(output_file, label_names, matrix, measure):
+    # upper triangle (excluding the diagonal) of a symmetric matrix
+    np.savez(
+        output_file,
+        label_name=np.asarray(label_names, dtype=str),
+        measure=np.array(measure),
+        values=matrix[np.triu_indices(matrix.shape[0], 1)].astype(np.float32),
+    )
+
+
+def load_connectivity(input_file):
+    # load the label names and the dense (symmetric) connectivity matrix
+    with np.load(input_file) as content:
+        label_names = content['label_name']
+        matrix = np.zeros((label_names.shape[0], label_names.shape[0]), dtype=np.float32)
+        rows, cols = np.triu_indices(label_names.shape[0], 1)
+        matrix[rows, cols] = content['values']
+        matrix[cols, rows] = content['values']
+        np.fill_diagonal(matrix, diagonal_values[str(content['measure'])])
+    return label_names, matrix
+
+
+def compute_subject_connectivity(main_dir, ukb_subject_id, ukb_instance, atlas_names, selected_measures=('correlation',), shrinkage=0.1, input_format='csv'):
+    # compute the connectivity matrices of a subject's atlases (existing outputs are skipped)
+    temporary_dir = "{}/data/temporary".format(main_dir)
+    fmri_dir = '{}/subjects/{}_{}/fMRI'.format(temporary_dir, ukb_subject_id, ukb_instance)
+    connectivity_file = '{}/connectivity/fMRI.{{}}.{{}}.npz'.format(fmri_dir)
+
+    for atlas_name in atlas_names:
+        missing_measures = [x for x in selected_measures if not os.path.isfile(connectivity_file.format(atlas_name, x))]
+        if len(missing_measures) == 0:
+            continue
+
+        print('{}: \033[0;32m[INFO]\033[0m Computing functional connectivity on {}.'.format(time_str(), atlas_name))
+        atlas_fmri = load_timeseries('{}/fMRI.{}.{}'.format(fmri_dir, atlas_name, output_extensions[input_format]))
+        matrices = connectivity_matrices(atlas_fmri.drop(columns='label_name').to_numpy(), missing_measures, shrinkage)
+        for measure in matrices:
+            save_connectivity(ensure_dir(connectivity_file.format(atlas_name, measure)), atlas_fmri['label_name'], matrices[measure], measure)
+
+
+def read_instance_connectivity(main_dir, ukb_subject_id, ukb_instance, atlas_names, selected_measures, shrinkage):
+    # connectivity matrices of an instance from its fMRI zip file (run by every worker)
+    instance_matrices = {}
+    for atlas_name in atlas_names:
+        atlas_fmri = read_instance_timeseries(zip_file_name(main_dir, ukb_subject_id, ukb_instance, 'fMRI'), 'fMRI/fMRI.{}'.format(atlas_name))
+        if atlas_fmri is not None:
+            instance_matrices[atlas_name] = connectivity_matrices(atlas_fmri.drop(columns='label_name').to_numpy(), selected_measures, shrinkage)
+    return instance_matrices
+
+
+def compute_cohort_connectivity(main_dir, atlas_names, selected_measures=('correlation',), shrinkage=0.1, workers=8, start=1, end=None):
+    subject_instances = read_subject_instances(main_dir)
+    end = len(subject_instances) if end is None else min(end, len(subject_instances))
+    subject_instances = subject_instances[start - 1:end]
+
+    keys = [(atlas_name, measure) for atlas_name in atlas_names for measure in selected_measures]
+    store_dir = '{}/data/output/cohort/functional_connectivity/{{}}/{{}}'.format(main_dir)
+    stores = {key: ConnectomeStore(store_dir.format(*key)) for key in keys if os.path.isfile('{}/header.npz'.format(store_dir.format(*key)))}
+
+    # only compute the instances missing from any of the stores
+    pending = [
+        x for x in subject_instances
+        if any(key not in stores or x not in stores[key].rows for key in keys)
+    ]
+    print('{}: \033[0;32m[INFO]\033[0m Computing functional connectivity of {} instances.'.format(time_str(), len(pending)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            read_instance_connectivity,
+            *zip(*[(main_dir, ukb_subject_id, ukb_instance, atlas_names, selected_measures, shrinkage) for (ukb_subject_id, ukb_instance) in pending]),
+            chunksize=8,
+        )
+        for (computed, ((ukb_subject_id, ukb_instance), instance_matrices)) in enumerate(zip(pending, results), 1):
+            for (atlas_name, measure) in keys:
+                if atlas_name not in instance_matrices:
+                    continue
+                matrix = instance_matrices[atlas_name][measure]
+                if (atlas_name, measure) not in stores:
+                    stores[(atlas_name, measure)] = ConnectomeStore(store_dir.format(atlas_name, measure), atlas_name, measure, matrix.shape[0])
+                if (ukb_subject_id, ukb_instance) not in stores[(atlas_name, measure)].rows:
+                    stores[(atlas_name, measure)].append(ukb_subject_id, ukb_instance, matrix)
+
+            # save regularly, so that an interrupted run can continue from there
+            if computed % 1024 == 0:
+                for store in stores.values():
+                    store.save()
+                print('{}: \033[0;32m[INFO]\033[0m Computed {} of {} instances.'.format(time_str(), computed, len(pending)))
+
+    for (key, store) in stores.items():
+        store.save()
+        print('{}: \033[0;32m[INFO]\033[0m {} {}: {} matrices stored.'.format(time_str(), key[0], key[1], len(store)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute functional connectivity matrices from parcel fMRI time-series.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subject_parser = subparsers.add_parser('subject', help='compute the matrices of a subject (from the temporary directory)')
+    subject_parser.add_argument('main_dir')
+    subject_parser.add_argument('ukb_subject_id')
+    subject_parser.add_argument('ukb_instance')
+    subject_parser.add_argument('atlas_names', help='comma separated list of atlases')
+    subject_parser.add_argument('--input_format', choices=sorted(output_extensions), default='csv', help='fMRI time-series format')
+
+    cohort_parser = subparsers.add_parser('cohort', help='compute the matrices of all instances (from the fMRI zip files)')
+    cohort_parser.add_argument('main_dir')
+    cohort_parser.add_argument('atlas_names', help='comma separated list of atlases')
+    cohort_parser.add_argument('--workers', type=int, default=8, help='number of processes')
+    cohort_parser.add_argument('--start', type=int, default=1, help='first instance index (inclusive)')
+    cohort_parser.add_argument('--end', type=int, default=None, help='last instance index (inclusive)')
+
+    for measure_parser in [subject_parser, cohort_parser]:
+        measure_parser.add_argument('--measures', default='correlation', help='comma separated list of measures ({})'.format(','.join(measures)))
+        measure_parser.add_argument('--shrinkage', type=float, default=0.1, help='shrinkage of the correlation matrix for partial correlations')
+
+    args = parser.parse_args()
+
+    selected_measures = args.measures.split(',')
+    for measure in selected_measures:
+        if measure not in measures:
+            parser.error('Unknown measure: {}'.format(measure))
+
+    if args.command == 'subject':
+        compute_subject_connectivity(
+            args.main_dir, args.ukb_subject_id, args.ukb_instance, [x for x in args.atlas_names.split(',') if x],
+            selected_measures, args.shrinkage, args.input_format,
+        )
+    else:
+        compute_cohort_connectivity(
+            args.main_dir, [x for x in args.atlas_names.split(',') if x], selected_measures, args.shrinkage,
+            args.workers, args.start, args.end,
+        )
@@ -0,0 +1,306 @@
+# script to compute group statistics of connectomes and fMRI time-series in a single streaming pass
+# over the subject outputs (without loading the whole cohort in memory)
+#
+# Usage:
+#     group_statistics.py aggregate <main_dir> <statistics_file> --source connectome|fmri --atlas <atlas_name>
+#                         [--metric streamline_count] [--streamlines 10M] [--range <min> <max>] [--bins N]
+#                         [--workers N] [--start i] [--end j]
+#     group_statistics.py merge <statistics_file> <partial_statistics_file> [<partial_statistics_file> ...]
+#     group_statistics.py report <statistics_file> [--quantiles 0.05,0.5,0.95] [--output report.csv]
+#
+# The connectomes (tractography/connectomes/<atlas>/connectome_<metric>_<streamlines>) or time-series
+# (fMRI/fMRI.<atlas>) are read from the zip files of the instances listed in the combined bulk file.
+# For every edge (upper triangle, including the diagonal) or parcel (over all time points), the
+# count, mean and sum of squared deviations (Welford's online algorithm, in the pairwise form of Chan
+# et al. to update with a batch of values at once), the number of non-zero values, the minimum and
+# the maximum are kept. When a value range is given, a fixed-bin histogram is also kept to estimate
+# quantiles (values outside of the range are counted in the first or last bin).
+#
+# All of these statistics can be merged: every worker aggregates a slice of the instances, and
+# partial results (e.g. from different nodes, using --start and --end) are combined with merge.
+
+import io
+import zipfile
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import time_str
+from parcel_timeseries import load_timeseries
+from cohort_connectome_store import read_instance_connectomes
+from zip_completion_index import normalize_name, read_subject_instances, zip_file_name
+
+
+sources = ['connectome', 'fmri']
+timeseries_extensions = ['npz', 'csv.gz']
+statistic_names = ['count', 'mean', 'm2', 'nonzero', 'minimum', 'maximum', 'value_range', 'histogram']
+
+
+class RunningStatistics:
+    # mergeable per feature (edge or parcel) statistics, missing values are given as nan
+
+    def __init__(self, feature_count, value_range=None, bins=256):
+        self.count = np.zeros(feature_count, dtype=np.int64)
+        self.mean = np.zeros(feature_count)
+        self.m2 = np.zeros(feature_count)
+        self.nonzero = np.zeros(feature_count, dtype=np.int64)
+        self.minimum = np.full(feature_count, np.inf)
+        self.maximum = np.full(feature_count, -np.inf)
+        self.value_range = None if value_range is None else np.array(value_range, dtype=float)
+        self.histogram = None if value_range is None else np.zeros((feature_count, bins), dtype=np.int64)
+
+    def merge_moments(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = np.where(total > 0, self.mean + delta * count / total, 0)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 * self.count * count / total, 0)
+        self.count = total
+
+    def update(self, values):
+        # add a batch of values (samples x features)
+        values = np.asarray(values, dtype=float).reshape(-1, self.count.shape[0])
+        valid = ~np.isnan(values)
+        count = valid.sum(0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, np.where(valid, values, 0).sum(0) / count, 0)
+        m2 = (np.where(valid, values - mean, 0) ** 2).sum(0)
+        self.merge_moments(count, mean, m2)
+
+        self.nonzero += (valid & (values != 0)).sum(0)
+        self.minimum = np.fmin(self.minimum, np.fmin.reduce(values, axis=0))
+        self.maximum = np.fmax(self.maximum, np.fmax.reduce(values, axis=0))
+
+        if self.histogram is not None:
+            feature_count, bins = self.histogram.shape
+            with np.errstate(invalid='ignore'):
+                bin_index = np.clip(
+                    np.floor((values - self.value_range[0]) / (self.value_range[1] - self.value_range[0]) * bins), 0, bins - 1
+                )
+            flat_index = (np.arange(feature_count) * bins + bin_index)[valid].astype(np.int64)
+            self.histogram += np.bincount(flat_index, minlength=feature_count * bins).reshape(feature_count, bins)
+
+    def merge(self, other):
+        if (self.histogram is None) != (other.histogram is None) or \
+                (self.histogram is not None and (not np.array_equal(self.value_range, other.value_range) or self.histogram.shape != other.histogram.shape)):
+            raise ValueError('Statistics with different histograms can not be merged.')
+        self.merge_moments(other.count, other.mean, other.m2)
+        self.nonzero += other.nonzero
+        self.minimum = np.fmin(self.minimum, other.minimum)
+        self.maximum = np.fmax(self.maximum, other.maximum)
+        if self.histogram is not None:
+            self.histogram += other.histogram
+        return self
+
+    def variance(self):
+        # (unbiased) sample variance
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    def quantiles(self, quantiles):
+        # approximate quantiles (features x quantiles), interpolated linearly within the histogram bins
+        feature_count, bins = self.histogram.shape
+        bin_edges = np.linspace(self.value_range[0], self.value_range[1], bins + 1)
+        cumulative = np.cumsum(self.histogram, axis=1)
+        result = np.full((feature_count, len(quantiles)), np.nan)
+        for (i, quantile) in enumerate(quantiles):
+            target = quantile * cumulative[:, -1]
+            bin_index = np.minimum((cumulative < target[:, None]).sum(1), bins - 1)
+            previous = np.where(bin_index > 0, cumulative[np.arange(feature_count), bin_index - 1], 0)
+            in_bin = self.histogram[np.arange(feature_count), bin_index]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                fraction = np.where(in_bin > 0, (target - previous) / in_bin, 0)
+            result[:, i] = np.where(
+                cumulative[:, -1] > 0,
+                bin_edges[bin_index] + fraction * (bin_edges[bin_index + 1] - bin_edges[bin_index]),
+                np.nan,
+            )
+        return result
+
+    def arrays(self):
+        arrays = {
+            'count': self.count, 'mean': self.mean, 'm2': self.m2, 'nonzero': self.nonzero,
+            'minimum': self.minimum, 'maximum': self.maximum,
+        }
+        if self.histogram is not None:
+            arrays.update({'value_range': self.value_range, 'histogram': self.histogram})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        statistics = cls(arrays['count'].shape[0])
+        for name in ['count', 'mean', 'm2', 'nonzero', 'minimum', 'maximum']:
+            setattr(statistics, name, arrays[name])
+        if 'histogram' in arrays:
+            statistics.value_range = arrays['value_range']
+            statistics.histogram = arrays['histogram']
+        return statistics
+
+
+def save_statistics(statistics_file, statistics, header):
+    # header: source, atlas, number of instances, and the feature labels (node count or label names)
+    np.savez(statistics_file, **statistics.arrays(), **{x: np.array(header[x]) for x in header})
+
+
+def load_statistics(statistics_file):
+    with np.load(statistics_file) as content:
+        arrays = dict(content)
+    header = {x: arrays.pop(x) for x in list(arrays) if x not in statistic_names}
+    return RunningStatistics.from_arrays(arrays), header
+
+
+def read_instance_timeseries(zip_path, timeseries_name):
+    # read the time-series table of an instance from its fMRI zip file (None if not available)
+    try:
+        with zipfile.ZipFile(zip_path) as zip_content:
+            names = {normalize_name(x): x for x in zip_content.namelist()}
+            for extension in timeseries_extensions:
+                file_name = '{}.{}'.format(timeseries_name, extension)
+                if file_name in names:
+                    return load_timeseries(io.BytesIO(zip_content.read(names[file_name])), file_name)
+    except (zipfile.BadZipFile, OSError):
+        pass
+    return None
+
+
+def aggregate_instances(main_dir, source, atlas_name, metric_name, streamlines, subject_instances, value_range, bins):
+    # aggregate the statistics of a list of instances (run by every worker)
+    statistics = None
+    header = {'source': source, 'atlas': atlas_name, 'instances': 0}
+    for (ukb_subject_id, ukb_instance) in subject_instances:
+        if source == 'connectome':
+            adj = read_instance_connectomes(
+                zip_file_name(main_dir, ukb_subject_id, ukb_instance, 'tractography'),
+                ['tractography/connectomes/{}/connectome_{}_{}'.format(atlas_name, metric_name, streamlines)],
+            )[0]
+            if adj is None:
+                continue
+            if statistics is None:
+                header.update({'metric': metric_name, 'node_count': adj.shape[0]})
+                statistics = RunningStatistics(np.triu_indices(adj.shape[0])[0].shape[0], value_range, bins)
+            elif adj.shape[0] != header['node_count']:
+                raise ValueError('Connectome of {}_{} has {} nodes instead of {}.'.format(ukb_subject_id, ukb_instance, adj.shape[0], header['node_count']))
+            statistics.update(adj[np.triu_indices(adj.shape[0])][None, :])
+        else:
+            atlas_fmri = read_instance_timeseries(
+                zip_file_name(main_dir, ukb_subject_id, ukb_instance, 'fMRI'),
+                'fMRI/fMRI.{}'.format(atlas_name),
+            )
+            if atlas_fmri is None:
+                continue
+            if statistics is None:
+                header['label_name'] = atlas_fmri['label_name'].to_numpy(dtype=str)
+                statistics = RunningStatistics(atlas_fmri.shape[0], value_range, bins)
+            elif not np.array_equal(atlas_fmri['label_name'].to_numpy(dtype=str), header['label_name']):
+                raise ValueError('Time-series of {}_{} have different parcels.'.format(ukb_subject_id, ukb_instance))
+            statistics.update(atlas_fmri.drop(columns='label_name').to_numpy(dtype=float).T)
+        header['instances'] += 1
+    return statistics, header
+
+
+def merge_results(results):
+    # merge partial (statistics, header) results, skipping empty ones
+    statistics, header = None, None
+    for (partial_statistics, partial_header) in results:
+        if partial_statistics is None:
+            continue
+        if statistics is None:
+            statistics, header = partial_statistics, dict(partial_header)
+            continue
+        if partial_header['source'] != header['source'] or str(partial_header['atlas']) != str(header['atlas']):
+            raise ValueError('Statistics of different sources or atlases can not be merged.')
+        statistics.merge(partial_statistics)
+        header['instances'] = int(header['instances']) + int(partial_header['instances'])
+    return statistics, header
+
+
+def aggregate(main_dir, source, atlas_name, metric_name='streamline_count', streamlines='10M', value_range=None, bins=256, workers=8, start=1, end=None):
+    subject_instances = read_subject_instances(main_dir)
+    end = len(subject_instances) if end is None else min(end, len(subject_instances))
+    subject_instances = subject_instances[start - 1:end]
+
+    # every worker aggregates contiguous slices of the instances, the partial results are merged
+    slices = [x.tolist() for x in np.array_split(np.arange(len(subject_instances)), max(1, min(len(subject_instances), 4 * workers)))]
+    print('{}: \033[0;32m[INFO]\033[0m Aggregating {} instances in {} slices.'.format(time_str(), len(subject_instances), len(slices)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            aggregate_instances,
+            *zip(*[
+                (main_dir, source, atlas_name, metric_name, streamlines, [subject_instances[i] for i in x], value_range, bins)
+                for x in slices
+            ])
+        )
+        return merge_results(results)
+
+
+def report(statistics, header, quantiles=()):
+    # table of the statistics of every edge (row, col) or parcel (label_name)
+    if 'node_count' in header:
+        rows, cols = np.triu_indices(int(header['node_count']))
+        table = pd.DataFrame({'row': rows, 'col': cols})
+    else:
+        table = pd.DataFrame({'label_name': header['label_name']})
+
+    table['count'] = statistics.count
+    table['mean'] = statistics.mean
+    table['std'] = np.sqrt(statistics.variance())
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table['nonzero_fraction'] = statistics.nonzero / statistics.count
+    table['min'] = statistics.minimum
+    table['max'] = statistics.maximum
+    if len(quantiles) > 0:
+        if statistics.histogram is None:
+            raise ValueError('Quantiles need statistics aggregated with a value range.')
+        for (quantile, values) in zip(quantiles, statistics.quantiles(quantiles).T):
+            table['q{:g}'.format(quantile)] = values
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming group statistics of connectomes and fMRI time-series.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    aggregate_parser = subparsers.add_parser('aggregate', help='aggregate the statistics of (a range of) instances')
+    aggregate_parser.add_argument('main_dir')
+    aggregate_parser.add_argument('statistics_file', help='output npz file')
+    aggregate_parser.add_argument('--source', choices=sources, required=True)
+    aggregate_parser.add_argument('--atlas', required=True, help='atlas name (combined cortical+subcortical atlas for connectomes)')
+    aggregate_parser.add_argument('--metric', default='streamline_count', help='connectome metric')
+    aggregate_parser.add_argument('--streamlines', default='10M', help='number of streamlines in the connectome file names')
+    aggregate_parser.add_argument('--range', type=float, nargs=2, default=None, metavar=('MIN', 'MAX'), help='value range of the histograms used for quantiles')
+    aggregate_parser.add_argument('--bins', type=int, default=256, help='number of histogram bins')
+    aggregate_parser.add_argument('--workers', type=int, default=8, help='number of processes')
+    aggregate_parser.add_argument('--start', type=int, default=1, help='first instance index (inclusive)')
+    aggregate_parser.add_argument('--end', type=int, default=None, help='last instance index (inclusive)')
+
+    merge_parser = subparsers.add_parser('merge', help='merge partial statistics')
+    merge_parser.add_argument('statistics_file', help='output npz file')
+    merge_parser.add_argument('partial_statistics_files', nargs='+')
+
+    report_parser = subparsers.add_parser('report', help='write the statistics as a table')
+    report_parser.add_argument('statistics_file')
+    report_parser.add_argument('--quantiles', default='', help='comma separated list of quantiles (e.g. 0.05,0.5,0.95)')
+    report_parser.add_argument('--output', default=None, help='output csv file (printed by default)')
+
+    args = parser.parse_args()
+
+    if args.command == 'aggregate':
+        statistics, header = aggregate(
+            args.main_dir, args.source, args.atlas, args.metric, args.streamlines,
+            args.range, args.bins, args.workers, args.start, args.end,
+        )
+        if statistics is None:
+            raise SystemExit('No {} outputs of {} found.'.format(args.source, args.atlas))
+        save_statistics(args.statistics_file, statistics, header)
+        print('{}: \033[0;32m[INFO]\033[0m Statistics of {} instances saved.'.format(time_str(), header['instances']))
+    elif args.command == 'merge':
+        statistics, header = merge_results([load_statistics(x) for x in args.partial_statistics_files])
+        save_statistics(args.statistics_file, statistics, header)
+        print('{}: \033[0;32m[INFO]\033[0m Statistics of {} instances saved.'.format(time_str(), header['instances']))
+    else:
+        table = report(*load_statistics(args.statistics_file), [float(x) for x in args.quantiles.split(',') if x])
+        if args.output is None:
+            print(table)
+        else:
+            table.to_csv(args.output, index=False)
@@ -0,0 +1,148 @@
+# helper functions to record the runtime and resource usage of pipeline stages
+#
+# Every stage wrapped in a Stage context appends one json line to the stage log, with the stage
+# name, subject, instance, atlas (and any other given fields), along with its wall time, cpu time
+# (including threads and child processes), peak resident memory, and bytes read and written.
+#
+# The stage log is given by the UKB_STAGE_LOG environment variable (no records are written if it is
+# not set), and the subject and instance default to the UKB_SUBJECT_ID and UKB_INSTANCE environment
+# variables (exported by UKB_connectivity_mapping_pipeline.sh). The records are summarized across
+# subjects by stage_report.py.
+#
+# Usage:
+#     from instrumentation import Stage
+#     with Stage('compute_fmri', atlas='Glasser'):
+#         ...
+#
+# Memory peaks and io counters are read from /proc (Linux only), and are reported as null where
+# not available. The peak memory of a stage is measured by resetting the peak resident set size
+# of the process when the stage starts.
+#
+# The module also holds the time_str and ensure_dir helpers shared by the pipeline scripts.
+
+import os
+import json
+import time
+import socket
+import datetime
+import resource
+
+
+_active_stages = []
+
+
+def ensure_dir(file_name):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    return file_name
+
+
+def time_str(mode='abs', base=None):
+    if mode == 'rel':
+        return str(datetime.timedelta(seconds=(time.time() - base)))
+    if mode == 'raw':
+        return time.time()
+    if mode == 'abs':
+        return time.asctime(time.localtime(time.time()))
+
+
+def read_proc_fields(file_name, fields):
+    # read "key: value" fields from a /proc file (None where not available)
+    values = {}
+    try:
+        with open(file_name) as proc_file:
+            for line in proc_file:
+                key, _, value = line.partition(':')
+                if key in fields:
+                    values[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return values
+
+
+def peak_rss():
+    # peak resident set size (bytes) of this process since the last reset
+    hwm = read_proc_fields('/proc/self/status', ['VmHWM']).get('VmHWM')
+    if hwm is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return hwm * 1024
+
+
+def reset_peak_rss():
+    # reset the peak resident set size of this process (supported since Linux 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def cpu_seconds():
+    # user and system time of this process (all threads) and its finished child processes
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def io_bytes():
+    return read_proc_fields('/proc/self/io', ['rchar', 'wchar'])
+
+
+class Stage:
+    def __init__(self, name, subject=None, instance=None, atlas=None, **fields):
+        self.record = {
+            'stage': name,
+            'subject': subject if subject is not None else os.environ.get('UKB_SUBJECT_ID'),
+            'instance': instance if instance is not None else os.environ.get('UKB_INSTANCE'),
+            'atlas': atlas,
+        }
+        self.record.update(fields)
+
+    def __enter__(self):
+        # keep the peak memory of any enclosing stage before resetting it
+        peak = peak_rss()
+        for active_stage in _active_stages:
+            active_stage.peak = max(active_stage.peak, peak)
+        reset_peak_rss()
+        _active_stages.append(self)
+
+        self.peak = 0
+        self.io = io_bytes()
+        self.cpu = cpu_seconds()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.time() - self.start
+        cpu = cpu_seconds() - self.cpu
+        io = io_bytes()
+        _active_stages.remove(self)
+        self.peak = max(self.peak, peak_rss())
+        for active_stage in _active_stages:
+            active_stage.peak = max(active_stage.peak, self.peak)
+
+        self.record.update({
+            'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start)),
+            'wall_seconds': round(wall, 3),
+            'cpu_seconds': round(cpu, 3),
+            'peak_rss_bytes': self.peak,
+            'bytes_read': io['rchar'] - self.io['rchar'] if 'rchar' in io and 'rchar' in self.io else None,
+            'bytes_written': io['wchar'] - self.io['wchar'] if 'wchar' in io and 'wchar' in self.io else None,
+            'host': socket.gethostname(),
+            'failed': exc_type is not None,
+        })
+        write_record(self.record)
+
+        return False
+
+
+def write_record(record, stage_log=None):
+    # append a record to the stage log (a single write, so that concurrent jobs can share the log)
+    stage_log = stage_log or os.environ.get('UKB_STAGE_LOG')
+    if not stage_log:
+        return
+    if os.path.dirname(stage_log):
+        os.makedirs(os.path.dirname(stage_log), exist_ok=True)
+    log_file = os.open(stage_log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        os.write(log_file, (json.dumps(record) + '\n').encode('utf8'))
+    finally:
+        os.close(log_file)
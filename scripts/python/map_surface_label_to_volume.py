@@ -1,14 +1,24 @@
 # script made from the notebook codes
+#
+# Usage:
+#     map_surface_label_to_volume.py <main_dir> <ukb_subjects_dir> <subject_id> <instance> <atlas_names> [workers]
+#
+# atlas_names is a comma separated list of atlases. The mapping from every cortical ribbon voxel
+# to its nearest surface vertex does not depend on the atlas: it is computed once per subject
+# (with a parallel KD-tree query), cached to ribbon_vertex_map.npz in the subject's temporary cache
+# directory (outside of the archived atlases directory), and reused to label any number of atlases
+# by array indexing. The cache stores the modification time and size of the ribbon and surfaces it
+# was computed from, and is recomputed if any of them has changed.
 
 import os
 import sys
 import time
 import datetime
 import numpy as np
-import pandas as pd
 import nibabel as nib
 from scipy import spatial
 from nibabel import freesurfer
+from instrumentation import Stage
 
 
 def ensure_dir(file_name):
@@ -25,149 +35,214 @@ def time_str(mode='abs', base=None):
         return time.asctime(time.localtime(time.time()))
 
 
-if __name__ == '__main__':
-    # sys.argv
-    main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, atlas_name = sys.argv[1:]
+# Label numbers are from the FreeSurferColorLUT (https://surfer.nmr.mgh.harvard.edu/fswiki/FsTutorial/AnatomicalROI/FreeSurferColorLUT) lookup table and has 5 values:
+#     0: Unknown
+#     2: Left-Cerebral-White-Matter
+#     3: Left-Cerebral-Cortex
+#     41: Right-Cerebral-White-Matter
+#     42: Right-Cerebral-Cortex
 
-    template_dir = "{}/data/templates".format(main_dir)
-    temporary_dir = "{}/data/temporary".format(main_dir)
-    output_dir = "{}/data/output".format(main_dir)
+id_to_label = {
+    0: 'Unknown',
+    2: 'Left-Cerebral-White-Matter',
+    3: 'Left-Cerebral-Cortex',
+    41: 'Right-Cerebral-White-Matter',
+    42: 'Right-Cerebral-Cortex',
+}
 
-    # load the pial and white surfaces for left and right hemispheres
-    #
-    # each loaded object is a python tuple containing two elements:
-    #     1. the coordinates of all vertices
-    #     2. the triangle information of the mesh
+label_id = {id_to_label[x]: x for x in id_to_label}
 
-    lh_pial_surf = freesurfer.read_geometry('{}/{}_{}/FreeSurfer/surf/lh.pial'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance))
-    lh_white_surf = freesurfer.read_geometry('{}/{}_{}/FreeSurfer/surf/lh.white'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance))
+hemisphere_cortex = {
+    'lh': 'Left-Cerebral-Cortex',
+    'rh': 'Right-Cerebral-Cortex',
+}
 
-    rh_pial_surf = freesurfer.read_geometry('{}/{}_{}/FreeSurfer/surf/rh.pial'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance))
-    rh_white_surf = freesurfer.read_geometry('{}/{}_{}/FreeSurfer/surf/rh.white'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance))
 
-    # Now let's load the surface atlas mapped to each surface
+def compute_ribbon_vertex_map(subject_dir, workers=-1):
+    # map every voxel of the cortical ribbon to its nearest surface vertex
     #
-    # each loaded object is a python tuple containing 3 elements:
-    #     1. A list of integers indicating the label of each vertex
-    #     2. A table for the color of each label (r, g, b, t, colortable array id)
-    #     3. A list names of the lables
-
-    lh_atlas_annot = freesurfer.read_annot('{}/subjects/{}_{}/atlases/lh.native.{}.annot'.format(temporary_dir, ukb_subject_id, ukb_instance, atlas_name))
-    rh_atlas_annot = freesurfer.read_annot('{}/subjects/{}_{}/atlases/rh.native.{}.annot'.format(temporary_dir, ukb_subject_id, ukb_instance, atlas_name))
+    # returns a dictionary with the shape and affine of the ribbon, and for every hemisphere the
+    # (flat) indices of its cortical ribbon voxels along with the index of the nearest vertex
 
-    print('{}: \033[0;32m[INFO]\033[0m There are {} unique labels in surface atlas: {} (including ???)'.format(
-        time_str(),
-        len(np.unique(np.concatenate([lh_atlas_annot[0], rh_atlas_annot[0]]))),
-        atlas_name)
-    )
-
-    # Finally we need to load the ribbon mask to use as a reference for voxels to be labeled (only label voxels in the cortical ribbon)
+    # Load the ribbon mask to use as a reference for voxels to be labeled (only label voxels in the cortical ribbon)
     #
     # The ribbon file can be read using nibabel. The saved object is an MGHImage object containing the affine matrix, as well as the labels in a 3d data matrix
     # Check https://nipy.org/nibabel/reference/nibabel.freesurfer.html#nibabel.freesurfer.mghformat.MGHImage
-    #
-    # Label numbers are from the FreeSurferColorLUT (https://surfer.nmr.mgh.harvard.edu/fswiki/FsTutorial/AnatomicalROI/FreeSurferColorLUT) lookup table and has 5 values:
-    #     0: Unknown
-    #     2: Left-Cerebral-White-Matter
-    #     3: Left-Cerebral-Cortex
-    #     41: Right-Cerebral-White-Matter
-    #     42: Right-Cerebral-Cortex
-
-    id_to_label = {
-        0: 'Unknown',
-        2: 'Left-Cerebral-White-Matter',
-        3: 'Left-Cerebral-Cortex',
-        41: 'Right-Cerebral-White-Matter',
-        42: 'Right-Cerebral-Cortex',
+    ribbon = nib.load('{}/FreeSurfer/mri/ribbon.mgz'.format(subject_dir))
+    ribbon_data = np.asarray(ribbon.dataobj).reshape(-1)
+
+    vertex_map = {
+        'shape': np.array(ribbon.shape),
+        'affine': ribbon.header.get_vox2ras(),
     }
 
-    label_id = {id_to_label[x]: x for x in id_to_label}
+    for hemi in ['lh', 'rh']:
+        # load the pial and white surfaces
+        #
+        # each loaded object is a python tuple containing two elements:
+        #     1. the coordinates of all vertices
+        #     2. the triangle information of the mesh
+        pial_xyz = freesurfer.read_geometry('{}/FreeSurfer/surf/{}.pial'.format(subject_dir, hemi))[0]
+        white_xyz = freesurfer.read_geometry('{}/FreeSurfer/surf/{}.white'.format(subject_dir, hemi))[0]
+
+        # We'll use kdtree to store the coordinates of both surfaces to query for nearest neighbor
+        kdtree = spatial.cKDTree(np.vstack([pial_xyz, white_xyz]))
+
+        # extract the indices of voxels in the cortical ribbon
+        voxels = np.flatnonzero(ribbon_data == label_id[hemisphere_cortex[hemi]])
+
+        # use the affine transformation to get to xyz coordinates of the voxels
+        cortex_xyz = nib.affines.apply_affine(
+            ribbon.header.get_vox2ras_tkr(),
+            np.array(np.unravel_index(voxels, ribbon.shape)).T,
+        )
+
+        # querry each voxel's coordinates to find the nearest neighbor on the surfaces (in parallel)
+        distance, index = kdtree.query(cortex_xyz, workers=workers)
+
+        # convert the indices to a surface index (reduce the white matter and pial indices to one)
+        vertex_map['{}_voxels'.format(hemi)] = voxels
+        vertex_map['{}_vertices'.format(hemi)] = index % pial_xyz.shape[0]
+        vertex_map['{}_vertex_count'.format(hemi)] = np.array(pial_xyz.shape[0])
+
+    return vertex_map
+
+
+def ribbon_source_files(subject_dir):
+    # the files the voxel to vertex map is computed from
+    return ['{}/FreeSurfer/mri/ribbon.mgz'.format(subject_dir)] + [
+        '{}/FreeSurfer/surf/{}.{}'.format(subject_dir, hemi, surface)
+        for hemi in ['lh', 'rh'] for surface in ['pial', 'white']
+    ]
+
 
-    ribbon = nib.load('{}/{}_{}/FreeSurfer/mri/ribbon.mgz'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance))
+def source_stat(source_files):
+    # modification time (ns) and size of every source file
+    return np.array([[os.stat(x).st_mtime_ns, os.stat(x).st_size] for x in source_files], dtype=np.int64)
 
-    # We'll use kdtree to store the coordinates in data structure to query for nearest neighbor
+
+def load_ribbon_vertex_map(subject_dir, cache_file, workers=-1):
+    # load the voxel to vertex map from the cache, or compute (and cache) it if the cache is missing
+    # or its source files have changed
+    stat = source_stat(ribbon_source_files(subject_dir))
+    if os.path.isfile(cache_file):
+        with np.load(cache_file) as content:
+            vertex_map = dict(content)
+        if np.array_equal(vertex_map.pop('source_stat', None), stat):
+            return vertex_map
+
+    vertex_map = compute_ribbon_vertex_map(subject_dir, workers)
+
+    # write through a temporary file (so that an interrupted run does not leave a partial cache)
+    temporary_file = '{}.{}.tmp.npz'.format(cache_file[:-len('.npz')], os.getpid())
+    np.savez(ensure_dir(temporary_file), source_stat=stat, **vertex_map)
+    os.replace(temporary_file, cache_file)
+
+    return vertex_map
+
+
+def label_volume(vertex_map, annot_labels):
+    # write the vertex labels of every hemisphere (a dictionary of label arrays) to the ribbon voxels
+    # (labels are kept as integers)
+    atlas_labels = np.zeros(np.prod(vertex_map['shape']), dtype=np.int32)
+    for hemi in ['lh', 'rh']:
+        if annot_labels[hemi].shape[0] != vertex_map['{}_vertex_count'.format(hemi)]:
+            raise ValueError('The {} annot has {} vertices, but the surface has {}.'.format(
+                hemi, annot_labels[hemi].shape[0], vertex_map['{}_vertex_count'.format(hemi)]))
+        atlas_labels[vertex_map['{}_voxels'.format(hemi)]] = annot_labels[hemi][vertex_map['{}_vertices'.format(hemi)]]
+
+    return atlas_labels.reshape(vertex_map['shape'])
+
+
+def map_subject_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, atlas_names, workers=-1):
+    # map a list of native surface atlases of a subject to native volumetric atlases
     #
-    # One kdtree per hemisphere
-
-    lh_pial_xyz = lh_pial_surf[0]
-    lh_white_xyz = lh_white_surf[0]
-    lh_xyz = np.vstack([lh_pial_xyz, lh_white_xyz])
-    lh_white_kdtree = spatial.KDTree(lh_white_xyz)
-    lh_pial_kdtree = spatial.KDTree(lh_pial_xyz)
-    lh_kdtree = spatial.KDTree(lh_xyz)
-
-    rh_pial_xyz = rh_pial_surf[0]
-    rh_white_xyz = rh_white_surf[0]
-    rh_xyz = np.vstack([rh_pial_xyz, rh_white_xyz])
-    rh_white_kdtree = spatial.KDTree(rh_white_xyz)
-    rh_pial_kdtree = spatial.KDTree(rh_pial_xyz)
-    rh_kdtree = spatial.KDTree(rh_xyz)
-
-    # create a copy of the ribbon label file to overwrite
-    atlas_labels = (ribbon.get_fdata().copy() * 0).astype(float)
-
-    # extract the indices of voxels in the cortical ribbon
-    lh_cortex_ijk = np.array(np.where(ribbon.get_fdata() == label_id['Left-Cerebral-Cortex'])).T
-    rh_cortex_ijk = np.array(np.where(ribbon.get_fdata() == label_id['Right-Cerebral-Cortex'])).T
-
-    # use the affine transformation to get to xyz coordinates of the voxels
-    lh_cortex_xyz = nib.affines.apply_affine(ribbon.header.get_vox2ras_tkr(), lh_cortex_ijk)
-    rh_cortex_xyz = nib.affines.apply_affine(ribbon.header.get_vox2ras_tkr(), rh_cortex_ijk)
-
-    # querry each voxel's coordinates to find the nearest neighbor on the surfaces (takes a few seconds)
-    lh_distance, lh_index = lh_kdtree.query(lh_cortex_xyz)
-    rh_distance, rh_index = rh_kdtree.query(rh_cortex_xyz)
-
-    # convert the indices to a surface index (reduce the white matter and pial indices to one)
-    lh_index_surf = lh_index % (lh_atlas_annot[0].shape[0])
-    rh_index_surf = rh_index % (rh_atlas_annot[0].shape[0])
-
-    # write appropriate labels from the atlas to volume
-    atlas_labels[ribbon.get_fdata() == label_id['Left-Cerebral-Cortex']] = lh_atlas_annot[0][lh_index_surf]
-    atlas_labels[ribbon.get_fdata() == label_id['Right-Cerebral-Cortex']] = rh_atlas_annot[0][rh_index_surf]
-
-    print('{}: \033[0;32m[INFO]\033[0m There are {} unique labels in volumetric atlas: {} (including ???)'.format(time_str(), len(np.unique(atlas_labels)), atlas_name))
-
-    # now write the label into a volumetric format
-    img = nib.nifti1.Nifti1Image(
-        atlas_labels,
-        ribbon.header.get_vox2ras(),
-    )
-
-    nib.save(
-        img,
-        ensure_dir('{}/subjects/{}_{}/atlases/native.{}.nii.gz'.format(temporary_dir, ukb_subject_id, ukb_instance, atlas_name))
-    )
-
-    # This next bit of code was commented out to reduce file quota
-    # # color lookup table in freesurfer format
-    # np.savetxt(
-    #     ensure_dir('{}/subjects/{}_{}/atlases/{}.ColorLUT.txt'.format(temporary_dir, ukb_subject_id, ukb_instance, atlas_name)),
-    #     np.array(
-    #         pd.DataFrame({
-    #             '#No.': np.arange(len(lh_atlas_annot[2])),
-    #             'Label Name': [x.decode('utf8') for x in lh_atlas_annot[2]],
-    #             'R': lh_atlas_annot[1][:, 0],
-    #             'G': lh_atlas_annot[1][:, 1],
-    #             'B': lh_atlas_annot[1][:, 2],
-    #             'A': lh_atlas_annot[1][:, 3],
-    #         })
-    #     ),
-    #     fmt=['%d', '%s', '%d', '%d', '%d', '%d']
-    # )
-
-    # # color lookup table to be used with the connectome workbench viewer
-    # atlas_labels = [x.decode('utf8') for x in lh_atlas_annot[2]]
-
-    # with open(ensure_dir('{}/subjects/{}_{}/atlases/{}.label_list.txt'.format(temporary_dir, ukb_subject_id, ukb_instance, atlas_name)), 'w') as label_list_file:
-    #     for i in range(1, len(lh_atlas_annot[2])):
-    #         label_list_file.write(
-    #             '{}\n{} {} {} {} {}\n'.format(
-    #                 atlas_labels[i],
-    #                 i,
-    #                 lh_atlas_annot[1][i, 0],
-    #                 lh_atlas_annot[1][i, 1],
-    #                 lh_atlas_annot[1][i, 2],
-    #                 (255 - lh_atlas_annot[1][i, 3]),
-    #             )
-    #         )
+    # returns a dictionary of the written volumetric atlas files
+    temporary_dir = "{}/data/temporary".format(main_dir)
+
+    subject_dir = '{}/{}_{}'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance)
+    atlases_dir = '{}/subjects/{}_{}/atlases'.format(temporary_dir, ukb_subject_id, ukb_instance)
+    cache_dir = '{}/subjects/{}_{}/cache'.format(temporary_dir, ukb_subject_id, ukb_instance)
+
+    # map the cortical ribbon voxels to surface vertices (only once per subject)
+    with Stage('ribbon_vertex_map', subject=ukb_subject_id, instance=ukb_instance):
+        vertex_map = load_ribbon_vertex_map(subject_dir, '{}/ribbon_vertex_map.npz'.format(cache_dir), workers)
+
+    atlas_files = {}
+    for atlas_name in atlas_names:
+        with Stage('map_surface_label_to_volume', subject=ukb_subject_id, instance=ukb_instance, atlas=atlas_name):
+            # Now let's load the surface atlas mapped to each surface
+            #
+            # each loaded object is a python tuple containing 3 elements:
+            #     1. A list of integers indicating the label of each vertex
+            #     2. A table for the color of each label (r, g, b, t, colortable array id)
+            #     3. A list names of the lables
+            atlas_annot = {
+                hemi: freesurfer.read_annot('{}/{}.native.{}.annot'.format(atlases_dir, hemi, atlas_name))
+                for hemi in ['lh', 'rh']
+            }
+
+            print('{}: \033[0;32m[INFO]\033[0m There are {} unique labels in surface atlas: {} (including ???)'.format(
+                time_str(),
+                len(np.unique(np.concatenate([atlas_annot['lh'][0], atlas_annot['rh'][0]]))),
+                atlas_name)
+            )
+
+            # write appropriate labels from the atlas to volume
+            atlas_labels = label_volume(vertex_map, {hemi: atlas_annot[hemi][0] for hemi in atlas_annot})
+
+            print('{}: \033[0;32m[INFO]\033[0m There are {} unique labels in volumetric atlas: {} (including ???)'.format(time_str(), len(np.unique(atlas_labels)), atlas_name))
+
+            # now write the label into a volumetric format
+            img = nib.nifti1.Nifti1Image(
+                atlas_labels,
+                vertex_map['affine'],
+            )
+
+            atlas_files[atlas_name] = ensure_dir('{}/native.{}.nii.gz'.format(atlases_dir, atlas_name))
+            nib.save(img, atlas_files[atlas_name])
+
+        # This next bit of code was commented out to reduce file quota
+        # # color lookup table in freesurfer format
+        # np.savetxt(
+        #     ensure_dir('{}/subjects/{}_{}/atlases/{}.ColorLUT.txt'.format(temporary_dir, ukb_subject_id, ukb_instance, atlas_name)),
+        #     np.array(
+        #         pd.DataFrame({
+        #             '#No.': np.arange(len(lh_atlas_annot[2])),
+        #             'Label Name': [x.decode('utf8') for x in lh_atlas_annot[2]],
+        #             'R': lh_atlas_annot[1][:, 0],
+        #             'G': lh_atlas_annot[1][:, 1],
+        #             'B': lh_atlas_annot[1][:, 2],
+        #             'A': lh_atlas_annot[1][:, 3],
+        #         })
+        #     ),
+        #     fmt=['%d', '%s', '%d', '%d', '%d', '%d']
+        # )
+
+        # # color lookup table to be used with the connectome workbench viewer
+        # atlas_labels = [x.decode('utf8') for x in lh_atlas_annot[2]]
+
+        # with open(ensure_dir('{}/subjects/{}_{}/atlases/{}.label_list.txt'.format(temporary_dir, ukb_subject_id, ukb_instance, atlas_name)), 'w') as label_list_file:
+        #     for i in range(1, len(lh_atlas_annot[2])):
+        #         label_list_file.write(
+        #             '{}\n{} {} {} {} {}\n'.format(
+        #                 atlas_labels[i],
+        #                 i,
+        #                 lh_atlas_annot[1][i, 0],
+        #                 lh_atlas_annot[1][i, 1],
+        #                 lh_atlas_annot[1][i, 2],
+        #                 (255 - lh_atlas_annot[1][i, 3]),
+        #             )
+        #         )
+
+    return atlas_files
+
+
+if __name__ == '__main__':
+    # sys.argv
+    main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, atlas_names = sys.argv[1:6]
+
+    # optional number of threads used for the nearest vertex query (all cores by default)
+    workers = int(sys.argv[6]) if len(sys.argv) > 6 else -1
+
+    map_subject_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, [x for x in atlas_names.split(',') if x], workers)
@@ -0,0 +1,150 @@
+# helper functions to extract parcel time-series from fMRI data (used by compute_fmri.py and
+# the compute_*_fmri.py scripts)
+#
+# The atlas is flattened once and all voxels are grouped by label, so that the mean
+# time-series of every label is computed in a single pass over the (float32) fMRI data,
+# instead of masking the whole 4D volume once per label.
+#
+# Time-series are written as gzipped csv files (fMRI.<atlas>.csv.gz) by default, or as binary
+# npz files (fMRI.<atlas>.npz) holding the label names and a float32 (labels x timepoints)
+# array, which are much faster to write and read. Either format is read back with:
+#     from parcel_timeseries import load_timeseries
+#     atlas_fmri = load_timeseries('fMRI.Glasser.npz')
+
+import os
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from atlas_labels import load_atlas_labels
+from fmri_cache import FmriCache, open_fmri_cache
+
+
+def load_fmri(fmri_file):
+    # load the 4D fMRI volume in float32 precision
+    #
+    # when UKB_FMRI_CACHE_DIR is set, the memory-mapped cache of the fMRI is opened instead (see
+    # fmri_cache.py), which can be used in place of the 4D array by the functions below
+    if os.environ.get('UKB_FMRI_CACHE_DIR'):
+        return open_fmri_cache(fmri_file, os.environ['UKB_FMRI_CACHE_DIR'])
+    return nib.load(fmri_file).get_fdata(dtype=np.float32)
+
+
+def parcel_mean_timeseries(fmri_data, atlas_data, label_indices):
+    # average the fmri signal over every label of the atlas
+    #
+    # returns an array of shape (len(label_indices), timepoints), with NaN time-series for
+    # labels without any voxels (same as np.mean over an empty selection)
+    label_indices = np.asarray(label_indices, dtype=np.intp)
+    atlas_labels = np.rint(np.asarray(atlas_data)).astype(np.intp).reshape(-1)
+
+    # row of every voxel in the output (-1 for voxels that do not belong to any of the labels)
+    label_rows = np.full(max(atlas_labels.max(), label_indices.max()) + 1, -1, dtype=np.intp)
+    label_rows[label_indices] = np.arange(label_indices.shape[0])
+    voxel_rows = label_rows[np.maximum(atlas_labels, 0)]
+    voxel_rows[atlas_labels < 0] = -1
+
+    # group the voxels of every label together
+    voxels = np.flatnonzero(voxel_rows >= 0)
+    voxels = voxels[np.argsort(voxel_rows[voxels], kind='stable')]
+    voxel_counts = np.bincount(voxel_rows[voxels], minlength=label_indices.shape[0])
+
+    # sum the time-series of all voxels of a label (accumulated in float64) in one pass
+    timeseries = np.full((label_indices.shape[0], fmri_data.shape[-1]), np.nan)
+    present = voxel_counts > 0
+    if present.any():
+        group_starts = (np.cumsum(voxel_counts) - voxel_counts)[present]
+        if isinstance(fmri_data, FmriCache):
+            # only read the voxels of the labels from the cache
+            voxel_timeseries = fmri_data.voxel_timeseries(voxels)
+        else:
+            voxel_timeseries = fmri_data.reshape(atlas_labels.shape[0], -1)[voxels]
+        timeseries[present] = np.add.reduceat(voxel_timeseries, group_starts, axis=0, dtype=np.float64)
+        timeseries[present] /= voxel_counts[present, None]
+
+    return timeseries
+
+
+def timeseries_dataframe(label_names, timeseries, index=None):
+    # tabulate the time-series of every label (one row per label, one column per timepoint)
+    return pd.concat(
+        [
+            pd.Series(list(label_names), index=index, name='label_name'),
+            pd.DataFrame(
+                timeseries,
+                index=index,
+                columns=['timepoint_{}'.format(x) for x in range(timeseries.shape[-1])],
+            )
+        ],
+        axis=1
+    )
+
+
+# file extension of every supported output format
+output_extensions = {'csv': 'csv.gz', 'npz': 'npz'}
+
+
+def save_timeseries(output_file, atlas_fmri):
+    # write out a time-series table in the format given by the file extension
+    if output_file.endswith('.npz'):
+        np.savez(
+            output_file,
+            label_name=atlas_fmri['label_name'].to_numpy(dtype=str),
+            timeseries=atlas_fmri.drop(columns='label_name').to_numpy(dtype=np.float32),
+        )
+    else:
+        atlas_fmri.to_csv(output_file, index=False)
+
+
+def load_timeseries(input_file, file_name=None):
+    # load a time-series table (label_name, timepoint_0, timepoint_1, ...) from any of the
+    # supported formats
+    #
+    # input_file can also be an open (binary) file object, e.g. a file within a zip archive, in
+    # which case the format is deduced from file_name
+    file_name = input_file if file_name is None else file_name
+    if file_name.endswith('.npz'):
+        with np.load(input_file) as content:
+            return timeseries_dataframe(content['label_name'], content['timeseries'])
+    return pd.read_csv(input_file, compression='gzip' if file_name.endswith('.gz') else None)
+
+
+def load_cortical_labels(template_dir, atlas_name):
+    # load names of all labels from the color lookup table
+    labels = load_atlas_labels(template_dir, atlas_name, 'ColorLUT')
+    return pd.DataFrame({
+        'index': labels['index'].astype(int),
+        'label_name': labels['label_name'].astype(object),
+        'R': labels['color'][:, 0].astype(int),
+        'G': labels['color'][:, 1].astype(int),
+        'B': labels['color'][:, 2].astype(int),
+        'A': labels['color'][:, 3].astype(int),
+    })
+
+
+def load_subcortical_labels(template_dir, atlas_name):
+    # load the atlas label names from txt file
+    labels = load_atlas_labels(template_dir, atlas_name, 'subcortical')
+    return pd.DataFrame({
+        'label_name': labels['label_name'].astype(object),
+        'index': labels['index'].astype(int),
+    })
+
+
+def atlas_timeseries(fmri_data, atlas_file, labels):
+    # extract label names, excluding ???
+    atlas_fmri = labels[['index', 'label_name']][labels['label_name'] != '???'].copy()
+
+    # Here, we'll average fmri signal over every label from atlas (all labels in a single pass)
+    return timeseries_dataframe(
+        atlas_fmri['label_name'],
+        parcel_mean_timeseries(fmri_data, nib.load(atlas_file).get_fdata(), atlas_fmri['index']),
+        index=atlas_fmri.index,
+    )
+
+
+def global_signal_timeseries(fmri_data, mask_file):
+    # compute the global signal (average over the brain mask)
+    return timeseries_dataframe(
+        ['global_signal'],
+        parcel_mean_timeseries(fmri_data, (nib.load(mask_file).get_fdata() == 1).astype(int), [1]),
+    )
@@ -0,0 +1,205 @@
+# script to submit the connectivity mapping of many instances as a few packed jobs
+#
+# Instead of submitting one job per instance, the instances are grouped into packed jobs that map
+# several instances one after the other, either a fixed number of instances per job, or as many
+# instances as fit in a time budget according to their estimated runtime. Runtimes of previous runs
+# are recorded (data/temporary/bulk/instance_runtimes.csv) and used to estimate the cost of every
+# instance: the last successful runtime of the same instance, or else the median of all runtimes.
+#
+# Usage:
+#     plan_job_submission.py submit <main_dir> [indices ...] [--instances_per_job N | --job_hours H]
+#                                   [--backend slurm|local|dry-run] [--array_stride K] [--command CMD]
+#                                   [--code_dir DIR] [--data_dir DIR] [--extra VALUE]
+#     plan_job_submission.py run <plan_file> <job_number>
+#
+# Instance indices (lines of the dwi,rsfc,surf,t1.combined list) are read from stdin if not given,
+# e.g. from the output of zip_completion_index.py missing. The plan is written to a json file, and
+# every packed job runs "plan_job_submission.py run" to map its instances. The slurm backend submits
+# a single job array (automate_packed.sh) running at most K jobs at once, the local backend runs the
+# jobs as subprocesses on this machine, and the dry-run backend only prints the plan.
+#
+# The default command runs UKB_connectivity_mapping_pipeline.sh with the code_dir, data_dir and extra
+# environment variables (as automate.sh). These are exported by automate_packed.sh in slurm jobs
+# (extra is its optional second argument, given by --extra), and set from --code_dir (the main
+# directory by default), --data_dir and --extra for local jobs.
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import ensure_dir, time_str
+
+
+# command executed for every instance inside a packed job ({index} is replaced by the instance
+# index, environment variables are exported by automate_packed.sh or set by the local backend)
+default_command = '"${code_dir}/scripts/bash/UKB_connectivity_mapping_pipeline.sh" "${code_dir}" "${data_dir}" {index} "${extra}"'
+
+# download directory of local jobs (the fast local storage, as in automate.sh)
+default_data_dir = '/tmp/UKB-download'
+
+# estimated runtime (in seconds) of an instance without any recorded runtime
+default_cost = 2 * 3600
+
+
+def runtimes_file(main_dir):
+    return '{}/data/temporary/bulk/instance_runtimes.csv'.format(main_dir)
+
+
+def load_runtimes(main_dir):
+    # successful runtimes of previous runs (the last one recorded for every instance)
+    runtimes = {}
+    if os.path.isfile(runtimes_file(main_dir)):
+        with open(runtimes_file(main_dir)) as runtime_records:
+            for line in runtime_records:
+                fields = line.strip().split(',')
+                if len(fields) >= 3 and fields[2] == '0':
+                    runtimes[int(fields[0])] = float(fields[1])
+    return runtimes
+
+
+def record_runtime(main_dir, index, seconds, returncode):
+    # append a single line (index, seconds, return code, date) to the runtime records
+    with open(ensure_dir(runtimes_file(main_dir)), 'a') as runtime_records:
+        runtime_records.write('{},{:.1f},{},{}\n'.format(index, seconds, returncode, time_str()))
+
+
+def estimate_costs(indices, runtimes):
+    # estimated runtime (in seconds) of every instance
+    fallback = float(np.median(list(runtimes.values()))) if len(runtimes) > 0 else default_cost
+    return [runtimes.get(index, fallback) for index in indices]
+
+
+def pack_jobs(indices, costs, instances_per_job=None, job_seconds=None):
+    # group instances into jobs, either N consecutive instances per job, or as many instances as
+    # fit in the time budget (first fit decreasing, instances exceeding the budget run alone)
+    if job_seconds is None:
+        instances_per_job = instances_per_job or 1
+        return [list(indices[i:i + instances_per_job]) for i in range(0, len(indices), instances_per_job)]
+
+    jobs = []
+    job_costs = []
+    for i in np.argsort(costs, kind='stable')[::-1]:
+        for j in range(len(jobs)):
+            if job_costs[j] + costs[i] <= job_seconds and (instances_per_job is None or len(jobs[j]) < instances_per_job):
+                jobs[j].append(indices[i])
+                job_costs[j] += costs[i]
+                break
+        else:
+            jobs.append([indices[i]])
+            job_costs.append(costs[i])
+
+    return [sorted(job) for job in sorted(jobs)]
+
+
+def slurm_time(seconds):
+    # format a duration as slurm's D-HH:MM:SS
+    seconds = int(np.ceil(seconds))
+    return '{}-{:02d}:{:02d}:{:02d}'.format(seconds // 86400, (seconds % 86400) // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def submit(main_dir, indices, instances_per_job=None, job_hours=None, backend='slurm', array_stride=None, command=default_command, time_margin=1.5,
+           code_dir=None, data_dir=default_data_dir, extra=''):
+    indices = sorted(set(indices))
+    if len(indices) == 0:
+        print('{}: \033[0;32m[INFO]\033[0m No instances to submit.'.format(time_str()))
+        return None
+
+    costs = estimate_costs(indices, load_runtimes(main_dir))
+    cost_of = dict(zip(indices, costs))
+    jobs = pack_jobs(indices, costs, instances_per_job, None if job_hours is None else job_hours * 3600)
+    job_costs = [sum(cost_of[index] for index in job) for job in jobs]
+
+    # write the plan to be read by every packed job
+    plan_file = ensure_dir('{}/data/temporary/jobs/plan_{}_{}.json'.format(main_dir, time.strftime('%Y%m%d_%H%M%S'), os.getpid()))
+    with open(plan_file, 'w') as plan:
+        json.dump({'main_dir': main_dir, 'command': command, 'jobs': jobs, 'estimated_seconds': job_costs}, plan, indent=1)
+
+    print('{}: \033[0;32m[INFO]\033[0m Planned {} instances in {} jobs (estimated {:.1f} hours per job at most): {}'.format(
+        time_str(), len(indices), len(jobs), max(job_costs) / 3600, plan_file))
+
+    if backend == 'dry-run':
+        for (job_number, job) in enumerate(jobs):
+            print('job {}: {:.1f} hours, instances {}'.format(job_number, job_costs[job_number] / 3600, ','.join(str(x) for x in job)))
+
+    elif backend == 'local':
+        # run the packed jobs as subprocesses (at most array_stride at once), with the environment
+        # variables exported by automate_packed.sh in slurm jobs
+        environment = dict(os.environ, code_dir=os.path.abspath(code_dir or main_dir), data_dir=data_dir, extra=extra)
+        os.makedirs(data_dir, exist_ok=True)
+
+        def run_job(job_number):
+            return subprocess.call([sys.executable, os.path.abspath(__file__), 'run', plan_file, str(job_number)], env=environment)
+
+        with ThreadPoolExecutor(max_workers=array_stride or 1) as executor:
+            returncodes = list(executor.map(run_job, range(len(jobs))))
+        print('{}: \033[0;32m[INFO]\033[0m {} of {} local jobs finished successfully.'.format(time_str(), returncodes.count(0), len(jobs)))
+
+    elif backend == 'slurm':
+        # a single job array with one task per packed job
+        array = '0-{}'.format(len(jobs) - 1) + ('' if array_stride is None else '%{}'.format(array_stride))
+        subprocess.check_call([
+            'sbatch',
+            '--job-name=ukb_packed',
+            '--comment=UKB mapping pipeline, {} instances in {} packed jobs'.format(len(indices), len(jobs)),
+            '--array={}'.format(array),
+            '--time={}'.format(slurm_time(max(job_costs) * time_margin)),
+            '{}/scripts/bash/automate_packed.sh'.format(main_dir),
+            plan_file,
+            extra,
+        ])
+
+    return plan_file
+
+
+def run(plan_file, job_number):
+    # map every instance of a packed job one after the other
+    with open(plan_file) as plan:
+        plan = json.load(plan)
+
+    failed = 0
+    for index in plan['jobs'][job_number]:
+        print('{}: \033[0;32m[INFO]\033[0m Packed job {}: running instance {}.'.format(time_str(), job_number, index))
+        start = time_str('raw')
+        returncode = subprocess.call(plan['command'].replace('{index}', str(index)), shell=True)
+        record_runtime(plan['main_dir'], index, time_str('raw') - start, returncode)
+        if returncode != 0:
+            print('{}: \033[0;31m[INFO]\033[0m Instance {} failed with return code {}.'.format(time_str(), index, returncode))
+            failed += 1
+
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Submit the mapping of many instances as packed jobs.')
+    subparsers = parser.add_subparsers(dest='command_name', required=True)
+
+    submit_parser = subparsers.add_parser('submit', help='plan and submit packed jobs')
+    submit_parser.add_argument('main_dir')
+    submit_parser.add_argument('indices', nargs='*', type=int, help='instance indices (read from stdin if not given)')
+    submit_parser.add_argument('--instances_per_job', type=int, default=None, help='(maximum) number of instances per job')
+    submit_parser.add_argument('--job_hours', type=float, default=None, help='pack instances up to this estimated runtime per job')
+    submit_parser.add_argument('--backend', choices=['slurm', 'local', 'dry-run'], default='slurm')
+    submit_parser.add_argument('--array_stride', type=int, default=None, help='maximum number of jobs running at once')
+    submit_parser.add_argument('--command', default=default_command, help='command run for every instance ({index} is replaced)')
+    submit_parser.add_argument('--code_dir', default=None, help='code directory of local jobs (the main directory by default)')
+    submit_parser.add_argument('--data_dir', default=default_data_dir, help='download directory of local jobs')
+    submit_parser.add_argument('--extra', default='', help='extra argument of the pipeline (delete downloads, yes by default)')
+
+    run_parser = subparsers.add_parser('run', help='run a packed job (called from within the job)')
+    run_parser.add_argument('plan_file')
+    run_parser.add_argument('job_number', type=int)
+
+    args = parser.parse_args()
+
+    if args.command_name == 'submit':
+        indices = args.indices if len(args.indices) > 0 else [int(x) for x in sys.stdin.read().split()]
+        submit(
+            args.main_dir, indices, args.instances_per_job, args.job_hours, args.backend, args.array_stride, args.command,
+            code_dir=args.code_dir, data_dir=args.data_dir, extra=args.extra,
+        )
+    else:
+        sys.exit(1 if run(args.plan_file, args.job_number) > 0 else 0)
@@ -0,0 +1,97 @@
+# script to run the python stages of the connectivity mapping of a subject in a single process
+#
+# Usage:
+#     run_subject.py <main_dir> <ukb_subjects_dir> <subject_id> <instance> <cortical_atlases> <subcortical_atlases>
+#                    [--stages volume,fmri,connectivity] [--output_format csv|npz] [--workers N]
+#
+# Atlases are given as comma separated lists of atlas names. The stages are:
+#     volume: map the native surface (cortical) atlases to native volume (map_surface_label_to_volume.py),
+#             sharing the ribbon voxel to vertex map between atlases, and resample all native cortical
+#             and subcortical atlases to the fMRI space (mri_vol2vol)
+#     fmri:   extract the fMRI time-series of all atlases and the global signal (compute_fmri.py),
+#             loading the fMRI only once
+#     connectivity: compute the functional connectivity (correlation) matrices of all atlases from
+#             the time-series (functional_connectivity.py)
+# Outputs that already exist are skipped, as in UKB_connectivity_mapping_pipeline.sh.
+#
+# The stages are also available from python, e.g.
+#     from run_subject import run_subject
+#     run_subject(main_dir, ukb_subjects_dir, subject_id, instance, ['Glasser'], ['Tian_Subcortex_S1_3T'])
+
+import os
+import argparse
+import subprocess
+from instrumentation import time_str
+from map_surface_label_to_volume import map_subject_atlases
+from compute_fmri import compute_subject_fmri
+from functional_connectivity import compute_subject_connectivity
+
+
+stages = ['volume', 'fmri', 'connectivity']
+
+
+def resample_to_fmri_space(native_atlas, fmri_space_atlas, mean_func):
+    # nearest neighbour resampling of a native atlas to the fMRI space (same as the bash pipeline)
+    subprocess.check_call([
+        'mri_vol2vol', '--mov', native_atlas, '--targ', mean_func, '--interp', 'nearest', '--regheader', '--o', fmri_space_atlas
+    ])
+
+
+def map_volume_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, cortical_atlases, subcortical_atlases, workers=-1):
+    temporary_dir = "{}/data/temporary".format(main_dir)
+    native_atlas = '{}/subjects/{}_{}/atlases/native.{{}}.nii.gz'.format(temporary_dir, ukb_subject_id, ukb_instance)
+    fmri_space_atlas = '{}/subjects/{}_{}/atlases/native.fMRI_space.{{}}.nii.gz'.format(temporary_dir, ukb_subject_id, ukb_instance)
+
+    # map all surface atlases that are not yet mapped to native volume
+    unmapped_atlases = [x for x in cortical_atlases if not os.path.isfile(native_atlas.format(x))]
+    if len(unmapped_atlases) > 0:
+        print('{}: \033[0;32m[INFO]\033[0m Mapping {} to native volume.'.format(time_str(), ','.join(unmapped_atlases)))
+        map_subject_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, unmapped_atlases, workers)
+
+    # resample all native atlases to the fmri space
+    for atlas_name in cortical_atlases + subcortical_atlases:
+        if not os.path.isfile(fmri_space_atlas.format(atlas_name)):
+            resample_to_fmri_space(
+                native_atlas.format(atlas_name),
+                fmri_space_atlas.format(atlas_name),
+                '{}/{}_{}/fMRI/rfMRI.ica/mean_func.nii.gz'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance),
+            )
+
+
+def run_subject(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, cortical_atlases, subcortical_atlases, run_stages=stages, output_format='csv', workers=-1):
+    if 'volume' in run_stages:
+        print('{}: \033[0;32m[INFO]\033[0m Mapping native atlases to native and fMRI space volumes.'.format(time_str()))
+        map_volume_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, cortical_atlases, subcortical_atlases, workers)
+
+    if 'fmri' in run_stages:
+        print('{}: \033[0;32m[INFO]\033[0m Mapping fMRI on cortical and subcortical atlases, and global signal.'.format(time_str()))
+        compute_subject_fmri(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, cortical_atlases, subcortical_atlases, output_format)
+
+    if 'connectivity' in run_stages:
+        print('{}: \033[0;32m[INFO]\033[0m Computing functional connectivity on cortical and subcortical atlases.'.format(time_str()))
+        compute_subject_connectivity(main_dir, ukb_subject_id, ukb_instance, cortical_atlases + subcortical_atlases, input_format=output_format)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the python stages of a subject in a single process.')
+    parser.add_argument('main_dir')
+    parser.add_argument('ukb_subjects_dir')
+    parser.add_argument('ukb_subject_id')
+    parser.add_argument('ukb_instance')
+    parser.add_argument('cortical_atlases', help='comma separated list of cortical (surface) atlases')
+    parser.add_argument('subcortical_atlases', help='comma separated list of subcortical (volumetric) atlases')
+    parser.add_argument('--stages', default=','.join(stages), help='comma separated list of stages to run ({})'.format(','.join(stages)))
+    parser.add_argument('--output_format', choices=['csv', 'npz'], default='csv', help='fMRI time-series output format')
+    parser.add_argument('--workers', type=int, default=-1, help='number of threads for the nearest vertex query (all cores by default)')
+    args = parser.parse_args()
+
+    run_stages = args.stages.split(',')
+    for stage in run_stages:
+        if stage not in stages:
+            parser.error('Unknown stage: {}'.format(stage))
+
+    run_subject(
+        args.main_dir, args.ukb_subjects_dir, args.ukb_subject_id, args.ukb_instance,
+        [x for x in args.cortical_atlases.split(',') if x], [x for x in args.subcortical_atlases.split(',') if x],
+        run_stages, args.output_format, args.workers,
+    )
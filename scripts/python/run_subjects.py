@@ -0,0 +1,267 @@
+# script to run the python stages of the connectivity mapping for many instances on a single node
+#
+# Usage:
+#     run_subjects.py <main_dir> <ukb_subjects_dir> <cortical_atlases> <subcortical_atlases> [--start i] [--end j]
+#                     [--stages volume,fmri,connectivity,combine,connectome] [--combinations A+B,...]
+#                     [--workers N] [--threads T] [--memory_gb M] [--output_format csv|npz]
+#                     [--streamlines 10M] [--search_radius 4] [--engine kdtree|grid]
+#
+# The instances are a slice (lines i to j, inclusive and starting from 1) of the combined subject
+# list (dwi,rsfc,surf,t1.combined), and their inputs are expected to be in place (downloaded and
+# extracted by UKB_connectivity_mapping_pipeline.sh). The stages are the stages of run_subject.py
+# along with:
+#     combine:    combine the dMRI space cortical and subcortical atlases (combine_volumetric_atlases.py)
+#                 of all combinations (every cortical + subcortical pair by default), the native atlases
+#                 that are not in dMRI space yet are first transformed by transform_atlases_to_dmri.sh
+#                 (which needs the native atlases of the volume stage, and the dMRI to T1 transform of
+#                 probabilistic_tractography_native_space.sh)
+#     connectome: map the structural connectomes (streamline count, SIFT2 weights, mean length and
+#                 mean FA) of all combined atlases in a single pass over the streamline endpoints
+#                 (tck2connectome.py), written with a distinct name (connectome_<metric>_<streamlines>.py.csv)
+#                 to the subject's python_connectomes directory, which is not archived by the pipeline
+#                 (the archived connectomes are computed with MRtrix's tck2connectome), so that the
+#                 outputs of both tools are never mixed
+# Outputs that already exist are skipped.
+#
+# Every instance is a separate task of a pool of worker processes, so that idle workers take the
+# next pending instance as soon as they are done and long instances do not hold up the others. The
+# instances are started longest first, according to the runtimes of previous runs (see
+# plan_job_submission.py). Every worker:
+#     - uses at most --threads threads for BLAS and the nearest neighbour queries (the thread count
+#       environment variables are set before the workers import numpy)
+#     - is limited to --memory_gb of memory (the data segment limit, so that memory-mapped inputs
+#       are not counted), an instance exceeding it fails without affecting the others, and the
+#       number of workers is reduced to what fits in the available memory
+# Failed instances are reported at the end (and the script exits with an error), the stage records
+# of every instance are written to the stage log as in the pipeline (see instrumentation.py), and
+# the fMRI cache is used per instance when UKB_FMRI_CACHE=yes (see fmri_cache.py).
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import traceback
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from instrumentation import read_proc_fields, ensure_dir, time_str
+from plan_job_submission import load_runtimes, estimate_costs
+from run_subject import stages as subject_stages, run_subject
+from combine_volumetric_atlases import combine_all_subject_atlases
+from tck2connectome import map_connectomes, assignment_engines
+from connectome_io import save_connectome
+
+
+stages = subject_stages + ['combine', 'connectome']
+
+# environment variables limiting the threads of numerical libraries
+thread_variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def read_subject_lines(main_dir, start=1, end=None):
+    # (line number, subject, instance) of a slice of the combined subject list
+    with open('{}/data/temporary/bulk/dwi,rsfc,surf,t1.combined'.format(main_dir)) as combined_file:
+        subject_lines = [(index, *line.split()[:2]) for (index, line) in enumerate(combined_file, 1) if line.strip()]
+    return [x for x in subject_lines if x[0] >= start and (end is None or x[0] <= end)]
+
+
+def available_memory():
+    # memory available to new processes (bytes), None if not known
+    available = read_proc_fields('/proc/meminfo', ['MemAvailable']).get('MemAvailable')
+    return None if available is None else available * 1024
+
+
+def init_worker(memory_budget):
+    # limit the memory of the worker (allocations beyond the limit raise a MemoryError)
+    if memory_budget is not None:
+        hard_limit = resource.getrlimit(resource.RLIMIT_DATA)[1]
+        if hard_limit != resource.RLIM_INFINITY:
+            memory_budget = min(memory_budget, hard_limit)
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_budget, hard_limit))
+
+
+def transform_subject_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, combinations):
+    # transform the native atlases of all combinations that are not combined yet to the dMRI space
+    # (same as map_structural_connectivity.sh)
+    temporary_dir = "{}/data/temporary".format(main_dir)
+    native_atlas = '{}/subjects/{}_{}/atlases/native.{{}}.nii.gz'.format(temporary_dir, ukb_subject_id, ukb_instance)
+    dmri_space_atlas = '{}/subjects/{}_{}/tractography/atlases/native.dMRI_space.{{}}.nii.gz'.format(temporary_dir, ukb_subject_id, ukb_instance)
+    combined_atlas_file = '{}/{}_{}/dMRI/dMRI/atlases/combinations/native.dMRI_space.{{}}+{{}}.nii.gz'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance)
+    transform_file = '{}/{}_{}/dMRI/dMRI/diff2struct_mrtrix.txt'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance)
+
+    for (atlas_1_name, atlas_2_name) in combinations:
+        if os.path.isfile(combined_atlas_file.format(atlas_1_name, atlas_2_name)):
+            continue
+        if all(os.path.isfile(dmri_space_atlas.format(x)) for x in [atlas_1_name, atlas_2_name]):
+            continue
+
+        missing = [x for x in [native_atlas.format(atlas_1_name), native_atlas.format(atlas_2_name), transform_file] if not os.path.isfile(x)]
+        if len(missing) > 0:
+            raise FileNotFoundError(
+                'Cannot transform {} and {} to the dMRI space, missing: {} (native atlases are written by the volume stage, '
+                'and the dMRI to T1 transform by probabilistic_tractography_native_space.sh).'.format(atlas_1_name, atlas_2_name, ', '.join(missing))
+            )
+
+        print('{}: \033[0;32m[INFO]\033[0m Transforming {} and {} to the dMRI space.'.format(time_str(), atlas_1_name, atlas_2_name))
+        subprocess.check_call([
+            '{}/scripts/bash/transform_atlases_to_dmri.sh'.format(main_dir),
+            main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, atlas_1_name, atlas_2_name,
+        ])
+
+
+def map_subject_connectomes(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, combinations, streamlines='10M', search_radius=4, engine='kdtree', threads=1):
+    # map the structural connectomes of all combined atlases of an instance from its endpoints
+    temporary_dir = "{}/data/temporary".format(main_dir)
+    tractography_dir = '{}/subjects/{}_{}/tractography'.format(temporary_dir, ukb_subject_id, ukb_instance)
+    combined_atlas_file = '{}/{}_{}/dMRI/dMRI/atlases/combinations/native.dMRI_space.{{}}.nii.gz'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance)
+    connectome_file = '{}/subjects/{}_{}/python_connectomes/'.format(temporary_dir, ukb_subject_id, ukb_instance) + '{combination}/connectome_{metric}_' + streamlines + '.py.csv'
+
+    # combinations that are not mapped yet
+    combination_names = [
+        '{}+{}'.format(atlas_1_name, atlas_2_name) for (atlas_1_name, atlas_2_name) in combinations
+        if not os.path.isfile(connectome_file.replace('{combination}', '{}+{}'.format(atlas_1_name, atlas_2_name)).replace('{metric}', 'streamline_count'))
+    ]
+    if len(combination_names) == 0:
+        return
+
+    print('{}: \033[0;32m[INFO]\033[0m Mapping structural connectomes on {}.'.format(time_str(), ','.join(combination_names)))
+    endpoints = np.load('{}/endpoints/tracks_{}_endpoints.npy'.format(tractography_dir, streamlines), mmap_mode='r')
+    weights = ('sift2_fbc', np.load('{}/metrics/sift_weights.npy'.format(tractography_dir), mmap_mode='r'))
+    scales = {
+        'mean_length': np.load('{}/metrics/streamline_metric_length.npy'.format(tractography_dir), mmap_mode='r'),
+        'mean_FA': np.load('{}/metrics/streamline_metric_FA_mean.npy'.format(tractography_dir), mmap_mode='r'),
+    }
+
+    atlas_connectomes = map_connectomes(
+        [combined_atlas_file.format(x) for x in combination_names], endpoints, search_radius, engine, weights, scales, workers=threads
+    )
+    for (combination_name, connectomes) in zip(combination_names, atlas_connectomes):
+        for (metric, adj) in connectomes.items():
+            save_connectome(ensure_dir(connectome_file.replace('{combination}', combination_name).replace('{metric}', metric)), adj, combination_name, metric)
+
+
+def run_instance(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, cortical_atlases, subcortical_atlases, combinations, run_stages, options):
+    # run the stages of an instance in a worker (returns the runtime, and the error if it failed)
+    start = time.time()
+
+    # stage records and fMRI cache of the instance (as exported by the pipeline)
+    os.environ['UKB_SUBJECT_ID'] = ukb_subject_id
+    os.environ['UKB_INSTANCE'] = ukb_instance
+    if os.environ.get('UKB_FMRI_CACHE', 'no') == 'yes':
+        os.environ['UKB_FMRI_CACHE_DIR'] = '{}/{}_{}/fmri_cache'.format(ukb_subjects_dir, ukb_subject_id, ukb_instance)
+    else:
+        os.environ.pop('UKB_FMRI_CACHE_DIR', None)
+
+    error = None
+    try:
+        run_subject(
+            main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, cortical_atlases, subcortical_atlases,
+            [x for x in run_stages if x in subject_stages], options['output_format'], options['threads'],
+        )
+        if 'combine' in run_stages:
+            transform_subject_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, combinations)
+            combine_all_subject_atlases(main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, combinations)
+        if 'connectome' in run_stages:
+            map_subject_connectomes(
+                main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance, combinations,
+                options['streamlines'], options['search_radius'], options['engine'], options['threads'],
+            )
+    except Exception:
+        # (including memory errors when exceeding the memory budget)
+        error = traceback.format_exc()
+    finally:
+        if 'UKB_FMRI_CACHE_DIR' in os.environ:
+            shutil.rmtree(os.environ['UKB_FMRI_CACHE_DIR'], ignore_errors=True)
+
+    return time.time() - start, error
+
+
+def run_subjects(main_dir, ukb_subjects_dir, subject_lines, cortical_atlases, subcortical_atlases, combinations, run_stages=stages, workers=4, threads=1, memory_budget=None, **options):
+    # run the stages of all instances in a process pool (returns the line numbers of failed instances)
+    options = dict({'output_format': 'csv', 'streamlines': '10M', 'search_radius': 4, 'engine': 'kdtree'}, threads=threads, **options)
+
+    # only run as many workers as fit in the available memory
+    memory = available_memory()
+    if memory_budget is not None and memory is not None and workers * memory_budget > memory:
+        workers = max(1, int(memory // memory_budget))
+        print('{}: \033[0;32m[INFO]\033[0m Reduced to {} workers to fit in the available memory.'.format(time_str(), workers))
+
+    # longest instances first (estimated from previous runtimes)
+    costs = estimate_costs([x[0] for x in subject_lines], load_runtimes(main_dir))
+    subject_lines = [subject_lines[i] for i in np.argsort(costs, kind='stable')[::-1]]
+
+    # the thread counts are inherited by the (spawned) workers, and read when they import numpy
+    for variable in thread_variables:
+        os.environ[variable] = str(threads)
+
+    print('{}: \033[0;32m[INFO]\033[0m Running {} instances on {} workers ({} threads each).'.format(time_str(), len(subject_lines), workers, threads))
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker, initargs=(memory_budget,)) as executor:
+        # one task per instance, started in order by the first idle worker
+        futures = {
+            executor.submit(
+                run_instance, main_dir, ukb_subjects_dir, ukb_subject_id, ukb_instance,
+                cortical_atlases, subcortical_atlases, combinations, run_stages, options,
+            ): (index, ukb_subject_id, ukb_instance)
+            for (index, ukb_subject_id, ukb_instance) in subject_lines
+        }
+        for (completed, future) in enumerate(as_completed(futures), 1):
+            index, ukb_subject_id, ukb_instance = futures[future]
+            try:
+                seconds, error = future.result()
+            except Exception as worker_error:
+                # the worker was terminated (e.g. killed when running out of memory)
+                seconds, error = None, repr(worker_error)
+
+            if error is None:
+                print('{}: \033[0;32m[INFO]\033[0m Completed {}_{} in {:.1f} seconds ({} of {}).'.format(time_str(), ukb_subject_id, ukb_instance, seconds, completed, len(futures)))
+            else:
+                failed.append(index)
+                print('{}: \033[0;31m[ERROR]\033[0m {}_{} failed ({} of {}):\n{}'.format(time_str(), ukb_subject_id, ukb_instance, completed, len(futures), error))
+
+    return sorted(failed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the python stages of many instances with a process pool.')
+    parser.add_argument('main_dir')
+    parser.add_argument('ukb_subjects_dir')
+    parser.add_argument('cortical_atlases', help='comma separated list of cortical (surface) atlases')
+    parser.add_argument('subcortical_atlases', help='comma separated list of subcortical (volumetric) atlases')
+    parser.add_argument('--start', type=int, default=1, help='first line of the combined subject list (inclusive)')
+    parser.add_argument('--end', type=int, default=None, help='last line of the combined subject list (inclusive)')
+    parser.add_argument('--stages', default=','.join(stages), help='comma separated list of stages to run ({})'.format(','.join(stages)))
+    parser.add_argument('--combinations', default=None, help='comma separated list of <cortical>+<subcortical> combinations (all pairs by default)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=1, help='number of threads of every worker')
+    parser.add_argument('--memory_gb', type=float, default=None, help='memory budget of every worker (GB)')
+    parser.add_argument('--output_format', choices=['csv', 'npz'], default='csv', help='fMRI time-series output format')
+    parser.add_argument('--streamlines', default='10M', help='number of streamlines (in the tractography file names)')
+    parser.add_argument('--search_radius', type=float, default=4, help='assignment radial search distance (mm)')
+    parser.add_argument('--engine', choices=sorted(assignment_engines), default='kdtree', help='endpoint assignment engine')
+    args = parser.parse_args()
+
+    run_stages = args.stages.split(',')
+    for stage in run_stages:
+        if stage not in stages:
+            parser.error('Unknown stage: {}'.format(stage))
+
+    cortical_atlases = [x for x in args.cortical_atlases.split(',') if x]
+    subcortical_atlases = [x for x in args.subcortical_atlases.split(',') if x]
+    combinations = [
+        (atlas_1_name, atlas_2_name) for atlas_1_name in cortical_atlases for atlas_2_name in subcortical_atlases
+        if args.combinations is None or '{}+{}'.format(atlas_1_name, atlas_2_name) in args.combinations.split(',')
+    ]
+
+    failed = run_subjects(
+        args.main_dir, args.ukb_subjects_dir, read_subject_lines(args.main_dir, args.start, args.end),
+        cortical_atlases, subcortical_atlases, combinations, run_stages, args.workers, args.threads,
+        None if args.memory_gb is None else int(args.memory_gb * 2 ** 30),
+        output_format=args.output_format, streamlines=args.streamlines, search_radius=args.search_radius, engine=args.engine,
+    )
+    if len(failed) > 0:
+        print('{}: \033[0;31m[ERROR]\033[0m {} instances failed: {}'.format(time_str(), len(failed), ','.join(str(x) for x in failed)))
+        sys.exit(1)
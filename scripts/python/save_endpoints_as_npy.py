@@ -1,11 +1,19 @@
 # script made from notebook codes to save MRtrix endpoint tractography file as float16 NPY binaries
+#
+# The tck file is streamed in fixed size chunks, and only the first and last point of every
+# streamline are written to a preallocated (N, 2, 3) float16 memory-mapped npy file, so that
+# memory usage is bounded regardless of the number of streamlines.
 
 import os
 import sys
 import time
 import datetime
 import numpy as np
-import nibabel as nib
+from instrumentation import Stage
+
+
+# number of points read from the tck file at once
+chunk_points = 2 ** 20
 
 
 def ensure_dir(file_name):
@@ -22,13 +30,98 @@ def time_str(mode='abs', base=None):
         return time.asctime(time.localtime(time.time()))
 
 
+def read_tck_header(input_file):
+    # read the key: value pairs of the tck text header (up to the END line)
+    header = {}
+    with open(input_file, 'rb') as tck_file:
+        if tck_file.readline().strip() != b'mrtrix tracks':
+            raise ValueError('"{}" is not an MRtrix tck file.'.format(input_file))
+        for line in tck_file:
+            line = line.decode('utf8').strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            header[key.strip()] = value.strip()
+
+    dtypes = {'Float32LE': '<f4', 'Float32BE': '>f4', 'Float64LE': '<f8', 'Float64BE': '>f8'}
+
+    return {
+        'offset': int(header['file'].split()[-1]),
+        'dtype': np.dtype(dtypes[header['datatype']]),
+        'count': int(header['count']) if header.get('count', '').isdigit() else None,
+    }
+
+
+def read_tck_chunks(input_file, header):
+    # iterate over chunks of (n, 3) points of a tck file (streamlines are delimited by NaN
+    # points, and the file ends with an infinite point)
+    with open(input_file, 'rb') as tck_file:
+        tck_file.seek(header['offset'])
+        while True:
+            points = np.fromfile(tck_file, dtype=header['dtype'], count=3 * chunk_points).reshape(-1, 3)
+            if points.shape[0] == 0:
+                return
+            finished = np.isinf(points[:, 0])
+            if finished.any():
+                yield points[:np.argmax(finished)]
+                return
+            yield points
+
+
+def iterate_endpoints(input_file, header):
+    # iterate over chunks of (n, 2, 3) streamline endpoints of a tck file
+    pending = np.empty((0, 3), dtype=header['dtype'])
+    for points in read_tck_chunks(input_file, header):
+        points = np.concatenate([pending, points])
+        delimiters = np.flatnonzero(np.isnan(points[:, 0]))
+        if delimiters.size == 0:
+            # keep the first and last point of a streamline that continues in the next chunk
+            pending = points[[0, -1]] if points.shape[0] > 1 else points
+            continue
+
+        # first and last points of the streamlines that are completed in this chunk
+        starts = np.concatenate([[0], delimiters[:-1] + 1])
+        ends = delimiters - 1
+        yield np.stack([points[starts], points[ends]], axis=1)
+
+        pending = points[delimiters[-1] + 1:]
+        pending = pending[[0, -1]] if pending.shape[0] > 1 else pending
+
+    if pending.shape[0] > 0:
+        yield pending[[0, -1]][None, :, :]
+
+
+def save_endpoints(input_file, output_file):
+    # save the endpoints of all streamlines of a tck file to a float16 npy file
+    #
+    # returns the number of streamlines
+    with Stage('save_endpoints_as_npy'):
+        header = read_tck_header(input_file)
+
+        # count the streamlines if the header does not (reliably) report it
+        streamline_count = header['count']
+        if streamline_count is None:
+            streamline_count = sum(x.shape[0] for x in iterate_endpoints(input_file, header))
+
+        # write the endpoints directly into a memory-mapped npy (float16 precision)
+        endpoints = np.lib.format.open_memmap(ensure_dir(output_file), mode='w+', dtype=np.float16, shape=(streamline_count, 2, 3))
+        written = 0
+        for chunk in iterate_endpoints(input_file, header):
+            endpoints[written:written + chunk.shape[0]] = chunk.astype(np.float16)
+            written += chunk.shape[0]
+        endpoints.flush()
+        del endpoints
+
+    if written != streamline_count:
+        raise ValueError('Expected {} streamlines in "{}", found {}.'.format(streamline_count, input_file, written))
+
+    return written
+
+
 if __name__ == '__main__':
     # sys.argv
     input_file, output_file = sys.argv[1:]
 
-    # read metric
-    endpoints = nib.streamlines.load(input_file)
-    arr = np.array(endpoints.streamlines)
+    written = save_endpoints(input_file, output_file)
 
-    # write as npy (float16 precision)
-    np.save(ensure_dir(output_file), arr.astype(np.float16))
+    print('{}: \033[0;32m[INFO]\033[0m Saved the endpoints of {} streamlines to "{}".'.format(time_str(), written, output_file))
@@ -0,0 +1,68 @@
+# script to summarize the stage records (json lines written through instrumentation.py) across
+# subjects, showing where the compute budget of the cohort is spent
+#
+# Usage:
+#     stage_report.py <stage_log> [<stage_log> ...] [--by stage,atlas] [--output report.csv]
+#
+# For every group (by default every stage), the report lists the number of records and subjects, the
+# total wall and cpu hours along with their share of the total wall time, the median and 95th
+# percentile wall time, the largest peak memory, and the total bytes read and written.
+
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+
+def load_records(stage_logs):
+    # read all records from the stage logs (lines that can not be parsed, e.g. from jobs killed
+    # while writing, are skipped)
+    records = []
+    for stage_log in stage_logs:
+        with open(stage_log) as log_file:
+            for line in log_file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return pd.DataFrame.from_records(records)
+
+
+def summarize(records, by=('stage',)):
+    by = list(by)
+    records = records.copy()
+    for column in by:
+        records[column] = records[column].fillna('-') if column in records else '-'
+    records['subject_instance'] = records['subject'].astype(str) + '_' + records['instance'].astype(str)
+
+    report = records.groupby(by).agg(
+        records=('wall_seconds', 'size'),
+        subjects=('subject_instance', 'nunique'),
+        failed=('failed', 'sum'),
+        wall_hours=('wall_seconds', lambda x: x.sum() / 3600),
+        cpu_hours=('cpu_seconds', lambda x: x.sum() / 3600),
+        median_wall_seconds=('wall_seconds', 'median'),
+        p95_wall_seconds=('wall_seconds', lambda x: np.percentile(x, 95)),
+        max_peak_rss_gb=('peak_rss_bytes', lambda x: x.max() / 2 ** 30),
+        read_gb=('bytes_read', lambda x: x.sum() / 2 ** 30),
+        written_gb=('bytes_written', lambda x: x.sum() / 2 ** 30),
+    )
+    report.insert(3, 'wall_share', report['wall_hours'] / report['wall_hours'].sum())
+
+    return report.sort_values('wall_hours', ascending=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the stage records across subjects.')
+    parser.add_argument('stage_logs', nargs='+', help='json lines files written by instrumentation.py')
+    parser.add_argument('--by', default='stage', help='comma separated fields to group the records by (e.g. stage,atlas)')
+    parser.add_argument('--output', default=None, help='optionally write the report to a csv file')
+    args = parser.parse_args()
+
+    report = summarize(load_records(args.stage_logs), args.by.split(','))
+
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 250, 'display.float_format', '{:.3f}'.format):
+        print(report)
+
+    if args.output is not None:
+        report.to_csv(args.output)
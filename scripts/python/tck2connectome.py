@@ -1,72 +1,463 @@
 # script made from the notebook codes
+#
+# Usage:
+#     tck2connectome.py <atlas_file> <endpoint_file> <output_file> <search_radius> [--engine kdtree|grid] [--dropped_file dropped.csv]
+#
+# Weighted and scaled connectomes (similar to -tck_weights_in, -scale_file and -stat_edge mean)
+# are computed from the same endpoint assignment as the streamline count, e.g.
+#     tck2connectome.py <atlas_file> <endpoint_file> connectome_{metric}_10M.csv 4 \
+#         --weights sift2_fbc sift_weights.npy \
+#         --scale mean_length streamline_metric_length.npy \
+#         --scale mean_FA streamline_metric_FA_mean.npy
+# the {metric} placeholder of the output is replaced by streamline_count and the given names.
+#
+# Connectomes are written as dense csv files, or in a compact sparse binary format when the
+# output file ends with .npz (see connectome_io.py for the format and a reader).
+#
+# Batch mode: several atlases can be mapped from a single endpoint file by passing
+# comma separated lists of atlases and output files (one output per atlas), e.g.
+#     tck2connectome.py <atlas_1>,<atlas_2> <endpoint_file> <output_1>,<output_2> <search_radius>
+# the endpoints are then only loaded (and converted) once for all atlases.
+#
+# Radius sweep: a comma separated list of search radii (e.g. 2,3,4,5) gives one connectome per
+# radius (the output files need a {radius} placeholder) from a single nearest labelled voxel query
+# at the largest radius and a single accumulation pass, as a streamline assigned at a radius is
+# assigned to the same edge at any larger radius. The number of streamlines dropped at every radius
+# (an endpoint further than the radius from all labels) is printed and can be written to a csv file.
+#
+# Endpoints are memory-mapped and processed in chunks of streamlines (--chunk_size), which
+# can be queried by several threads in parallel (--workers), keeping memory usage flat.
+#
+# Assignment engines (both assign an endpoint to the nearest labelled voxel within the
+# search radius, similar to MRtrix's -assignment_radial_search):
+#     kdtree: nearest neighbor queries on a kdtree built from all labelled voxels
+#     grid:   endpoints are mapped to voxel space with the inverse affine and resolved
+#             through a precomputed radial search lookup, listing for every voxel the few
+#             labelled voxels that can be nearest to a point inside it (no kdtree, and no
+#             arrays for the whole volume: the lookup covers the bounding box of the labelled
+#             voxels), the lookup takes longer and more memory to build than the kdtree (about 3
+#             seconds and 180 MB for a conformed 256^3 atlas) but is queried several times faster
 
-import sys
+import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy import spatial
+from scipy import ndimage
 import nibabel as nib
+from connectome_io import atlas_name, save_connectome
+from instrumentation import Stage
 
 
-if __name__ == '__main__':
-    # sys.argv
-    atlas_file, endpoint_file, output_file, search_radius = sys.argv[1:]
+# default number of streamlines processed at once
+default_chunk_size = 2 ** 18
+
+
+def iterate_chunks(endpoints, chunk_size, *per_streamline_values):
+    # iterate over chunks of streamline start and end points (converted once per chunk for all
+    # atlases) along with the matching chunks of any per streamline values
+    for start in range(0, endpoints.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        yield (
+            endpoints[chunk, 0, :].astype(np.float64),
+            endpoints[chunk, -1, :].astype(np.float64),
+            *[None if x is None else x[chunk].astype(np.float64) for x in per_streamline_values],
+        )
+
+
+class KDTreeAssignment:
+    # nearest labelled voxel lookup using a kdtree of labelled voxel coordinates
+
+    def __init__(self, atlas_data, affine):
+        # only select voxels with a label greater than zero (no whole volume coordinate grid)
+        selection_ijk = np.argwhere(atlas_data > 0)
+        selection_xyz = nib.affines.apply_affine(affine, selection_ijk)
+
+        # label of every kdtree point
+        self.labels = atlas_data[tuple(selection_ijk.T)]
+
+        # build a kdtree for spatial proximity queries
+        self.kdtree = spatial.cKDTree(selection_xyz)
+
+    def query(self, points, search_radius):
+        # query for closest coordinate from selection
+        dists, indices = self.kdtree.query(points)
+        labels = self.labels[indices]
+        labels[dists >= search_radius] = 0
+
+        return dists, labels
+
+
+class GridAssignment:
+    # nearest labelled voxel lookup using the regular voxel grid of the atlas (radial search)
+
+    def __init__(self, atlas_data, affine):
+        self.atlas_data = atlas_data
+        self.affine = affine
+        self.voxel_sizes = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+        self.half_diagonal = np.max(np.linalg.norm(np.array(list(itertools.product((-0.5, 0.5), repeat=3))) @ affine[:3, :3].T, axis=1))
+
+        # sampling of the distance transform: the voxel sizes if the voxel axes are orthogonal,
+        # otherwise the smallest singular value of the affine (distances on a sheared grid are
+        # underestimated, so that no voxel within reach is missed)
+        gram = affine[:3, :3].T @ affine[:3, :3]
+        if np.allclose(gram, np.diag(np.diag(gram))):
+            self.sampling = self.voxel_sizes
+        else:
+            self.sampling = np.full(3, np.linalg.svd(affine[:3, :3], compute_uv=False).min())
+
+        # radial search lookups (one per search radius)
+        self.lookups = {}
+
+    def radial_offsets(self, max_distance):
+        # voxel offsets within a maximum distance (mm), sorted from the closest outwards
+        extent = np.ceil(max_distance / self.voxel_sizes).astype(int)
+        offsets = np.array(list(itertools.product(*[range(-x, x + 1) for x in extent])))
+        offset_dists = np.linalg.norm(offsets @ self.affine[:3, :3].T, axis=1)
+        order = np.argsort(offset_dists, kind='stable')
+        selection = offset_dists[order] <= max_distance
+
+        return offsets[order][selection], offset_dists[order][selection]
+
+    def lookup(self, search_radius):
+        # For every voxel, the list of labelled voxels that can be the nearest label of a point
+        # inside that voxel (within the search radius), stored in a compressed sparse row layout.
+        if search_radius in self.lookups:
+            return self.lookups[search_radius]
+
+        max_distance = search_radius + self.half_diagonal
+        offsets, offset_dists = self.radial_offsets(max_distance)
+
+        # crop the grid to the bounding box of the labelled voxels, padded so that endpoints outside
+        # of the grid are out of reach, and the neighbors of voxels within reach never fall outside
+        # of the grid (no arrays of the whole volume)
+        padding = np.ceil(max_distance / self.sampling).astype(int) + np.abs(offsets).max(axis=0)
+        labelled = self.atlas_data > 0
+        labelled_axes = [np.flatnonzero(np.any(labelled, axis=tuple(x for x in range(3) if x != axis))) for axis in range(3)]
+        lower = np.array([x[0] for x in labelled_axes])
+        upper = np.array([x[-1] + 1 for x in labelled_axes])
+        del labelled
+        labels = np.pad(self.atlas_data[tuple(slice(x, y) for (x, y) in zip(lower, upper))], [(x, x) for x in padding])
+        shape = labels.shape
+        labels = labels.reshape(-1)
+        affine = self.affine @ nib.affines.from_matvec(np.eye(3), lower - padding)
+        strides = np.array([shape[1] * shape[2], shape[2], 1])
+        offset_voxels = (offsets @ strides).astype(np.int32)
+
+        # nearest labelled voxel (and its distance in mm) of every voxel centre, only voxels with a
+        # labelled voxel within reach need a lookup
+        label_distance, nearest_ijk = ndimage.distance_transform_edt(
+            labels.reshape(shape) == 0,
+            sampling=self.sampling,
+            return_indices=True,
+        )
+        voxels = np.flatnonzero(label_distance.reshape(-1) < max_distance).astype(np.int32)
+        del label_distance
+        nearest_offsets = nearest_ijk.reshape(3, -1)[:, voxels].T - np.array(np.unravel_index(voxels, shape), dtype=np.int32).T
+        del nearest_ijk
+        nearest = voxels + (nearest_offsets @ strides).astype(np.int32)
+        nearest_xyz = nearest_offsets @ self.affine[:3, :3].T
+        nearest_sq_dists = np.sum(nearest_xyz ** 2, axis=1)
+        del nearest_offsets
+
+        # a labelled voxel is a candidate if it is closer than the nearest labelled voxel of the
+        # voxel centre for some point of the voxel (tested on the voxel corners), which requires
+        # the offset to be less than two half diagonals further than that nearest labelled voxel
+        # (with a margin for rounding errors):
+        # voxels are sorted from the furthest from a label, so that only a leading slice of them is
+        # tested for every offset, and only the rows of the voxels for which an offset is a
+        # candidate are kept (no voxels by offsets arrays)
+        order = np.argsort(-nearest_sq_dists, kind='stable')
+        voxels, nearest, nearest_sq_dists = voxels[order], nearest[order], nearest_sq_dists[order]
+        nearest_projections = [x[order] for x in (nearest_xyz @ self.affine[:3, :3]).T]
+        del order, nearest_xyz
+        labelled = labels > 0
+        min_dists = offset_dists - 2 * self.half_diagonal - 1e-6
+        tested = np.where(min_dists < 0, voxels.size, np.searchsorted(-nearest_sq_dists, -min_dists ** 2, side='left'))
+        candidate_rows = []
+        row_counts = np.ones(voxels.size, dtype=np.int32)
+        for (offset, offset_voxel, rows_tested) in zip(offsets, offset_voxels, tested):
+            # (squared offset distance from the coordinates, so that ties at the voxel corners are
+            # not counted as candidates because of rounding errors)
+            offset_xyz = self.affine[:3, :3] @ offset
+            offset_sq_dist = np.sum(offset_xyz ** 2)
+            offset_projection = offset_xyz @ self.affine[:3, :3]
+            rows = np.flatnonzero(labelled[voxels[:rows_tested] + offset_voxel]).astype(np.int32)
+            corner_sums = np.abs(nearest_projections[0][rows] - offset_projection[0])
+            for axis in (1, 2):
+                corner_sums += np.abs(nearest_projections[axis][rows] - offset_projection[axis])
+            rows = rows[(offset_sq_dist - nearest_sq_dists[rows]) < corner_sums]
+            candidate_rows.append(rows)
+            row_counts[rows] += 1
+        del nearest_projections, nearest_sq_dists, labelled
+
+        # candidates of voxel v are candidates[pointers[v]:pointers[v + 1]]
+        index_dtype = np.int32 if row_counts.sum(dtype=np.int64) < 2 ** 31 else np.int64
+        pointers = np.zeros(labels.size + 1, dtype=index_dtype)
+        pointers[voxels + 1] = row_counts
+        np.cumsum(pointers, out=pointers)
+
+        # the nearest labelled voxel of the voxel centre is always the first candidate, followed by
+        # the candidate offsets from the closest outwards
+        candidate_voxels = np.empty(pointers[-1], dtype=np.int32)
+        candidate_voxels[pointers[voxels]] = nearest
+        fill = pointers[voxels] + 1
+        for (offset_voxel, rows) in zip(offset_voxels, candidate_rows):
+            candidate_voxels[fill[rows]] = voxels[rows] + offset_voxel
+            fill[rows] += 1
+        del candidate_rows, fill
+
+        candidate_xyz = np.empty((3, candidate_voxels.size))
+        candidate_ijk = np.unravel_index(candidate_voxels, shape)
+        for axis in range(3):
+            candidate_xyz[axis] = affine[axis, 3]
+            for i in range(3):
+                candidate_xyz[axis] += affine[axis, i] * candidate_ijk[i]
+        del candidate_ijk
+
+        self.lookups[search_radius] = {
+            'shape': np.array(shape),
+            'inverse_affine': np.linalg.inv(affine),
+            'pointers': pointers,
+            'candidate_xyz': candidate_xyz,
+            'candidate_labels': labels[candidate_voxels],
+        }
+
+        return self.lookups[search_radius]
+
+    def query(self, points, search_radius):
+        lookup = self.lookup(search_radius)
+        dists = np.full(points.shape[0], np.inf)
+        labels = np.zeros(points.shape[0], dtype=self.atlas_data.dtype)
 
+        # map the endpoints to the closest voxel of the (cropped) grid
+        voxels_ijk = np.round(nib.affines.apply_affine(lookup['inverse_affine'], points)).astype(np.intp)
+        inside = np.flatnonzero(np.all((voxels_ijk >= 0) & (voxels_ijk < lookup['shape']), axis=1))
+        voxels = np.ravel_multi_index(tuple(voxels_ijk[inside].T), tuple(lookup['shape']))
+        counts = lookup['pointers'][voxels + 1] - lookup['pointers'][voxels]
+        inside, voxels, counts = inside[counts > 0], voxels[counts > 0], counts[counts > 0].astype(np.intp)
+        if inside.size == 0:
+            return dists, labels
+
+        # distances to all candidates of every endpoint
+        first = np.cumsum(counts) - counts
+        candidates = np.repeat(lookup['pointers'][voxels] - first, counts) + np.arange(first[-1] + counts[-1])
+        candidate_sq_dists = np.zeros(candidates.size)
+        for axis in range(3):
+            candidate_sq_dists += (np.repeat(points[inside, axis], counts) - lookup['candidate_xyz'][axis][candidates]) ** 2
+
+        # select the (first) closest candidate of every endpoint
+        closest_sq_dists = np.minimum.reduceat(candidate_sq_dists, first)
+        closest = np.flatnonzero(candidate_sq_dists == np.repeat(closest_sq_dists, counts))
+        closest = closest[np.searchsorted(closest, first)]
+
+        dists[inside] = np.sqrt(closest_sq_dists)
+        labels[inside] = lookup['candidate_labels'][candidates[closest]]
+        labels[dists >= search_radius] = 0
+
+        return dists, labels
+
+
+assignment_engines = {
+    'kdtree': KDTreeAssignment,
+    'grid': GridAssignment,
+}
+
+
+class Connectome:
     # This code performs a pythonic immitation of tck2connectome
+    #
+    # Connectomes of an atlas are accumulated over chunks of streamlines: the streamline count,
+    # the sum of streamline weights (e.g. SIFT2 weights) and the (weighted) mean of every
+    # streamline scale (e.g. mean length), all from the same endpoint assignment.
+    #
+    # search_radius can also be a list of radii: every streamline is then accumulated once, at the
+    # smallest radius that assigns it (its level), and the sums of all larger radii are cumulative.
 
-    # load the atlas file
-    atlas = nib.load(atlas_file)
+    def __init__(self, atlas_file, search_radius, engine='kdtree'):
+        # load the atlas file
+        atlas = nib.load(atlas_file)
+        atlas_data = np.asarray(atlas.dataobj).astype(int)
 
-    # load the tractography endpoint information
-    endpoints = np.load(endpoint_file)
+        # build the nearest labelled voxel lookup (queried at the largest radius)
+        self.assignment = assignment_engines[engine](atlas_data, atlas.affine)
+        self.search_radii = np.sort(np.atleast_1d(search_radius).astype(float))
+        self.search_radius = self.search_radii[-1]
 
-    # extract the coordinates information from NIFTI atlas
-    node_indices = np.arange(np.prod(atlas.shape)).reshape(atlas.shape)
+        # number of regions/nodes
+        self.node_count = atlas_data.max()
 
-    ind_i, ind_j, ind_k = np.meshgrid(
-        np.arange(atlas.shape[0]),
-        np.arange(atlas.shape[1]),
-        np.arange(atlas.shape[2]), indexing='ij',
-    )
+        # (non-symmetric) sums over all edges of every level, and the number of streamlines per
+        # level (the last level counts the streamlines dropped at all radii)
+        self.sums = {}
+        self.weights_name = None
+        self.level_counts = np.zeros(self.search_radii.shape[0] + 1, dtype=np.int64)
+
+    def assign(self, starts, ends):
+        # query for closest labelled voxel
+        start_dists, start_labels = self.assignment.query(starts, self.search_radius)
+        end_dists, end_labels = self.assignment.query(ends, self.search_radius)
+
+        # level of every streamline: the number of radii at which an endpoint is further than the
+        # search radius from all selection coordinates (streamlines dropped at all radii are masked)
+        levels = np.searchsorted(self.search_radii, np.maximum(start_dists, end_dists), side='right')
+        distance_mask = levels < self.search_radii.shape[0]
+
+        # edge of every valid streamline (at its level) according to the search radius
+        edges = (
+            levels[distance_mask] * self.node_count ** 2 +
+            (start_labels[distance_mask] - 1) * self.node_count + (end_labels[distance_mask] - 1)
+        )
+
+        return edges, distance_mask, np.bincount(levels, minlength=self.level_counts.shape[0])
+
+    def add(self, name, edges, values=None):
+        edge_sums = np.bincount(edges, weights=values, minlength=self.search_radii.shape[0] * self.node_count ** 2)
+        if name in self.sums:
+            self.sums[name] += edge_sums
+        else:
+            self.sums[name] = edge_sums.astype(np.float64)
 
-    node_ijk = np.array([ind_i.reshape(-1), ind_j.reshape(-1), ind_k.reshape(-1)]).T
+    def accumulate(self, assigned, weights=None, weights_name=None, scales=None):
+        edges, distance_mask, level_counts = assigned
 
-    node_xyz = nib.affines.apply_affine(atlas.affine, node_ijk)
+        self.level_counts += level_counts
+        self.add('streamline_count', edges)
 
-    # only select voxels with a label greater than zero
-    selection_mask = (atlas.get_fdata() > 0)
+        if weights is not None:
+            self.weights_name = weights_name
+            weights = weights[distance_mask]
+            self.add(weights_name, edges, weights)
 
-    selection_indices = node_ijk[selection_mask.reshape(-1), :]
+        for (scale_name, scale_values) in (scales or {}).items():
+            scale_values = scale_values[distance_mask]
+            self.add(scale_name, edges, scale_values if weights is None else weights * scale_values)
 
-    selection_xyz = node_xyz[selection_mask.reshape(-1), :]
+    def dropped(self):
+        # number of streamlines dropped at every radius
+        return self.level_counts.sum() - np.cumsum(self.level_counts)[:-1]
 
-    selection_labels = atlas.get_fdata()[selection_mask].astype(int)
+    def connectomes(self, search_radius=None):
+        # connectomes at one of the search radii (the largest by default)
+        levels = self.search_radii.shape[0] if search_radius is None else int(np.flatnonzero(self.search_radii == search_radius)[0]) + 1
+        connectomes = {}
+        for (name, edge_sums) in self.sums.items():
+            # generate symmetric connectivity matrix (from the sums of all levels up to the radius)
+            adj = edge_sums.reshape(-1, self.node_count, self.node_count)[:levels].sum(axis=0)
+            adj = adj + adj.T
+            adj[np.diag_indices_from(adj)] /= 2
+            connectomes[name] = adj
 
-    # build a kdtree for spatial proximity queries
-    kdtree = spatial.cKDTree(selection_xyz)
+        # scales are averaged over streamlines (weighted by streamline weights if given)
+        denominator = connectomes[self.weights_name or 'streamline_count']
+        for name in connectomes:
+            if name not in ('streamline_count', self.weights_name):
+                connectomes[name] = np.divide(connectomes[name], denominator, out=np.zeros_like(denominator), where=(denominator != 0))
 
-    # get the list of endpoints
-    starts = endpoints[:, 0, :]
-    ends = endpoints[:, -1, :]
+        return connectomes
+
+
+def accumulate_connectomes(atlas_files, endpoints, search_radius, engine='kdtree', weights=None, scales=None, chunk_size=default_chunk_size, workers=1):
+    # Accumulate the connectomes of several atlases in a single pass over the (possibly memory-mapped)
+    # endpoints array, processed in chunks of streamlines to keep memory flat.
+    #
+    # search_radius is a radius or a list of radii, weights are given as a (name, values) pair, and
+    # scales as a {name: values} dictionary. Returns the Connectome of every atlas.
+    connectomes = [Connectome(atlas_file, search_radius, engine) for atlas_file in atlas_files]
+    weights_name, weights = weights or (None, None)
+    scale_names = list(scales or {})
+
+    def assign(chunk):
+        starts, ends = chunk[:2]
+        return [connectome.assign(starts, ends) for connectome in connectomes]
+
+    def accumulate(chunk, assigned):
+        chunk_weights, *chunk_scales = chunk[2:]
+        for (connectome, chunk_assigned) in zip(connectomes, assigned.result()):
+            connectome.accumulate(chunk_assigned, chunk_weights, weights_name, dict(zip(scale_names, chunk_scales)))
+
+    # query chunks in parallel threads (keeping a bounded number of pending chunks), and accumulate in order
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in iterate_chunks(endpoints, chunk_size, weights, *[scales[x] for x in scale_names]):
+            pending.append((chunk, executor.submit(assign, chunk)))
+            if len(pending) > workers:
+                accumulate(*pending.popleft())
+        while pending:
+            accumulate(*pending.popleft())
+
+    return connectomes
+
+
+def map_connectomes(atlas_files, endpoints, search_radius, engine='kdtree', weights=None, scales=None, chunk_size=default_chunk_size, workers=1):
+    # Returns a list with a dictionary of connectomes per atlas.
+    return [
+        connectome.connectomes()
+        for connectome in accumulate_connectomes(atlas_files, endpoints, search_radius, engine, weights, scales, chunk_size, workers)
+    ]
+
+
+def sweep_connectomes(atlas_files, endpoints, search_radii, engine='kdtree', weights=None, scales=None, chunk_size=default_chunk_size, workers=1):
+    # Returns a list with a dictionary of connectomes per radius for every atlas, along with a list
+    # of the number of dropped streamlines per radius for every atlas.
+    connectomes = accumulate_connectomes(atlas_files, endpoints, search_radii, engine, weights, scales, chunk_size, workers)
+    return (
+        [{radius: connectome.connectomes(radius) for radius in connectome.search_radii} for connectome in connectomes],
+        [dict(zip(connectome.search_radii, connectome.dropped())) for connectome in connectomes],
+    )
+
+
+if __name__ == '__main__':
+    # command line arguments
+    parser = argparse.ArgumentParser(description='Pythonic immitation of MRtrix tck2connectome.')
+    parser.add_argument('atlas_file', help='atlas file (or comma separated list of atlases)')
+    parser.add_argument('endpoint_file', help='streamline endpoints stored as npy')
+    parser.add_argument('output_file', help='output csv/npz file (or comma separated list, one per atlas), use a {metric} placeholder when computing several metrics')
+    parser.add_argument('search_radius', help='assignment radial search distance (mm), or a comma separated list of distances')
+    parser.add_argument('--engine', choices=sorted(assignment_engines), default='kdtree', help='endpoint assignment engine')
+    parser.add_argument('--weights', nargs=2, metavar=('NAME', 'FILE'), help='per streamline weights (npy), e.g. sift2_fbc sift_weights.npy')
+    parser.add_argument('--scale', nargs=2, metavar=('NAME', 'FILE'), action='append', default=[], help='per streamline values (npy) to average over each edge, e.g. mean_length streamline_metric_length.npy (repeatable)')
+    parser.add_argument('--chunk_size', type=int, default=default_chunk_size, help='number of streamlines processed at once')
+    parser.add_argument('--workers', type=int, default=1, help='number of threads querying chunks in parallel')
+    parser.add_argument('--dropped_file', default=None, help='optional csv file of the number of dropped streamlines per atlas and radius')
+    args = parser.parse_args()
 
-    # query for closest coordinate from selection
-    start_dists, start_indices = kdtree.query(starts)
-    end_dists, end_indices = kdtree.query(ends)
+    # comma separated list of search radii (radius sweep)
+    search_radii = sorted(set(float(x) for x in args.search_radius.split(',')))
 
-    # mask points that are further than the search radius from all selection coordinates
-    search_radius = float(search_radius)
-    distance_mask = (start_dists < search_radius) & (end_dists < search_radius)
+    # comma separated lists of atlases and outputs (batch mode)
+    atlas_files = args.atlas_file.split(',')
+    output_files = args.output_file.split(',')
+    if len(atlas_files) != len(output_files):
+        parser.error('Expected one output file per atlas, got {} atlases and {} outputs.'.format(len(atlas_files), len(output_files)))
+    if (args.weights or args.scale) and not all('{metric}' in x for x in output_files):
+        parser.error('Output files need a {metric} placeholder when computing weighted or scaled connectomes.')
+    if len(search_radii) > 1 and not all('{radius}' in x for x in output_files):
+        parser.error('Output files need a {radius} placeholder when computing connectomes for several search radii.')
 
-    # only keep valid endpoints according to the search radius
-    valid_start_indices = start_indices[distance_mask]
-    valid_end_indices = end_indices[distance_mask]
+    # memory-map the endpoints (and per streamline weights and scales) only once for all atlases
+    endpoints = np.load(args.endpoint_file, mmap_mode='r')
+    weights = None if args.weights is None else (args.weights[0], np.load(args.weights[1], mmap_mode='r'))
+    scales = {name: np.load(scale_file, mmap_mode='r') for (name, scale_file) in args.scale}
+    for values in ([weights[1]] if weights else []) + list(scales.values()):
+        if values.shape != (endpoints.shape[0],):
+            parser.error('Expected one value per streamline ({}), got an array of shape {}.'.format(endpoints.shape[0], values.shape))
 
-    # number of regions/nodes
-    node_count = selection_labels.max()
+    with Stage('tck2connectome', atlas=','.join(atlas_name(x) for x in atlas_files), streamlines=endpoints.shape[0], engine=args.engine, search_radius=args.search_radius):
+        atlas_connectomes, atlas_dropped = sweep_connectomes(
+            atlas_files, endpoints, search_radii, args.engine, weights, scales, args.chunk_size, args.workers
+        )
 
-    # generate connectivity matrix
-    adj = np.zeros((node_count, node_count), dtype=np.float32)
-    np.add.at(adj, (selection_labels[valid_start_indices] - 1, selection_labels[valid_end_indices] - 1), 1)
-    adj = adj + adj.T
-    adj[np.diag_indices_from(adj)] /= 2
+        dropped_rows = []
+        for (atlas_file, output_file, radius_connectomes, dropped) in zip(atlas_files, output_files, atlas_connectomes, atlas_dropped):
+            for (radius, connectomes) in radius_connectomes.items():
+                print('{}: {} of {} streamlines dropped at a search radius of {:g} mm.'.format(atlas_name(atlas_file), dropped[radius], endpoints.shape[0], radius))
+                dropped_rows.append('{},{:g},{},{}\n'.format(atlas_name(atlas_file), radius, endpoints.shape[0], dropped[radius]))
+                for (metric, adj) in connectomes.items():
+                    save_connectome(output_file.replace('{metric}', metric).replace('{radius}', '{:g}'.format(radius)), adj, atlas_name(atlas_file), metric)
 
-    # store connectome in a csv file
-    np.savetxt(output_file, adj.astype(np.int32), delimiter=',', fmt="%d")
+        if args.dropped_file is not None:
+            with open(args.dropped_file, 'w') as dropped_file:
+                dropped_file.write('atlas,search_radius,streamlines,dropped\n')
+                dropped_file.writelines(dropped_rows)
@@ -0,0 +1,5 @@
+# the python scripts are not a package, make them importable by the tests
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,25 @@
+# parcels without signal should not affect the connectivity of the other parcels
+
+import numpy as np
+from functional_connectivity import measures, connectivity_matrices
+
+
+def test_empty_parcel():
+    rng = np.random.default_rng(0)
+    timeseries = rng.normal(size=(50, 200)).astype(np.float32)
+    timeseries[7] = np.nan
+    timeseries[21] = 3.
+    valid = np.ones(timeseries.shape[0], dtype=bool)
+    valid[[7, 21]] = False
+
+    matrices = connectivity_matrices(timeseries, measures)
+    valid_matrices = connectivity_matrices(timeseries[valid], measures)
+
+    for measure in measures:
+        # (the diagonal holds the fixed diagonal value of every measure)
+        matrix = matrices[measure]
+        off_diagonal = ~np.eye(matrix.shape[0], dtype=bool)
+        assert np.all(np.isnan(matrix[off_diagonal & ~valid[:, None]]))
+        assert np.all(np.isnan(matrix[off_diagonal & ~valid[None, :]]))
+        assert not np.any(np.isnan(matrix[off_diagonal & valid[:, None] & valid[None, :]]))
+        np.testing.assert_allclose(matrices[measure][np.ix_(valid, valid)], valid_matrices[measure], rtol=1e-5, atol=1e-6)
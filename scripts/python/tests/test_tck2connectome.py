@@ -0,0 +1,65 @@
+# the grid assignment engine should agree with the kdtree engine (nearest labelled voxel within the
+# search radius) on orthogonal, oblique and sheared voxel grids
+
+import numpy as np
+import nibabel as nib
+import pytest
+from tck2connectome import KDTreeAssignment, GridAssignment, map_connectomes
+
+
+voxel_axes = {
+    'isotropic': np.eye(3),
+    'oblique': np.array([[0.8, -0.6, 0.], [0.6, 0.8, 0.], [0., 0., 1.]]) @ np.diag([1.25, 2., 2.5]),
+    'sheared': np.array([[1.5, 0.9, 0.6], [0., 1.5, 0.75], [0., 0., 1.5]]),
+}
+
+
+def fixture_atlas(axes, seed=0):
+    # sparse random labels in the centre of a small volume
+    rng = np.random.default_rng(seed)
+    atlas = np.zeros((30, 32, 28), dtype=int)
+    atlas[5:25, 6:26, 5:23] = rng.integers(0, 20, (20, 20, 18)) * (rng.random((20, 20, 18)) < 0.2)
+    affine = nib.affines.from_matvec(axes, [-20., -25., -15.])
+    return atlas, affine
+
+
+def fixture_points(atlas, affine, count=20000, seed=1):
+    # points scattered around the labelled voxels (some of them out of reach)
+    rng = np.random.default_rng(seed)
+    labelled = np.argwhere(atlas > 0)
+    return nib.affines.apply_affine(affine, labelled[rng.choice(labelled.shape[0], count)] + rng.normal(0, 3, (count, 3)))
+
+
+@pytest.mark.parametrize('axes', sorted(voxel_axes))
+@pytest.mark.parametrize('search_radius', [1.5, 4])
+def test_grid_matches_kdtree(axes, search_radius):
+    atlas, affine = fixture_atlas(voxel_axes[axes])
+    points = fixture_points(atlas, affine)
+
+    kdtree_dists, kdtree_labels = KDTreeAssignment(atlas, affine).query(points, search_radius)
+    grid_dists, grid_labels = GridAssignment(atlas, affine).query(points, search_radius)
+
+    assigned = kdtree_dists < search_radius
+    assert 0 < assigned.sum() < points.shape[0]
+    np.testing.assert_array_equal(grid_labels, kdtree_labels)
+    np.testing.assert_allclose(grid_dists[assigned], kdtree_dists[assigned])
+    assert np.all(grid_dists[~assigned] >= search_radius)
+
+
+def test_grid_connectomes_match_kdtree(tmp_path):
+    atlas, affine = fixture_atlas(voxel_axes['oblique'])
+    atlas_file = str(tmp_path / 'atlas.nii.gz')
+    nib.save(nib.Nifti1Image(atlas.astype(np.int32), affine), atlas_file)
+
+    rng = np.random.default_rng(2)
+    endpoints = np.stack([fixture_points(atlas, affine, seed=3), fixture_points(atlas, affine, seed=4)], axis=1)
+    weights = ('sift2_fbc', rng.random(endpoints.shape[0]))
+    scales = {'mean_length': rng.random(endpoints.shape[0])}
+
+    kdtree = map_connectomes([atlas_file], endpoints, 4, 'kdtree', weights, scales, chunk_size=3000)[0]
+    grid = map_connectomes([atlas_file], endpoints, 4, 'grid', weights, scales, chunk_size=3000)[0]
+
+    assert sorted(grid) == sorted(kdtree)
+    np.testing.assert_array_equal(grid['streamline_count'], kdtree['streamline_count'])
+    for metric in kdtree:
+        np.testing.assert_allclose(grid[metric], kdtree[metric])
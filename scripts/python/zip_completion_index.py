@@ -0,0 +1,162 @@
+# script to keep track of the outputs that are already stored in the compressed subject folders
+#
+# The central directories (file listings) of all <subject>_<zip_file>_<instance>.zip files (zip_file
+# being one of atlases, fMRI, or tractography) are read in parallel and stored in a persistent sqlite
+# index. Zip files are only read again when their modification time or size changes.
+#
+# Usage:
+#     zip_completion_index.py update <main_dir> [--workers N]
+#     zip_completion_index.py missing <main_dir> <zip_file> <required files ...> [--start i] [--end j]
+#
+# Instances are listed (and numbered from 1) as in the dwi,rsfc,surf,t1.combined list created by
+# combine_bulk_files_to_subject_list.py. The missing command prints the indices of all instances
+# that lack any of the required files in their zip file.
+
+import os
+import sqlite3
+import zipfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import ensure_dir, time_str
+
+
+zip_files = ['atlases', 'fMRI', 'tractography']
+
+
+def normalize_name(name):
+    # file names are stored relative to the subject directory (zip -r stores "./fMRI" as "fMRI/...")
+    while name.startswith('./'):
+        name = name[2:]
+    return name
+
+
+def read_subject_instances(main_dir):
+    # list of (subject, instance) pairs from the combined bulk file
+    with open('{}/data/temporary/bulk/dwi,rsfc,surf,t1.combined'.format(main_dir)) as combined_file:
+        return [tuple(line.split()[:2]) for line in combined_file if line.strip()]
+
+
+def zip_file_name(main_dir, ukb_subject_id, ukb_instance, zip_file):
+    return '{}/data/output/subjects/{}_{}/{}_{}_{}.zip'.format(main_dir, ukb_subject_id, ukb_instance, ukb_subject_id, zip_file, ukb_instance)
+
+
+def open_index(main_dir):
+    connection = sqlite3.connect(ensure_dir('{}/data/temporary/bulk/zip_completion_index.sqlite'.format(main_dir)))
+    connection.executescript(
+        '''
+        CREATE TABLE IF NOT EXISTS zips (
+            subject TEXT, instance TEXT, zip_file TEXT, mtime REAL, size INTEGER,
+            PRIMARY KEY (subject, instance, zip_file)
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            subject TEXT, instance TEXT, zip_file TEXT, name TEXT,
+            PRIMARY KEY (zip_file, subject, instance, name)
+        ) WITHOUT ROWID;
+        '''
+    )
+    return connection
+
+
+def list_zip(file_name):
+    # read the central directory of a zip file (the compressed content is not touched)
+    try:
+        with zipfile.ZipFile(file_name) as zip_content:
+            return [normalize_name(x) for x in zip_content.namelist()]
+    except (zipfile.BadZipFile, OSError):
+        # zip files that are being written (or are corrupt) are treated as empty
+        return []
+
+
+def update_index(main_dir, workers=16):
+    connection = open_index(main_dir)
+    indexed = {
+        (subject, instance, zip_file): (mtime, size)
+        for (subject, instance, zip_file, mtime, size) in connection.execute('SELECT subject, instance, zip_file, mtime, size FROM zips')
+    }
+
+    # find zip files that are new, changed, or removed since the last update
+    changed = []
+    removed = []
+    for (ukb_subject_id, ukb_instance) in read_subject_instances(main_dir):
+        for zip_file in zip_files:
+            key = (ukb_subject_id, ukb_instance, zip_file)
+            try:
+                stat = os.stat(zip_file_name(main_dir, *key))
+            except FileNotFoundError:
+                if key in indexed:
+                    removed.append(key)
+                continue
+            if indexed.get(key) != (stat.st_mtime, stat.st_size):
+                changed.append((key, stat))
+
+    print('{}: \033[0;32m[INFO]\033[0m Reading {} new or modified zip files.'.format(time_str(), len(changed)))
+
+    # read the file listings in parallel
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        listings = executor.map(lambda x: list_zip(zip_file_name(main_dir, *x[0])), changed)
+
+        with connection:
+            for key in removed:
+                connection.execute('DELETE FROM zips WHERE subject = ? AND instance = ? AND zip_file = ?', key)
+                connection.execute('DELETE FROM files WHERE subject = ? AND instance = ? AND zip_file = ?', key)
+            for ((key, stat), names) in zip(changed, listings):
+                connection.execute('DELETE FROM files WHERE subject = ? AND instance = ? AND zip_file = ?', key)
+                connection.executemany(
+                    'INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?)',
+                    [key + (name,) for name in names]
+                )
+                connection.execute('INSERT OR REPLACE INTO zips VALUES (?, ?, ?, ?, ?)', key + (stat.st_mtime, stat.st_size))
+
+    connection.close()
+
+    print('{}: \033[0;32m[INFO]\033[0m Zip index updated ({} removed).'.format(time_str(), len(removed)))
+
+
+def missing_instances(main_dir, zip_file, required_files, start=1, end=None):
+    # indices (starting from 1) of the instances that are missing any of the required files
+    connection = open_index(main_dir)
+    required_files = sorted(set(normalize_name(x) for x in required_files))
+
+    connection.execute('CREATE TEMP TABLE required (name TEXT PRIMARY KEY)')
+    connection.executemany('INSERT INTO temp.required VALUES (?)', [(x,) for x in required_files])
+    complete = set(
+        connection.execute(
+            '''
+            SELECT subject, instance FROM files JOIN temp.required USING (name)
+            WHERE zip_file = ?
+            GROUP BY subject, instance
+            HAVING COUNT(*) = ?
+            ''',
+            (zip_file, len(required_files))
+        )
+    )
+    connection.close()
+
+    subject_instances = read_subject_instances(main_dir)
+    end = len(subject_instances) if end is None else min(end, len(subject_instances))
+
+    return [index for index in range(start, end + 1) if subject_instances[index - 1] not in complete]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the outputs stored in the compressed subject folders.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update_parser = subparsers.add_parser('update', help='read new or modified zip files into the index')
+    update_parser.add_argument('main_dir')
+    update_parser.add_argument('--workers', type=int, default=16, help='number of zip files read in parallel')
+
+    missing_parser = subparsers.add_parser('missing', help='print the indices of instances with missing files')
+    missing_parser.add_argument('main_dir')
+    missing_parser.add_argument('zip_file', choices=zip_files)
+    missing_parser.add_argument('required_files', nargs='+')
+    missing_parser.add_argument('--start', type=int, default=1, help='first instance index (inclusive)')
+    missing_parser.add_argument('--end', type=int, default=None, help='last instance index (inclusive)')
+
+    args = parser.parse_args()
+
+    if args.command == 'update':
+        update_index(args.main_dir, args.workers)
+    else:
+        for index in missing_instances(args.main_dir, args.zip_file, args.required_files, args.start, args.end):
+            print(index)